@@ -0,0 +1,147 @@
+"""
+Benchmark of the conversation memory of handle_openai_model against history length.
+
+For chats of growing length, compares the memory the handler used to build,
+every turn of the chat replayed into a new ConversationBufferMemory on each
+message, with the per-chat store of utils/conversation.py. No requests are
+sent: the local time to build the history and record the turn is measured, and
+the size of the prompt, which is what the model's latency and cost grow with.
+--prefill-ms adds an estimate of the model's time to read the prompt.
+
+Then many chats are filled concurrently from threads to check the store stays
+within its bounds and loses no turns.
+
+Usage:
+python bench/conversation_memory.py --lengths 10,100,1000,5000
+python bench/conversation_memory.py --chats 5000 --threads 16 --prefill-ms 0.05
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain.memory import ConversationBufferMemory
+
+from utils.conversation import ConversationStore, count_tokens
+
+WORDS = ("cache index query memory parser thread process queue socket buffer kernel scheduler compiler vector "
+         "matrix network storage request response latency throughput").split()
+
+
+def make_turn(rng):
+    """
+    Function to generate a question and an answer of a few sentences.
+    """
+    def sentences(count):
+        return " ".join(" ".join(rng.choice(WORDS) for _ in range(rng.randint(6, 20))).capitalize() + "."
+                        for _ in range(count))
+    return sentences(rng.randint(1, 2)), sentences(rng.randint(2, 6))
+
+
+def replay_history(turns):
+    """
+    Function to build the history like the handler did before the store.
+    """
+    memory = ConversationBufferMemory(memory_key="chat_history", max_len=2000)
+    for human, answer in turns:
+        memory.save_context({"question": human}, {"output": answer})
+    return memory.buffer
+
+
+def measure_length(length, args, rng):
+    """
+    Function to time one message at the end of a chat of a given length, both ways.
+
+    Returns:
+    dict: The median milliseconds and prompt tokens of the replay and of the store.
+    """
+    turns = [make_turn(rng) for _ in range(length)]
+    store = ConversationStore(None, max_tokens=args.tokens)
+    for human, answer in turns:
+        store.add_turn(1, human, answer)
+
+    replay_ms, store_ms = [], []
+    for _ in range(args.repeat):
+        human, answer = make_turn(rng)
+        start = time.perf_counter()
+        replay_prompt = replay_history(turns)
+        replay_ms.append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        store_prompt = store.history(1)
+        store.add_turn(1, human, answer)
+        store_ms.append((time.perf_counter() - start) * 1000)
+
+    replay_tokens, store_tokens = count_tokens(replay_prompt), count_tokens(store_prompt)
+    return {"replay_ms": statistics.median(replay_ms), "store_ms": statistics.median(store_ms),
+            "replay_tokens": replay_tokens, "store_tokens": store_tokens,
+            "replay_total_ms": statistics.median(replay_ms) + replay_tokens * args.prefill_ms,
+            "store_total_ms": statistics.median(store_ms) + store_tokens * args.prefill_ms}
+
+
+def fill_concurrently(args, rng):
+    """
+    Function to add turns to many chats from threads, with a small in-memory limit so chats are spilled.
+
+    Returns:
+    tuple: The seconds it took, the stats of the store and the number of turns found afterwards.
+    """
+    path = os.path.join(tempfile.mkdtemp(prefix="notes-memory-"), "conversations.sqlite")
+    store = ConversationStore(path, max_chats=args.max_chats, max_tokens=args.tokens)
+    messages = [(rng.randrange(args.chats), n) for n in range(args.messages)]
+
+    def send(message):
+        chat_id, n = message
+        store.history(chat_id)
+        store.add_turn(chat_id, "question {}".format(n), "answer {}".format(n))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.threads) as executor:
+        list(executor.map(send, messages))
+    seconds = time.perf_counter() - start
+    stats = store.get_stats()
+
+    # Every turn is short, so each one must still be in the window of its chat
+    store.close()
+    reopened = ConversationStore(path, max_chats=args.chats, max_tokens=args.tokens)
+    found = sum(reopened.history(chat_id).count("Human: ") for chat_id in {chat_id for chat_id, _ in messages})
+    return seconds, stats, found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lengths", default="10,100,1000,5000", help="Numbers of turns before the message.")
+    parser.add_argument("--repeat", type=int, default=5, help="Messages timed at each length.")
+    parser.add_argument("--tokens", type=int, default=1500, help="Token budget of the window of recent turns.")
+    parser.add_argument("--prefill-ms", type=float, default=0.0, help="Estimated model milliseconds per prompt token.")
+    parser.add_argument("--chats", type=int, default=2000)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--max-chats", type=int, default=200, help="Chats kept in memory in the concurrent run.")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    print("{:>7} {:>10} {:>10} {:>11} {:>11} {:>12} {:>12}".format(
+        "turns", "replay ms", "store ms", "replay tok", "store tok", "replay+model", "store+model"))
+    for length in (int(length) for length in args.lengths.split(",")):
+        result = measure_length(length, args, rng)
+        print("{:>7} {:>10.2f} {:>10.3f} {:>11} {:>11} {:>12.1f} {:>12.1f}".format(
+            length, result["replay_ms"], result["store_ms"], result["replay_tokens"], result["store_tokens"],
+            result["replay_total_ms"], result["store_total_ms"]))
+
+    seconds, stats, found = fill_concurrently(args, rng)
+    print("\n{} messages to {} chats from {} threads in {:.2f}s ({:.0f}/s)".format(
+        args.messages, args.chats, args.threads, seconds, args.messages / seconds))
+    print("in memory: {} chats, {} tokens; spilled {} times; turns found after reopening: {} of {}".format(
+        stats["chats"], stats["tokens"], stats["spilled"], found, args.messages))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,440 @@
+"""
+Offline end-to-end benchmark of the bot.
+
+Replays synthetic Telegram updates (plain text, text with links, photos and
+voice messages) through the real application built by main.py. Every service
+it talks to is a local stand-in served from this process, with configurable
+latency:
+
+- telegram: the Bot API (messages, edits, chat actions, files)
+- notion: page creation and database queries
+- gemini: text and vision replies
+- whisper: OpenAI audio transcriptions
+- web: a corpus of HTML pages, generated or read from a directory of saved pages
+
+The Gemini SDK only talks gRPC over TLS from async code, so the shared model
+objects are replaced by a thin client that sends each request to the local
+stand-in instead. Everything else goes through the real clients.
+
+Each update is timed from the moment it is handed to the application until
+its reply shows the final result. The report has the throughput, the latency
+percentiles of each kind of note and the per-stage timings of the metrics
+registry. No network access or API keys are needed.
+
+Usage:
+python bench/e2e.py --updates 200 --chats 20 --rate 20 --latency gemini=0.8 notion=0.3
+"""
+import io
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+import tempfile
+import threading
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TOKEN = "123456:bench"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+DEFAULT_LATENCY = {"telegram": 0.03, "notion": 0.3, "gemini": 0.8, "whisper": 1.0, "web": 0.2}
+WORDS = ("note idea meeting article paper recipe travel budget project design review python async cache "
+         "latency index search summary notion telegram image voice link reading list").split()
+# Replies that end the processing of a note
+FINAL_MARKERS = ("Saved to Notion", "Already saved", "already being saved", "Error:", "Too many notes")
+
+
+class Services:
+    """
+    State of the local stand-ins, shared by the server threads and the benchmark.
+    """
+    def __init__(self, latency, pages, files):
+        self.latency = latency
+        self.pages = pages
+        self.files = files
+        self.lock = threading.Lock()
+        self.next_message_id = 10 ** 6
+        self.placeholders = {}
+        self.finished = {}
+        self.counts = {}
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+            return self.counts[name]
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """
+    Request handler of every stand-in, routed by path prefix.
+    """
+    protocol_version = "HTTP/1.1"
+    services = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, body, content_type="application/json", status=200):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length) if length else b""
+
+    def wait(self, service):
+        time.sleep(self.services.latency.get(service, 0) * random.uniform(0.5, 1.5))
+
+    def do_GET(self):
+        self.route(b"")
+
+    def do_POST(self):
+        self.route(self.read_body())
+
+    def route(self, body):
+        path = self.path.split("?")[0]
+        if path.startswith("/bot"):
+            self.wait("telegram")
+            self.telegram(path.rsplit("/", 1)[1], body)
+        elif path.startswith("/file/bot"):
+            self.wait("telegram")
+            self.reply(self.services.files[path.rsplit("/", 1)[1]], "application/octet-stream")
+        elif path.startswith("/notion/"):
+            self.wait("notion")
+            self.notion(path, body)
+        elif path.startswith("/gemini"):
+            self.wait("gemini")
+            request = json.loads(body)
+            number = self.services.count("gemini")
+            if request["kind"] == "image":
+                text = "A photo of {} things, number {}".format(random.choice(WORDS), number)
+            else:
+                text = json.dumps({"summary": "Summary {} about {}.".format(number, " ".join(random.sample(WORDS, 5))),
+                                   "tags": ", ".join(random.sample(WORDS, 3))})
+            self.reply({"text": text})
+        elif path.startswith("/openai/"):
+            self.wait("whisper")
+            number = self.services.count("whisper")
+            self.reply({"text": "Voice note {}: {}".format(number, " ".join(random.choices(WORDS, k=40)))})
+        elif path.startswith("/web/"):
+            self.wait("web")
+            page = self.services.pages[int(path.rsplit("/", 1)[1]) % len(self.services.pages)]
+            self.reply(page, "text/html; charset=utf-8")
+        else:
+            self.reply({"error": "not found"}, status=404)
+
+    def telegram(self, method, body):
+        content_type = self.headers.get("Content-Type", "")
+        if "json" in content_type:
+            params = json.loads(body or b"{}")
+        else:
+            params = {key: values[0] for key, values in parse_qs(body.decode("utf-8")).items()}
+        services = self.services
+        now = time.perf_counter()
+
+        if method == "getMe":
+            result = BOT_USER
+        elif method == "sendChatAction":
+            result = True
+        elif method == "getFile":
+            file_id = params["file_id"]
+            result = {"file_id": file_id, "file_unique_id": file_id, "file_size": len(services.files[file_id]),
+                      "file_path": file_id}
+        elif method in ("sendMessage", "editMessageText"):
+            chat_id = int(params["chat_id"])
+            text = params.get("text", "")
+            with services.lock:
+                if method == "sendMessage":
+                    services.next_message_id += 1
+                    message_id = services.next_message_id
+                    reply_to = json.loads(params.get("reply_parameters") or "{}").get("message_id")
+                    if reply_to is not None:
+                        services.placeholders[(chat_id, message_id)] = (chat_id, reply_to)
+                        original = (chat_id, reply_to)
+                    else:
+                        original = None
+                else:
+                    message_id = int(params["message_id"])
+                    original = services.placeholders.get((chat_id, message_id))
+                if original is not None and original not in services.finished:
+                    for marker in FINAL_MARKERS:
+                        if marker in text:
+                            services.finished[original] = (now, marker)
+                            break
+            result = {"message_id": message_id, "date": int(time.time()), "text": text, "from": BOT_USER,
+                      "chat": {"id": chat_id, "type": "group", "title": "bench"}}
+        else:
+            result = True
+        self.reply({"ok": True, "result": result})
+
+    def notion(self, path, body):
+        if path.endswith("/pages"):
+            data = json.loads(body)
+            page_id = str(uuid.uuid4())
+            self.reply({"object": "page", "id": page_id, "url": "https://www.notion.so/" + page_id.replace("-", ""),
+                        "created_time": time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime()),
+                        "properties": data.get("properties", {})})
+        else:
+            self.reply({"object": "list", "results": [], "has_more": False, "next_cursor": None})
+
+
+class FakeGeminiResponse:
+    """
+    Stand-in for the response of the Gemini SDK.
+    """
+    def __init__(self, text):
+        self.text = text
+
+    async def resolve(self):
+        pass
+
+
+class FakeGeminiModel:
+    """
+    Stand-in for a Gemini model object that sends its requests to the local Gemini stand-in.
+    """
+    def __init__(self, url, kind):
+        self.url = url
+        self.kind = kind
+
+    async def generate_content_async(self, contents=None, generation_config=None, **kwargs):
+        from utils.http_client import get_http_client
+        res = await get_http_client().post(self.url, json={"kind": self.kind, "chars": len(str(contents))})
+        return FakeGeminiResponse(res.json()["text"])
+
+
+def make_pages(rng, count):
+    """
+    Function to generate HTML pages of very different sizes and shapes.
+    """
+    pages = []
+    for n in range(count):
+        paragraphs = "".join("<p>{}</p>".format(" ".join(rng.choices(WORDS, k=rng.randint(20, 120))))
+                             for _ in range(rng.choice((3, 10, 40, 200))))
+        cruft = "".join('<li><a href="/x/{0}">menu {0}</a></li>'.format(i) for i in range(rng.choice((10, 300))))
+        pages.append((
+            '<html><head><title>Page {n}</title><meta name="description" content="Page {n} about {w}">'
+            '<meta property="og:image" content="https://example.com/{n}.jpg"><script>var x = {n};</script>'
+            '</head><body><nav><ul>{cruft}</ul></nav><article><h1>Page {n}</h1>{paragraphs}</article>'
+            '<footer>{cruft}</footer></body></html>').format(n=n, w=rng.choice(WORDS), cruft=cruft,
+                                                              paragraphs=paragraphs).encode("utf-8"))
+    return pages
+
+
+def load_pages(directory):
+    """
+    Function to read a corpus of saved HTML pages.
+    """
+    pages = []
+    for name in sorted(os.listdir(directory)):
+        if name.endswith((".html", ".htm")):
+            with open(os.path.join(directory, name), "rb") as page_file:
+                pages.append(page_file.read())
+    if not pages:
+        raise SystemExit("No .html files in " + directory)
+    return pages
+
+
+def make_photo(rng):
+    """
+    Function to generate a photo-sized JPEG that no other generated photo looks like.
+    """
+    from PIL import Image
+    small = Image.frombytes("RGB", (8, 6), bytes(rng.randrange(256) for _ in range(8 * 6 * 3)))
+    out = io.BytesIO()
+    small.resize((1280, 960), Image.BILINEAR).save(out, "JPEG", quality=85)
+    return out.getvalue()
+
+
+def make_updates(rng, args, base_url, files):
+    """
+    Function to generate the updates to replay.
+
+    Returns:
+    list: Tuples of kind and update dict.
+    """
+    kinds, weights = zip(*args.mix.items())
+    updates = []
+    sent_texts = []
+    for n in range(args.updates):
+        chat_id = rng.randrange(args.chats) + 1
+        message = {"message_id": n + 1, "date": int(time.time()), "from": {"id": chat_id, "is_bot": False,
+                   "first_name": "User"}, "chat": {"id": chat_id, "type": "group", "title": "bench"}}
+        kind = rng.choices(kinds, weights)[0]
+        if sent_texts and rng.random() < args.duplicates:
+            kind = "duplicate"
+            message["text"] = rng.choice(sent_texts)
+        elif kind == "text":
+            message["text"] = "Note {}: {}".format(n, " ".join(rng.choices(WORDS, k=rng.randint(5, 60))))
+        elif kind == "links":
+            links = " ".join("{}/web/{}?n={}".format(base_url, rng.randrange(10 ** 6), n)
+                             for _ in range(rng.randint(1, 3)))
+            message["text"] = "Read later {} {}".format(n, links)
+        elif kind == "photo":
+            file_id = "photo{}".format(n)
+            files[file_id] = make_photo(rng)
+            message["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": 1280, "height": 960,
+                                 "file_size": len(files[file_id])}]
+        else:
+            file_id = "voice{}".format(n)
+            files[file_id] = os.urandom(rng.randint(10, 200) * 1024)
+            message["voice"] = {"file_id": file_id, "file_unique_id": file_id, "duration": rng.randint(3, 120),
+                                "mime_type": "audio/ogg", "file_size": len(files[file_id])}
+        if "text" in message and kind != "duplicate":
+            sent_texts.append(message["text"])
+        updates.append((kind, {"update_id": n + 1, "message": message}))
+    return updates
+
+
+def percentiles(timings):
+    """
+    Function to get the p50, p95 and p99 of timings in milliseconds.
+    """
+    timings = sorted(timings)
+    return [timings[min(len(timings) - 1, int(len(timings) * q))] * 1000 for q in (0.5, 0.95, 0.99)]
+
+
+async def replay(args, services, updates, base_url):
+    """
+    Function to run the application and feed it the updates.
+
+    Returns:
+    tuple: The time each update was sent, and the time the last one finished.
+    """
+    import main as bot
+    from telegram import Update
+    from telegram.ext import ApplicationBuilder
+    from utils import gemini_api
+
+    gemini_api._models[gemini_api.TEXT_MODEL] = FakeGeminiModel(base_url + "/gemini", "text")
+    gemini_api._models[gemini_api.VISION_MODEL] = FakeGeminiModel(base_url + "/gemini", "image")
+
+    builder = (ApplicationBuilder().token(TOKEN).base_url(base_url + "/bot").base_file_url(base_url + "/file/bot")
+               .connection_pool_size(256))
+    application = bot.build_application(builder)
+    await application.initialize()
+    await bot.startup(application)
+
+    sent = {}
+    tasks = []
+    rng = random.Random(args.seed + 1)
+    for kind, data in updates:
+        update = Update.de_json(data, application.bot)
+        sent[(update.message.chat_id, update.message.message_id)] = (kind, time.perf_counter())
+        tasks.append(asyncio.create_task(application.process_update(update)))
+        if args.rate:
+            await asyncio.sleep(rng.expovariate(args.rate))
+    await asyncio.gather(*tasks)
+
+    deadline = time.perf_counter() + args.timeout
+    while len(services.finished) < len(sent) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+
+    await bot.shutdown(application)
+    await application.shutdown()
+    return sent
+
+
+def report(services, sent):
+    """
+    Function to print the throughput, the latency of each kind of note and the time spent in each stage.
+    """
+    from utils.metrics import get_metrics
+
+    finished = services.finished
+    start = min(at for _, at in sent.values())
+    end = max((at for at, _ in finished.values()), default=start)
+    outcomes = {}
+    for key in sent:
+        outcome = finished[key][1] if key in finished else "unfinished"
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    print("finished {} of {} updates in {:.1f}s, {:.1f} updates/sec".format(
+        len(finished), len(sent), end - start, len(finished) / (end - start) if end > start else 0))
+    print("outcomes: " + ", ".join("{} {}".format(name, count) for name, count in sorted(outcomes.items())))
+
+    print("\n{:<10} {:>7} {:>9} {:>9} {:>9}".format("kind", "notes", "p50 ms", "p95 ms", "p99 ms"))
+    kinds = sorted({kind for kind, _ in sent.values()})
+    for kind in kinds + ["all"]:
+        timings = [finished[key][0] - at for key, (k, at) in sent.items()
+                   if key in finished and kind in (k, "all")]
+        if timings:
+            print("{:<10} {:>7} {:>9.0f} {:>9.0f} {:>9.0f}".format(kind, len(timings), *percentiles(timings)))
+
+    print("\n{:<18} {:>7} {:>9} {:>9} {:>9} {:>7}".format("stage", "count", "p50 ms", "p95 ms", "p99 ms",
+                                                         "errors"))
+    for stage, stats in sorted(get_metrics().snapshot()["stages"].items()):
+        print("{:<18} {:>7} {:>9.1f} {:>9.1f} {:>9.1f} {:>7}".format(
+            stage, stats["count"], stats["p50_ms"] or 0, stats["p95_ms"] or 0, stats["p99_ms"] or 0,
+            stats["errors"]))
+
+
+def parse_pairs(pairs, defaults, kind):
+    """
+    Function to parse name=value arguments over a dict of defaults.
+    """
+    values = dict(defaults)
+    for pair in pairs:
+        name, _, value = pair.partition("=")
+        if name not in values:
+            raise SystemExit("Unknown {} {!r}, expected one of {}".format(kind, name, ", ".join(values)))
+        values[name] = float(value)
+    return values
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=200)
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--rate", type=float, default=20, help="Updates per second, 0 to send them all at once.")
+    parser.add_argument("--mix", nargs="*", default=[], metavar="KIND=WEIGHT",
+                        help="Share of text, links, photo and voice notes. Defaults to 3, 4, 2 and 1.")
+    parser.add_argument("--duplicates", type=float, default=0.05, help="Share of texts sent again.")
+    parser.add_argument("--latency", nargs="*", default=[], metavar="SERVICE=SECONDS",
+                        help="Mean latency of telegram, notion, gemini, whisper and web.")
+    parser.add_argument("--pages", type=int, default=50, help="Number of generated web pages.")
+    parser.add_argument("--corpus", help="Directory of saved .html pages to serve instead.")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    args.mix = parse_pairs(args.mix, {"text": 3, "links": 4, "photo": 2, "voice": 1}, "kind")
+    latency = parse_pairs(args.latency, DEFAULT_LATENCY, "service")
+    rng = random.Random(args.seed)
+
+    pages = load_pages(args.corpus) if args.corpus else make_pages(rng, args.pages)
+    services = Services(latency, pages, {})
+    ServiceHandler.services = services
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ServiceHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = "http://127.0.0.1:{}".format(server.server_address[1])
+
+    # Keep the caches, indexes and stored images of the run out of the repository
+    os.chdir(tempfile.mkdtemp(prefix="notes-e2e-"))
+    os.environ.update({
+        "CACHE_DIR": os.path.join(os.getcwd(), "cache"),
+        "NOTION_API": "bench", "NOTION_DATABASE_ID": "bench", "NOTION_API_URL": base_url + "/notion/v1",
+        "GOOGLE_API_KEY": "bench", "OPENAI_API_KEY": "bench", "OPENAI_BASE_URL": base_url + "/openai/v1",
+        "FILESERVER": base_url + "/files/", "METRICS_PORT": "0",
+        # The stand-ins are all on one host, and Notion's rate limit is not what is measured
+        "FETCH_MAX_PER_HOST": "1000", "NOTION_RATE_LIMIT": "1000", "NOTION_MAX_IN_FLIGHT": "50",
+    })
+
+    updates = make_updates(rng, args, base_url, services.files)
+    sent = asyncio.run(replay(args, services, updates, base_url))
+    server.shutdown()
+    report(services, sent)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""
+Benchmark of page content extraction.
+
+Runs every extraction engine that is installed, and the two functions it
+replaced, over a corpus of saved HTML pages:
+
+- original: BeautifulSoup with html.parser and the text of every p, article,
+  section and main element, so nested containers repeat their text
+- blocks: BeautifulSoup with html.parser, each string once under its nearest
+  container
+- soup, lxml, selectolax: the engines of utils/extract.py, meta tags read from
+  the head and the text of the main block picked by Readability-style scoring
+
+Each one runs in a fresh process, so the peak memory of one does not hide
+another's. Without --corpus, pages are generated with a known article between
+menus, share bars, related links and comments. For those pages the report also
+has the share of the article that was extracted and the share of the extracted
+words that are from the article.
+
+Usage:
+python bench/extract.py --pages 300
+python bench/extract.py --corpus saved_pages/
+"""
+import os
+import re
+import sys
+import time
+import random
+import argparse
+import resource
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bs4 import BeautifulSoup, NavigableString
+
+from utils.extract import ENGINES, read_meta, extract_main_text
+
+ARTICLE_WORDS = ("latency throughput cache index query memory parser thread process queue socket buffer "
+                 "kernel scheduler compiler vector matrix network storage request response").split()
+BOILERPLATE_WORDS = ("Home About Contact Login Subscribe Share Tweet Like Follow Newsletter Privacy Terms "
+                     "Cookies Advertisement Related Popular Trending Reply Comment Author").split()
+WORD = re.compile(r'\w+')
+
+
+def original_parse(html):
+    """
+    Function to extract a page like the bot did originally.
+    """
+    soup = BeautifulSoup(html, 'html.parser')
+    main_text = [element.get_text() for element in soup.find_all(['p', 'article', 'section', 'main'])]
+    meta_description_tag = soup.find('meta', attrs={'name': 'description'})
+    meta_description = meta_description_tag['content'] if meta_description_tag else None
+    main_image_tag = soup.find('meta', attrs={'property': 'og:image'})
+    main_image_url = main_image_tag['content'] if main_image_tag else ""
+    return "{}\n{}".format(meta_description, "\n".join(main_text)), main_image_url
+
+
+def blocks_parse(html):
+    """
+    Function to extract a page like the bot did before the extraction engines.
+    """
+    soup = BeautifulSoup(html, 'html.parser')
+    seen = set()
+    blocks = []
+    block = []
+    owner = None
+    for string in soup.find_all(string=True):
+        if type(string) is not NavigableString:
+            continue
+        parent = string.parent
+        while parent is not None and parent.name not in ('p', 'article', 'section', 'main', 'script', 'style',
+                                                         'noscript', 'template'):
+            parent = parent.parent
+        if parent is None or parent.name in ('script', 'style', 'noscript', 'template'):
+            continue
+        if parent is not owner and block:
+            text = re.sub(r'\s+', ' ', "".join(block)).strip()
+            if text and text not in seen:
+                seen.add(text)
+                blocks.append(text)
+            block = []
+        owner = parent
+        block.append(string)
+    text = re.sub(r'\s+', ' ', "".join(block)).strip()
+    if text and text not in seen:
+        blocks.append(text)
+    meta_description_tag = soup.find('meta', attrs={'name': 'description'})
+    meta_description = meta_description_tag['content'] if meta_description_tag else None
+    main_image_tag = soup.find('meta', attrs={'property': 'og:image'})
+    main_image_url = main_image_tag['content'] if main_image_tag else ""
+    return "{}\n{}".format(meta_description, "\n".join(blocks)), main_image_url
+
+
+def engine_parse(name):
+    """
+    Function to get the extraction of an engine of utils/extract.py.
+    """
+    engine = ENGINES[name]
+
+    def parse(html):
+        description, image = read_meta(html)
+        return "{}\n{}".format(description, "\n".join(extract_main_text(html, engine))), image
+    return parse
+
+
+def make_page(rng, n):
+    """
+    Function to generate a page with an article among boilerplate, like a news or blog page.
+
+    Returns:
+    tuple: The page and the number of article words in it.
+    """
+    def words(vocabulary, count):
+        return " ".join(rng.choice(vocabulary) for _ in range(count))
+
+    paragraphs = ["{}, {}.".format(words(ARTICLE_WORDS, rng.randint(15, 60)), words(ARTICLE_WORDS, 10))
+                  for _ in range(rng.choice((4, 12, 40, 150)))]
+    menu = "".join('<li><a href="/{0}">{1}</a></li>'.format(i, words(BOILERPLATE_WORDS, 2))
+                   for i in range(rng.choice((10, 60, 400))))
+    related = "".join('<div class="related-item"><a href="/r/{0}"><p>{1}</p></a></div>'.format(
+        i, words(BOILERPLATE_WORDS, 8)) for i in range(rng.randint(3, 20)))
+    comments = "".join('<div class="comment"><p>{}</p><span>{}</span></div>'.format(
+        words(BOILERPLATE_WORDS, rng.randint(10, 40)), words(BOILERPLATE_WORDS, 2))
+        for _ in range(rng.choice((0, 10, 100))))
+    scripts = "".join("<script>var data{} = {};</script>".format(i, list(range(200))) for i in range(rng.randint(1, 20)))
+    article = "".join("<p>{}</p>".format(text) for text in paragraphs)
+    # Nest the article in layers of wrappers, as page builders do
+    for depth in range(rng.randint(1, 6)):
+        article = '<div class="wrap-{}"><section>{}</section></div>'.format(depth, article)
+    page = ('<!DOCTYPE html><html><head><meta charset="utf-8"><title>Page {n}</title>{scripts}'
+            '<meta name="description" content="Page {n}"><meta property="og:image" content="https://e.com/{n}.jpg">'
+            '</head><body><header><div class="menu"><ul>{menu}</ul></div></header><main><article '
+            'class="post-content"><h1>Title {n}</h1>{article}</article><div class="share">{share}</div>'
+            '<div class="related">{related}</div><div id="comments">{comments}</div></main>'
+            '<footer><ul>{menu}</ul></footer></body></html>').format(
+        n=n, scripts=scripts, menu=menu, article=article, related=related, comments=comments,
+        share=words(BOILERPLATE_WORDS, 6))
+    return page.encode("utf-8"), sum(len(WORD.findall(text)) for text in paragraphs)
+
+
+def load_corpus(args):
+    """
+    Function to load the saved pages, or generate them.
+
+    Returns:
+    list: Pairs of page and number of article words, None for saved pages.
+    """
+    if args.corpus:
+        pages = []
+        for name in sorted(os.listdir(args.corpus)):
+            if name.endswith((".html", ".htm")):
+                with open(os.path.join(args.corpus, name), "rb") as page_file:
+                    pages.append((page_file.read(), None))
+        return pages
+    rng = random.Random(args.seed)
+    return [make_page(rng, n) for n in range(args.pages)]
+
+
+def run(name, args, results):
+    """
+    Function to extract every page of the corpus with one implementation, in its own process.
+    """
+    pages = load_corpus(args)
+    parse = {"original": original_parse, "blocks": blocks_parse}.get(name) or engine_parse(name)
+    parse(pages[0][0])
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    timings = []
+    extracted = found = article = total = 0
+    for page, article_words in pages:
+        start = time.perf_counter()
+        text, _ = parse(page)
+        timings.append(time.perf_counter() - start)
+        extracted += len(text)
+        if article_words is not None:
+            words = WORD.findall(text)
+            total += len(words)
+            found += sum(1 for word in words if word in ARTICLE_WORDS)
+            article += article_words
+
+    timings.sort()
+    size = sum(len(page) for page, _ in pages)
+    results[name] = {
+        "mean_ms": sum(timings) / len(timings) * 1000,
+        "p95_ms": timings[int(len(timings) * 0.95)] * 1000,
+        "mb_per_sec": size / sum(timings) / 1e6,
+        "peak_mb": (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024,
+        "chars": extracted / len(pages),
+        "recall": min(1.0, found / article) if article else None,
+        "precision": found / total if total else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=300, help="Number of generated pages.")
+    parser.add_argument("--corpus", help="Directory of saved .html pages to use instead.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    pages = load_corpus(args)
+    print("{} pages, {:.1f} MB".format(len(pages), sum(len(page) for page, _ in pages) / 1e6))
+    names = ["original", "blocks"] + [name for name in ("soup", "lxml", "selectolax") if ENGINES[name].available]
+
+    context = multiprocessing.get_context("spawn")
+    results = context.Manager().dict()
+    for name in names:
+        process = context.Process(target=run, args=(name, args, results))
+        process.start()
+        process.join()
+
+    print("\n{:<11} {:>9} {:>9} {:>7} {:>10} {:>10} {:>7} {:>9}".format(
+        "extractor", "mean ms", "p95 ms", "MB/s", "peak +MB", "chars", "recall", "precision"))
+    for name in names:
+        result = results[name]
+        quality = ["{:.2f}".format(result[key]) if result[key] is not None else "-"
+                   for key in ("recall", "precision")]
+        print("{:<11} {:>9.2f} {:>9.2f} {:>7.1f} {:>10.1f} {:>10.0f} {:>7} {:>9}".format(
+            name, result["mean_ms"], result["p95_ms"], result["mb_per_sec"], result["peak_mb"], result["chars"],
+            *quality))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Benchmark of the file server against the previous single-threaded server.
+
+Serves a directory of image-sized files with both servers and fetches them from
+concurrent clients. The new server is measured with keep-alive connections, the
+old one reconnects for every request because it only speaks HTTP/1.0. A slow
+client that reads at a trickle stays connected for the first seconds of the run,
+like Notion fetching an image over a bad link.
+
+Usage:
+python bench/fileserver.py --requests 2000 --clients 16
+"""
+import os
+import sys
+import time
+import socket
+import shutil
+import argparse
+import tempfile
+import threading
+import http.client
+import http.server
+import socketserver
+from functools import partial
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fileserver import create_server
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    """
+    The request handler of the previous server, without request logging.
+    """
+    def log_message(self, format, *args):
+        pass
+
+
+def slow_client(port, seconds):
+    """
+    Function to hold a connection open for a while, reading a file very slowly.
+    """
+    sock = socket.create_connection(("127.0.0.1", port))
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    sock.sendall(b"GET /0.webp HTTP/1.1\r\nHost: localhost\r\n\r\n")
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        try:
+            sock.settimeout(0.5)
+            if not sock.recv(64):
+                break
+        except OSError:
+            pass
+        time.sleep(0.2)
+    sock.close()
+
+
+def client(port, files, count, keep_alive, errors):
+    """
+    Function to fetch files in a loop from one client.
+    """
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    for i in range(count):
+        try:
+            conn.request("GET", "/{}".format(files[i % len(files)]))
+            response = conn.getresponse()
+            response.read()
+            if response.status != 200:
+                errors.append(response.status)
+            if not keep_alive or response.will_close:
+                conn.close()
+        except (OSError, http.client.HTTPException) as err:
+            errors.append(err)
+            conn.close()
+    conn.close()
+
+
+def measure(port, files, requests, clients, keep_alive, slow_seconds):
+    """
+    Function to measure the throughput of a running server.
+
+    Returns:
+    tuple: The number of requests per second and the number of failed requests.
+    """
+    if slow_seconds:
+        threading.Thread(target=slow_client, args=(port, slow_seconds), daemon=True).start()
+        time.sleep(0.1)
+
+    errors = []
+    threads = [threading.Thread(target=client, args=(port, files, requests // clients, keep_alive, errors))
+               for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return (requests // clients * clients) / elapsed, len(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--size", type=int, default=200 * 1024)
+    parser.add_argument("--slow-seconds", type=float, default=2.0, help="How long the slow client stays, 0 to disable.")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="notes-fileserver-")
+    files = []
+    for i in range(args.files):
+        files.append("{}.webp".format(i))
+        with open(os.path.join(directory, files[-1]), "wb") as f:
+            f.write(os.urandom(args.size))
+
+    # The previous server, as fileserver.py used to start it
+    socketserver.TCPServer.allow_reuse_address = True
+    legacy = socketserver.TCPServer(("127.0.0.1", 0), partial(QuietHandler, directory=directory))
+    current = create_server(directory, 0)
+
+    print("{:<10} {:>14} {:>8}".format("server", "requests/sec", "errors"))
+    for name, server, keep_alive in (("legacy", legacy, False), ("threaded", current, True)):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        rps, errors = measure(server.server_address[1], files, args.requests, args.clients, keep_alive,
+                              args.slow_seconds)
+        print("{:<10} {:>14.1f} {:>8}".format(name, rps, errors))
+        server.shutdown()
+
+    shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""
+Fuzz test and benchmark of the markdown to Telegram HTML renderer.
+
+Generates random LLM-like markdown (headings, bullets, emphasis, links, inline
+code, stray markup and many code fences), checks that every rendering is valid
+Telegram HTML (known tags only, properly nested, everything closed) and times
+format_text_to_html against the previous regex-based implementation as the
+number of code blocks grows.
+
+Usage:
+python bench/format_html.py --cases 2000 --sizes 100 1000 5000
+"""
+import os
+import re
+import sys
+import time
+import random
+import argparse
+from html.parser import HTMLParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.helpers import format_text_to_html
+
+TELEGRAM_TAGS = {"b", "i", "u", "s", "a", "code", "pre", "span", "tg-spoiler", "blockquote"}
+
+PIECES = ["word", "**bold**", "*italic*", "`code`", "[link](https://example.com/?a=1&b=2)", "**", "*",
+          "a < b", "x > y", "R&D", "<script>", "</b>", "_", "[", "](", "#", "2*3*4", "**nested *both***",
+          "été", "\U0001F600"]
+LINE_STARTS = ["", "", "", "# ", "## ", "### ", "* ", "- ", "1. "]
+
+
+class TelegramHTMLChecker(HTMLParser):
+    """
+    HTML parser that records the problems Telegram would reject the message for.
+    """
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.stack = []
+        self.errors = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag not in TELEGRAM_TAGS:
+            self.errors.append("unsupported tag <{}>".format(tag))
+        self.stack.append(tag)
+
+    def handle_endtag(self, tag):
+        if not self.stack or self.stack[-1] != tag:
+            self.errors.append("misnested </{}>".format(tag))
+        else:
+            self.stack.pop()
+
+    def check(self, text):
+        self.feed(text)
+        self.close()
+        if self.stack:
+            self.errors.append("unclosed {}".format(self.stack))
+        return self.errors
+
+
+def random_markdown(rng, lines, fence_every=4):
+    """
+    Function to generate a random markdown document.
+    """
+    out = []
+    for n in range(lines):
+        if n % fence_every == 0:
+            out.append("```" + rng.choice(["python", "js", "", "bash"]))
+            out.append("def f(x): return x < 1 and '<b>' or \"*\"")
+            out.append("```")
+            continue
+        words = [rng.choice(PIECES) for _ in range(rng.randint(1, 12))]
+        out.append(rng.choice(LINE_STARTS) + " ".join(words))
+    # Sometimes leave a code block open
+    if rng.random() < 0.2:
+        out.append("```python\nunterminated")
+    return "\n".join(out)
+
+
+def legacy_format_text_to_html(text):
+    """
+    Function with the previous implementation of format_text_to_html, for comparison.
+    """
+    class MyHTMLParser(HTMLParser):
+        def __init__(self):
+            super().__init__()
+            self.stack = []
+
+        def handle_starttag(self, tag, attrs):
+            self.stack.append(tag)
+
+        def handle_endtag(self, tag):
+            if self.stack and self.stack[-1] == tag:
+                self.stack.pop()
+
+    text = re.sub(r'\*\*(.*?)\*\*', r'<b>\1</b>', text)
+    text = re.sub(r'\*(.*?)\*', r'<i>\1</i>', text)
+    text = re.sub(r'^\*(.*)$', r'⚪ \1', text, flags=re.MULTILINE)
+    text = re.sub(r'^#{2,}(.*)$', lambda m: '{}'.format(m.group(1).strip().upper()), text, flags=re.MULTILINE)
+    text = re.sub(r'^#(.*)$', lambda m: '<b>{}</b>'.format(m.group(1).strip().upper()), text, flags=re.MULTILINE)
+    language_tags = {
+        'python': '<pre language="python">',
+        'javascript': '<pre language="javascript">',
+        'java': '<pre language="java">',
+    }
+    end_tag = '</pre>'
+    while '```' in text:
+        match = re.search(r'```(\w+)', text)
+        if match:
+            language = match.group(1)
+            if language in language_tags:
+                text = text.replace("```" + language, language_tags[language], 1)
+                text = text.replace("```", end_tag, 1)
+            else:
+                text = text.replace("```" + language, '<code>', 1)
+                text = text.replace("```", '</code>', 1)
+        else:
+            text = text.replace("```", '<code>', 1)
+            text = text.replace("```", '</code>', 1)
+    text = re.sub(r'\[(.*?)\]\((.*?)\)', r'<a href="\2">\1</a>', text)
+    parser = MyHTMLParser()
+    parser.feed(text)
+    if parser.stack:
+        for tag in parser.stack:
+            text = re.sub(r'<{}[^>]*>'.format(tag), '', text)
+    text = re.sub(r'[^\x00-\x7F]+', '', text)
+    return text
+
+
+def fuzz(rng, cases):
+    """
+    Function to check the renderer on random documents.
+
+    Returns:
+    tuple: The number of invalid renderings of the new and of the previous implementation.
+    """
+    failures = 0
+    legacy_failures = 0
+    for case in range(cases):
+        text = random_markdown(rng, rng.randint(1, 30))
+        errors = TelegramHTMLChecker().check(format_text_to_html(text))
+        if errors:
+            failures += 1
+            if failures <= 3:
+                print("case {}: {}\n{!r}".format(case, errors[:3], text[:300]))
+        if TelegramHTMLChecker().check(legacy_format_text_to_html(text)):
+            legacy_failures += 1
+    return failures, legacy_failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cases", type=int, default=2000)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 5000])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    failures, legacy_failures = fuzz(rng, args.cases)
+    print("invalid renderings: {} of {} (previous implementation: {})\n".format(failures, args.cases,
+                                                                               legacy_failures))
+
+    print("{:>12} {:>12} {:>14} {:>14}".format("code blocks", "chars", "renderer (ms)", "previous (ms)"))
+    for size in args.sizes:
+        text = random_markdown(rng, size * 4)
+        timings = []
+        for render in (format_text_to_html, legacy_format_text_to_html):
+            start = time.perf_counter()
+            render(text)
+            timings.append((time.perf_counter() - start) * 1000)
+        print("{:>12} {:>12} {:>14.1f} {:>14.1f}".format(size, len(text), *timings))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+"""
+Load test for the Telegram handlers.
+
+Replays text updates with a link through main.note_from_text, the job the scheduler
+runs for main.echo, with increasing numbers of workers.
+Page fetches and Notion requests go through the real async HTTP client to a local
+server that answers after a fixed delay, and the Gemini call is replaced by a
+stand-in with the same delay, so no network access or API keys are needed.
+
+Usage:
+python bench/load_handlers.py --updates 100 --latency 0.2
+"""
+import os
+import sys
+import time
+import json
+import asyncio
+import tempfile
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Dummy credentials, the real services are never contacted
+os.environ.setdefault("NOTION_API", "bench")
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+os.environ.setdefault("GOOGLE_API_KEY", "bench")
+
+# Keep the caches and the Notion queue out of the working tree. Every link is
+# served by the same local host, and the local Notion stand-in takes as many
+# requests as the handlers produce, so lift the per-host and rate limits.
+os.environ.setdefault("CACHE_DIR", tempfile.mkdtemp(prefix="notes-bench-"))
+os.environ.setdefault("FETCH_MAX_PER_HOST", "1000")
+os.environ.setdefault("NOTION_RATE_LIMIT", "10000")
+os.environ.setdefault("NOTION_MAX_IN_FLIGHT", "100")
+
+PAGE = b"""<html><head>
+<meta name="description" content="Bench page">
+<meta property="og:image" content="http://localhost/image.png">
+</head><body><article><p>Some text worth saving.</p><p>And some more of it.</p></article></body></html>"""
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+    """
+    Request handler that answers every request after a fixed delay.
+    """
+    latency = 0.0
+    protocol_version = "HTTP/1.1"
+
+    def reply(self, body, content_type):
+        time.sleep(self.latency)
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.reply(PAGE, "text/html")
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.reply(json.dumps({"object": "page", "id": "bench"}).encode(), "application/json")
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeMessage:
+    """
+    Stand-in for the parts of telegram.Message used by the handlers.
+    """
+    def __init__(self, chat_id, message_id, text=""):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.text = text
+        self.chat = self
+
+    async def reply_text(self, text, **kwargs):
+        return FakeMessage(self.chat_id, self.message_id + 1)
+
+    async def send_action(self, action):
+        pass
+
+
+class FakeUpdate:
+    """
+    Stand-in for telegram.Update.
+    """
+    def __init__(self, message):
+        self.message = message
+
+
+class FakeBot:
+    """
+    Stand-in for telegram.Bot that counts edited replies.
+    """
+    def __init__(self):
+        self.edits = 0
+
+    async def edit_message_text(self, text, **kwargs):
+        self.edits += 1
+
+
+class FakeContext:
+    """
+    Stand-in for telegram.ext.CallbackContext.
+    """
+    def __init__(self, bot):
+        self.bot = bot
+
+
+async def run(handler, updates, concurrency, base_url):
+    """
+    Function to replay updates through a handler with bounded concurrency.
+
+    Parameters:
+    handler (coroutine function): The note processing function to call.
+    updates (int): The number of updates to replay.
+    concurrency (int): The maximum number of updates in flight.
+    base_url (str): The URL of the local server.
+
+    Returns:
+    float: The number of updates processed per second.
+    """
+    from main import notify_page_created
+    from utils.http_client import close_http_client
+    from utils.notion_api import get_notion_writer
+
+    bot = FakeBot()
+    context = FakeContext(bot)
+    semaphore = asyncio.Semaphore(concurrency)
+    writer = get_notion_writer()
+    writer.listeners = [lambda meta, page, error: notify_page_created(bot, meta, page, error)]
+    await writer.start()
+
+    async def one(i):
+        async with semaphore:
+            # A new link for every update, so the page cache does not kick in
+            message = FakeMessage(i, 1, "Read this {}/article/{}/{}".format(base_url, concurrency, i))
+            placeholder_message = await message.reply_text("...")
+            await handler(FakeUpdate(message), context, placeholder_message)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(updates)))
+    # Wait until every page is written and its reply updated
+    while bot.edits < 2 * updates:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    await writer.stop()
+    await close_http_client()
+    return updates / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 5, 10, 25, 50])
+    args = parser.parse_args()
+
+    SlowHandler.latency = args.latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SlowHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = "http://127.0.0.1:{}".format(server.server_address[1])
+    os.environ["NOTION_API_URL"] = base_url
+
+    import main as bot
+    import utils.notion_api
+
+    async def fake_gemini(prompt, **kwargs):
+        await asyncio.sleep(args.latency)
+        return '{"summary": "A page", "tags": "bench"}'
+
+    utils.notion_api.handle_gemini_model = fake_gemini
+
+    print("{:>12} {:>14}".format("workers", "updates/sec"))
+    for concurrency in args.concurrency:
+        throughput = asyncio.run(run(bot.note_from_text, args.updates, concurrency, base_url))
+        print("{:>12} {:>14.1f}".format(concurrency, throughput))
+    server.shutdown()
+
+    # Where the time of the last run went, as the metrics endpoint reports it
+    from utils.metrics import get_metrics
+    print("\n{:<16} {:>7} {:>8} {:>8} {:>8} {:>7}".format("stage", "count", "p50 ms", "p95 ms", "p99 ms", "errors"))
+    for stage, stats in sorted(get_metrics().snapshot()["stages"].items()):
+        print("{:<16} {:>7} {:>8.1f} {:>8.1f} {:>8.1f} {:>7}".format(stage, stats["count"], stats["p50_ms"] or 0,
+                                                                     stats["p95_ms"] or 0, stats["p99_ms"] or 0,
+                                                                     stats["errors"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""
+Micro-benchmark of the per-message setup cost of the model objects.
+
+Compares building the Gemini model, chat session and LangChain objects on every call,
+as the handlers used to, with fetching the shared objects from the registry. No
+requests are sent, so only the local overhead is measured.
+
+Usage:
+python bench/model_setup.py --calls 2000
+"""
+import os
+import sys
+import timeit
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Dummy credentials, the real services are never contacted
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+os.environ.setdefault("GOOGLE_API_KEY", "bench")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=2000)
+    args = parser.parse_args()
+
+    import google.generativeai as genai
+    from langchain.chains import LLMChain
+    from langchain.memory import ConversationBufferMemory
+    from langchain_openai import ChatOpenAI
+
+    from utils import gemini_api, openai_api
+
+    def gemini_per_call():
+        model = genai.GenerativeModel(gemini_api.TEXT_MODEL, generation_config=gemini_api.generation_config)
+        model.start_chat(history=[])
+
+    def gemini_shared():
+        gemini_api.get_gemini_model(gemini_api.TEXT_MODEL)
+
+    prompt_template = openai_api.get_openai_chain("gpt-3.5-turbo").prompt
+
+    def openai_per_call():
+        llm = ChatOpenAI(temperature=.0, model_name="gpt-3.5-turbo", openai_api_key="bench")
+        memory = ConversationBufferMemory(memory_key="chat_history")
+        LLMChain(llm=llm, prompt=prompt_template, memory=memory)
+
+    def openai_shared():
+        openai_api.get_openai_chain("gpt-3.5-turbo")
+        ConversationBufferMemory(memory_key="chat_history")
+
+    print("{:<10} {:>16} {:>16}".format("provider", "per call (us)", "shared (us)"))
+    for name, before, after in (("gemini", gemini_per_call, gemini_shared),
+                                ("openai", openai_per_call, openai_shared)):
+        before_us = timeit.timeit(before, number=args.calls) / args.calls * 1e6
+        after_us = timeit.timeit(after, number=args.calls) / args.calls * 1e6
+        print("{:<10} {:>16.1f} {:>16.1f}".format(name, before_us, after_us))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Benchmark of the related notes index.
+
+Fills a fresh index with synthetic notes embedded as hashed n-grams, then
+measures indexing throughput, the latency of single and batched top-k searches
+and the memory the process uses. The memory-mapped int8 index is compared with
+scoring the same vectors as one float32 matrix held in memory.
+
+Usage:
+python bench/related_index.py --notes 200000 --queries 200
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import resource
+import itertools
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.related import HashedEmbedder, VectorIndex, RELATED_DIMENSIONS
+
+
+def make_vocabulary(rng, size):
+    """
+    Function to generate random pronounceable words.
+    """
+    syllables = ["ka", "lo", "mi", "ra", "te", "su", "vo", "ne", "pi", "da", "zu", "ho", "ge", "fa", "wi"]
+    return ["".join(rng.choice(syllables) for _ in range(rng.randint(2, 4))) for _ in range(size)]
+
+
+def percentiles(timings):
+    """
+    Function to get the p50, p95 and p99 of timings in milliseconds.
+    """
+    timings = sorted(timings)
+    return [timings[min(len(timings) - 1, int(len(timings) * q))] * 1000 for q in (0.5, 0.95, 0.99)]
+
+
+def max_rss_mb():
+    """
+    Function to get the peak resident memory of the process in MB.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--notes", type=int, default=200000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--batch", type=int, default=32, help="Number of queries searched together.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    words = make_vocabulary(rng, 20000)
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(words))))
+
+    def text():
+        return " ".join(rng.choices(words, cum_weights=cum_weights, k=rng.randint(30, 80)))
+
+    index = VectorIndex(tempfile.mkdtemp(prefix="notes-related-"), HashedEmbedder(RELATED_DIMENSIONS))
+    start = time.perf_counter()
+    for first in range(0, args.notes, 1000):
+        batch = [("page-{}".format(n), "https://www.notion.so/page-{}".format(n), "note {}".format(n), text())
+                 for n in range(first, min(args.notes, first + 1000))]
+        index.add(batch)
+    elapsed = time.perf_counter() - start
+    print("indexing: {} notes in {:.1f}s ({:.0f} notes/sec), {:.1f} MB of vectors, peak RSS {:.0f} MB".format(
+        args.notes, elapsed, args.notes / elapsed, os.path.getsize(index.path) / 1e6, max_rss_mb()))
+
+    queries = index.embedder.embed([text() for _ in range(args.queries)])
+    timings = []
+    for query in queries:
+        start = time.perf_counter()
+        index.search(query[None, :], 10)
+        timings.append(time.perf_counter() - start)
+    print("single search: p50 {:.1f} ms, p95 {:.1f} ms, p99 {:.1f} ms, peak RSS {:.0f} MB".format(
+        *percentiles(timings), max_rss_mb()))
+
+    start = time.perf_counter()
+    for first in range(0, len(queries), args.batch):
+        index.search(queries[first:first + args.batch], 10)
+    per_query = (time.perf_counter() - start) / len(queries) * 1000
+    print("batched search ({} at a time): {:.2f} ms per query, peak RSS {:.0f} MB".format(
+        args.batch, per_query, max_rss_mb()))
+
+    # The same vectors as one float32 matrix in memory, the simple alternative
+    rows = index.rows()
+    matrix = rows["vector"].astype(np.float32) * rows["scale"][:, None]
+    timings = []
+    for query in queries:
+        start = time.perf_counter()
+        scores = matrix @ query
+        np.argsort(-scores)[:10]
+        timings.append(time.perf_counter() - start)
+    print("in-memory float32 with full sort: p50 {:.1f} ms, p95 {:.1f} ms, peak RSS {:.0f} MB".format(
+        *percentiles(timings)[:2], max_rss_mb()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+Benchmark of the model provider router against local fake providers.
+
+Two fake providers answer after a log-normal latency: the preferred one with
+a slow tail, the fallback somewhat slower but steadier. Calls arrive at a fixed
+rate through three phases: normal, an outage of the preferred provider (every
+call fails) and recovery. Each strategy runs the same calls:
+
+- primary: the preferred provider only, as before the router
+- fallback: the next provider is asked when the preferred one fails
+- hedge: also asks the next provider when the preferred one is slower than its p95
+
+The report has the latency quantiles, the share of failed calls and the share
+of extra calls sent to the fallback.
+
+Usage:
+python bench/router.py --calls 2000 --rate 200
+python bench/router.py --outage 0 --slow 0.1
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import logging
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.router import Provider, ProviderRouter, CircuitBreaker
+
+
+class FakeProvider:
+    """
+    A provider that answers after a random latency, with a share of slow calls and an outage window.
+    """
+    def __init__(self, name, median, sigma, slow=0.0, slow_factor=10.0, outage=None, seed=0):
+        self.name = name
+        self.median = median
+        self.sigma = sigma
+        self.slow = slow
+        self.slow_factor = slow_factor
+        self.outage = outage
+        self.rng = random.Random(seed)
+        self.calls = 0
+        self.started = None
+
+    async def generate(self, prompt, json_mode=False):
+        self.calls += 1
+        elapsed = time.monotonic() - self.started
+        if self.outage is not None and self.outage[0] <= elapsed < self.outage[1]:
+            # An outage answers fast with an error, like a 503
+            await asyncio.sleep(self.median / 10)
+            raise RuntimeError("{} is unavailable".format(self.name))
+        latency = self.median * self.rng.lognormvariate(0, self.sigma)
+        if self.rng.random() < self.slow:
+            latency *= self.slow_factor
+        await asyncio.sleep(latency)
+        return "{} answer".format(self.name)
+
+
+def percentiles(timings):
+    """
+    Function to get the p50, p95 and p99 of timings in milliseconds.
+    """
+    timings = sorted(timings)
+    return [timings[min(len(timings) - 1, int(len(timings) * q))] * 1000 for q in (0.5, 0.95, 0.99)]
+
+
+async def run(strategy, args):
+    """
+    Function to send the calls through a router set up for a strategy.
+
+    Returns:
+    tuple: The latencies of the answered calls, the number of failed calls and the calls to each fake provider.
+    """
+    duration = args.calls / args.rate
+    outage = (duration / 3, duration / 3 + args.outage) if args.outage else None
+    primary = FakeProvider("primary", args.median, 0.3, slow=args.slow, outage=outage, seed=args.seed)
+    secondary = FakeProvider("secondary", args.median * 1.5, 0.2, seed=args.seed + 1)
+    providers = [Provider("primary", {"text": primary.generate},
+                          CircuitBreaker("primary", cooldown=args.cooldown))]
+    if strategy != "primary":
+        providers.append(Provider("secondary", {"text": secondary.generate},
+                                  CircuitBreaker("secondary", cooldown=args.cooldown)))
+    router = ProviderRouter(providers, timeout=args.timeout, hedge=strategy == "hedge",
+                            hedge_delay=args.median * 4)
+
+    latencies = []
+    failures = 0
+
+    async def one(n):
+        nonlocal failures
+        start = time.monotonic()
+        try:
+            await router.call("text", "prompt {}".format(n), False)
+        except Exception:
+            failures += 1
+            return
+        latencies.append(time.monotonic() - start)
+
+    primary.started = secondary.started = time.monotonic()
+    tasks = []
+    for n in range(args.calls):
+        tasks.append(asyncio.create_task(one(n)))
+        await asyncio.sleep(1 / args.rate)
+    await asyncio.gather(*tasks)
+    return latencies, failures, primary.calls, secondary.calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=2000)
+    parser.add_argument("--rate", type=float, default=200, help="Calls per second.")
+    parser.add_argument("--median", type=float, default=0.05, help="Median seconds of the preferred provider.")
+    parser.add_argument("--slow", type=float, default=0.03, help="Share of calls ten times slower than usual.")
+    parser.add_argument("--outage", type=float, default=2.0, help="Seconds the preferred provider fails, 0 for none.")
+    parser.add_argument("--cooldown", type=float, default=0.5, help="Seconds an open breaker waits.")
+    parser.add_argument("--timeout", type=float, default=5.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    # The errors of the outage are expected, only the report is of interest
+    logging.disable(logging.ERROR)
+
+    print("{:<9} {:>8} {:>8} {:>8} {:>8} {:>8}".format("strategy", "p50 ms", "p95 ms", "p99 ms", "failed", "extra"))
+    for strategy in ("primary", "fallback", "hedge"):
+        latencies, failures, primary_calls, secondary_calls = asyncio.run(run(strategy, args))
+        p50, p95, p99 = percentiles(latencies) if latencies else (0, 0, 0)
+        print("{:<9} {:>8.0f} {:>8.0f} {:>8.0f} {:>7.1f}% {:>7.1f}%".format(
+            strategy, p50, p95, p99, failures / args.calls * 100,
+            (primary_calls + secondary_calls - args.calls) / args.calls * 100))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Benchmark of the full-text search index.
+
+Fills a fresh index with synthetic notes (titles, summaries and tags drawn from a
+Zipf-like vocabulary), then measures bulk loading, single inserts as the writer
+makes them, and the latency of typical searches: one word, two words, a word
+prefix and a tag. A LIKE scan over the same table is timed for comparison.
+
+Usage:
+python bench/search_index.py --notes 100000 --queries 500
+"""
+import os
+import sys
+import time
+import random
+import itertools
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.search import SearchIndex
+
+
+def make_vocabulary(rng, size):
+    """
+    Function to generate random pronounceable words.
+    """
+    syllables = ["ka", "lo", "mi", "ra", "te", "su", "vo", "ne", "pi", "da", "zu", "ho", "ge", "fa", "wi"]
+    return ["".join(rng.choice(syllables) for _ in range(rng.randint(2, 4))) for _ in range(size)]
+
+
+def make_note(rng, number, words, cum_weights, tags):
+    """
+    Function to generate one note in the form stored by the index.
+    """
+    def text(count):
+        return " ".join(rng.choices(words, cum_weights=cum_weights, k=count))
+
+    return ("page-{}".format(number), "https://www.notion.so/page-{}".format(number), text(rng.randint(3, 12)),
+            text(rng.randint(30, 80)), ", ".join(rng.sample(tags, 3)),
+            "https://example.com/{}".format(number), "2024-01-01T00:00:00.000Z")
+
+
+def percentiles(timings):
+    """
+    Function to get the p50, p95 and p99 of timings in milliseconds.
+    """
+    timings = sorted(timings)
+    return [timings[min(len(timings) - 1, int(len(timings) * q))] * 1000 for q in (0.5, 0.95, 0.99)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--notes", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--vocabulary", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    words = make_vocabulary(rng, args.vocabulary)
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(words))))
+    tags = words[:300]
+
+    directory = tempfile.mkdtemp(prefix="notes-search-")
+    index = SearchIndex(os.path.join(directory, "search.sqlite"))
+
+    notes = [make_note(rng, n, words, cum_weights, tags) for n in range(args.notes)]
+    start = time.perf_counter()
+    for first in range(0, args.notes, 1000):
+        index.add(notes[first:first + 1000])
+    elapsed = time.perf_counter() - start
+    print("bulk load: {} notes in {:.1f}s ({:.0f} notes/sec), {:.1f} MB".format(
+        args.notes, elapsed, args.notes / elapsed, os.path.getsize(index.db.execute("PRAGMA database_list")
+                                                                  .fetchone()[2]) / 1e6))
+
+    timings = []
+    for n in range(args.notes, args.notes + 200):
+        note = make_note(rng, n, words, cum_weights, tags)
+        start = time.perf_counter()
+        index.add([note])
+        timings.append(time.perf_counter() - start)
+    print("single insert: p50 {:.2f} ms, p95 {:.2f} ms, p99 {:.2f} ms\n".format(*percentiles(timings)))
+
+    # Searches pick words the way users would, mostly fairly common ones
+    searchable = words[20:2000]
+    kinds = {
+        "one word": lambda: rng.choice(searchable),
+        "two words": lambda: "{} {}".format(rng.choice(searchable), rng.choice(searchable)),
+        "prefix": lambda: rng.choice(searchable)[:4] + "*",
+        "tag": lambda: "#" + rng.choice(tags),
+    }
+    print("{:<10} {:>9} {:>9} {:>9} {:>14}".format("query", "p50 ms", "p95 ms", "p99 ms", "LIKE scan ms"))
+    for name, make_query in kinds.items():
+        timings = []
+        for _ in range(args.queries):
+            query = make_query()
+            start = time.perf_counter()
+            index.search(query)
+            timings.append(time.perf_counter() - start)
+
+        # The scan is slow, a few runs are enough
+        scan = []
+        for _ in range(5):
+            term = "%{}%".format(make_query().lstrip("#").split()[0].rstrip("*"))
+            start = time.perf_counter()
+            # Ranking needs every match, so the scan reads the whole table
+            index.db.execute("SELECT COUNT(*) FROM notes WHERE title LIKE ? OR summary LIKE ? OR tags LIKE ?",
+                             (term, term, term)).fetchone()
+            scan.append(time.perf_counter() - start)
+        print("{:<10} {:>9.2f} {:>9.2f} {:>9.2f} {:>14.2f}".format(name, *percentiles(timings),
+                                                                    sum(scan) / len(scan) * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""
+Benchmark of the cold start of the bot process.
+
+Starts fresh interpreters and measures how long it takes until the bot could
+receive updates: importing main, building the application and running its
+startup (queues, indexes, workers), without contacting Telegram. Then it
+measures the background warm-up that loads the SDKs. --eager loads them before
+the bot is ready, as it did before they were imported lazily.
+
+A second run with -X importtime lists the modules that take longest to import
+under main. The exit code is 1 if the median time to ready is over --budget.
+
+Usage:
+python bench/startup.py --runs 5 --budget 0.8
+python bench/startup.py --eager
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in the fresh interpreter, prints the time of each phase as JSON
+CHILD = """
+import sys, time, json, asyncio
+start = time.perf_counter()
+sys.path.insert(0, {root!r})
+import main
+from telegram.ext import ApplicationBuilder
+from utils.lazy import load_lazy_modules
+imported = time.perf_counter()
+
+async def run():
+    application = main.build_application(ApplicationBuilder().token("123456:bench"))
+    built = time.perf_counter()
+    if {eager!r}:
+        load_lazy_modules()
+    await main.startup(application)
+    ready = time.perf_counter()
+    print(json.dumps({{"ready": True}}), flush=True)
+    await application.bot_data["warm_up"]
+    warm = time.perf_counter()
+    await main.shutdown(application)
+    print(json.dumps({{"import": imported - start, "build": built - imported, "startup": ready - built,
+                      "warm_up": warm - ready}}), flush=True)
+
+asyncio.run(run())
+"""
+
+
+def child_env(cache_dir):
+    """
+    Function to get the environment of a child: dummy credentials, a fresh cache and no metrics server.
+    """
+    env = dict(os.environ)
+    for name in ("NOTION_API", "NOTION_DATABASE_ID", "GOOGLE_API_KEY", "OPENAI_API_KEY"):
+        env.setdefault(name, "bench")
+    env.update({"CACHE_DIR": cache_dir, "METRICS_PORT": "0", "LOG_LEVEL": "WARNING"})
+    return env
+
+
+def measure(args):
+    """
+    Function to start the bot once in a fresh interpreter.
+
+    Returns:
+    dict: The seconds until the bot was ready, seen from outside, and of each phase inside.
+    """
+    code = CHILD.format(root=ROOT, eager=args.eager)
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-c", code], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                               env=child_env(tempfile.mkdtemp(prefix="notes-startup-")), cwd=ROOT, text=True)
+    ready = None
+    phases = {}
+    for line in process.stdout:
+        data = json.loads(line)
+        if data.get("ready"):
+            ready = time.perf_counter() - start
+        else:
+            phases = data
+    if process.wait() != 0 or ready is None:
+        raise SystemExit("The bot did not start, run the child code by hand to see why")
+    return dict(phases, ready=ready)
+
+
+def slowest_imports(args):
+    """
+    Function to get the modules that take longest to import under main, with -X importtime.
+
+    Returns:
+    list: Pairs of module name and cumulative seconds, slowest first.
+    """
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], capture_output=True,
+                             text=True, env=child_env(tempfile.mkdtemp(prefix="notes-startup-")), cwd=ROOT)
+    modules = []
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        # Modules imported by main directly are indented by three spaces
+        if cumulative.strip().isdigit() and name.startswith("   ") and not name.startswith("    "):
+            modules.append((name.strip(), int(cumulative) / 1e6))
+    return sorted(modules, key=lambda module: -module[1])[:args.top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=0.8, help="Most seconds the median start may take.")
+    parser.add_argument("--eager", action="store_true", help="Load the SDKs before the bot is ready.")
+    parser.add_argument("--top", type=int, default=10, help="Number of slowest imports listed.")
+    args = parser.parse_args()
+
+    runs = [measure(args) for _ in range(args.runs)]
+    print("{:<10} {:>9} {:>9} {:>9}".format("phase", "median ms", "min ms", "max ms"))
+    for phase in ("import", "build", "startup", "ready", "warm_up"):
+        values = [run[phase] * 1000 for run in runs]
+        print("{:<10} {:>9.0f} {:>9.0f} {:>9.0f}".format(phase, statistics.median(values), min(values), max(values)))
+
+    print("\n{:<28} {:>9}".format("imported by main", "ms"))
+    for name, seconds in slowest_imports(args):
+        print("{:<28} {:>9.1f}".format(name, seconds * 1000))
+
+    ready = statistics.median(run["ready"] for run in runs)
+    print("\nready in {:.0f} ms, budget {:.0f} ms: {}".format(ready * 1000, args.budget * 1000,
+                                                          "ok" if ready <= args.budget else "over budget"))
+    sys.exit(0 if ready <= args.budget else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,224 @@
-import http.server
-import socketserver
 import os
+import email.utils
+import http.server
+import argparse
+from functools import partial
 
-if __name__ == "__main__":
-    # Define the directory you want to serve files from
-    directory_to_serve = 'files'
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Stored files never change once written, so clients may cache them for long
+FILESERVER_MAX_AGE = int(os.getenv("FILESERVER_MAX_AGE", 7 * 24 * 3600))
+
+# Largest chunk handed to sendfile at once
+SENDFILE_CHUNK = 1024 * 1024
+
+
+class FileHandler(http.server.SimpleHTTPRequestHandler):
+    """
+    Request handler for the stored files.
+
+    Adds to SimpleHTTPRequestHandler: keep-alive connections, ETag/Last-Modified
+    validation, Cache-Control, single byte ranges and zero-copy transfers with
+    os.sendfile. Directory listings are handled by the base class.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def send_head(self):
+        """
+        Method to send the status and headers of a GET or HEAD request.
+
+        Returns:
+        file: The open file to send, or None if there is no body to send.
+        """
+        self.range = None
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            return super().send_head()
+        if path.endswith("/"):
+            self.send_error(404, "File not found")
+            return None
+        try:
+            f = open(path, "rb")
+        except OSError:
+            self.send_error(404, "File not found")
+            return None
+
+        try:
+            stat = os.fstat(f.fileno())
+            size = stat.st_size
+            etag = '"{:x}-{:x}"'.format(stat.st_mtime_ns, size)
+            last_modified = email.utils.formatdate(stat.st_mtime, usegmt=True)
+
+            # Answer conditional requests without a body
+            if self.is_not_modified(etag, stat.st_mtime):
+                self.send_response(304)
+                self.send_validators(etag, last_modified)
+                self.end_headers()
+                f.close()
+                return None
+
+            byte_range = self.parse_range(size, etag)
+            if byte_range is False:
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */{}".format(size))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                f.close()
+                return None
 
-    # Change the current working directory to the directory you want to serve files from
-    os.chdir(directory_to_serve)
+            if byte_range is None:
+                self.send_response(200)
+                self.range = (0, size)
+            else:
+                start, end = byte_range
+                self.send_response(206)
+                self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end - 1, size))
+                self.range = byte_range
+            self.send_header("Content-Type", self.guess_type(path))
+            self.send_header("Content-Length", str(self.range[1] - self.range[0]))
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_validators(etag, last_modified)
+            self.end_headers()
+            return f
+        except Exception:
+            f.close()
+            raise
 
-    # Create a Handler object using http.server.SimpleHTTPRequestHandler
-    Handler = http.server.SimpleHTTPRequestHandler
+    def send_validators(self, etag, last_modified):
+        """
+        Method to send the caching headers of a file.
+        """
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        self.send_header("Cache-Control", "public, max-age={}".format(FILESERVER_MAX_AGE))
 
-    # Define the server address and port
-    server_address = ('', 8009)  # Serve on all addresses, port
+    def is_not_modified(self, etag, mtime):
+        """
+        Method to check whether the client already has the current version of a file.
+
+        Returns:
+        bool: Whether a 304 response can be sent.
+        """
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            return if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since is not None:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return int(mtime) <= since
+        return False
+
+    def parse_range(self, size, etag):
+        """
+        Method to parse the Range header of the request. Only single byte ranges are served,
+        other requests get the whole file.
+
+        Returns:
+        tuple: The start and the end (exclusive) of the range, None to send the whole file,
+        or False if the range cannot be satisfied.
+        """
+        header = self.headers.get("Range")
+        if header is None or not header.startswith("bytes=") or "," in header:
+            return None
+        # A range of an outdated version is answered with the whole file
+        if_range = self.headers.get("If-Range")
+        if if_range is not None and if_range.strip() != etag:
+            return None
+
+        first, _, last = header[len("bytes="):].strip().partition("-")
+        try:
+            if first == "":
+                start, end = max(0, size - int(last)), size
+            else:
+                start = int(first)
+                end = min(size, int(last) + 1) if last else size
+        except ValueError:
+            return None
+        if start >= size or start >= end:
+            return False
+        return start, end
+
+    def copyfile(self, source, outputfile):
+        """
+        Method to send the requested range of a file, with sendfile when the platform supports it.
+        """
+        # Directory listings are built in memory by the base class
+        if self.range is None:
+            return super().copyfile(source, outputfile)
+        start, end = self.range
+        if hasattr(os, "sendfile"):
+            offset = start
+            while offset < end:
+                sent = os.sendfile(self.connection.fileno(), source.fileno(), offset, min(SENDFILE_CHUNK, end - offset))
+                if sent == 0:
+                    break
+                offset += sent
+            return
+        source.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = source.read(min(SENDFILE_CHUNK, remaining))
+            if not chunk:
+                break
+            outputfile.write(chunk)
+            remaining -= len(chunk)
+
+    def do_GET(self):
+        """
+        Method to serve a GET request.
+        """
+        f = self.send_head()
+        if f:
+            try:
+                # Flush the headers before writing to the socket directly
+                self.wfile.flush()
+                self.copyfile(f, self.wfile)
+            finally:
+                f.close()
+
+    def log_message(self, format, *args):
+        """
+        Method to log requests, only if verbose logging is enabled.
+        """
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def create_server(directory, port, verbose=False):
+    """
+    Function to create a threaded file server.
+
+    Parameters:
+    directory (str): The directory to serve files from.
+    port (int): The port to listen on.
+    verbose (bool, optional): Whether to log every request. Defaults to False.
+
+    Returns:
+    ThreadingHTTPServer: The server, ready to serve_forever.
+    """
+    handler = partial(FileHandler, directory=directory)
+    httpd = http.server.ThreadingHTTPServer(('', port), handler)
+    httpd.daemon_threads = True
+    httpd.verbose = verbose
+    return httpd
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the stored images to Notion.")
+    parser.add_argument("--directory", default="files", help="The directory to serve files from.")
+    parser.add_argument("--port", type=int, default=8009, help="The port to listen on.")
+    parser.add_argument("--verbose", action="store_true", help="Log every request.")
+    args = parser.parse_args()
 
-    # Create a TCPServer object
-    httpd = socketserver.TCPServer(server_address, Handler)
+    # Create a threaded server, one thread per connection
+    httpd = create_server(args.directory, args.port, args.verbose)
 
     # Start the server
-    print(f"Serving files from the directory {directory_to_serve} at http://localhost:8009")
-    httpd.serve_forever()
\ No newline at end of file
+    print(f"Serving files from the directory {args.directory} at http://localhost:{args.port}")
+    httpd.serve_forever()
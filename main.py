@@ -1,9 +1,9 @@
 import os
 import io
-
-import aiofiles
-
-from PIL import Image
+import html
+import asyncio
+import argparse
+from functools import partial
 
 from telegram import Update
 from telegram.constants import ParseMode
@@ -11,11 +11,23 @@ from telegram.ext import filters, CommandHandler, MessageHandler, CallbackContex
 
 from dotenv import load_dotenv
 
-from utils.gemini_api import handle_gemini_image
-from utils.helpers import format_text_to_html, find_links_in_text, get_main_text_from_url
-from utils.messages import WELCOME_MESSAGE, HELP_MESSAGE
-from utils.notion_api import add_notion_page
-from utils.openai_api import handle_transcribe_openai
+from utils.audio import transcribe_voice
+from utils.conversation import close_conversation_store
+from utils.dedup import get_dedup_index, note_keys
+from utils.gemini_api import handle_gemini_image, get_gemini_model, get_model_router, get_llm_cache, TEXT_MODEL, \
+    VISION_MODEL
+from utils.helpers import format_text_to_html, find_links_in_text, fetch_pages, get_page_cache
+from utils.http_client import close_http_client
+from utils.images import process_image, image_hash
+from utils.lazy import warm_up
+from utils.metrics import trace, timed, get_metrics, configure_logging, start_metrics_server, METRICS_PORT
+from utils.messages import WELCOME_MESSAGE, HELP_MESSAGE, SAVING_MESSAGE, SAVED_MESSAGE, QUEUED_MESSAGE, BUSY_MESSAGE, \
+    DUPLICATE_MESSAGE, DUPLICATE_PENDING_MESSAGE, SEARCH_USAGE_MESSAGE, SEARCH_EMPTY_MESSAGE, RELATED_MESSAGE, \
+    RELATED_USAGE_MESSAGE, RELATED_EMPTY_MESSAGE, RELATED_UNAVAILABLE_MESSAGE
+from utils.notion_api import prepare_notion_page, get_notion_writer
+from utils.related import get_related_index, record_related_page, note_text
+from utils.scheduler import get_scheduler, SchedulerFull
+from utils.search import get_search_index
 
 # Load environment variables from .env file
 load_dotenv()
@@ -49,29 +61,250 @@ async def send_help(update: Update, context: CallbackContext):
     await update.message.reply_text(HELP_MESSAGE, parse_mode=ParseMode.HTML)
 
 
-async def handle_image(update: Update, context: CallbackContext):
+async def search(update: Update, context: CallbackContext):
     """
-    Function to handle the image message.
+    Function to handle the search command, replying with the best matching notes.
 
     Parameters:
     update (Update): The update object that contains the status update.
     context (CallbackContext): The context object that contains the current context of the update.
     """
-    placeholder_message = await update.message.reply_text("...")
-    await update.message.chat.send_action(action="typing")
-    image_file = await context.bot.getFile(update.message.photo[-1].file_id)
-    image_data = await image_file.download_as_bytearray()
+    query = " ".join(context.args)
+    if not query.strip():
+        await update.message.reply_text(SEARCH_USAGE_MESSAGE)
+        return
+
+    results = await asyncio.to_thread(get_search_index().search, query)
+    if not results:
+        await update.message.reply_text(SEARCH_EMPTY_MESSAGE)
+        return
+
+    lines = []
+    for url, title, tags in results:
+        title = title if len(title) <= 80 else title[:80] + "..."
+        line = '<a href="{}">{}</a>'.format(html.escape(url), html.escape(title or url))
+        if tags:
+            line += " <i>{}</i>".format(html.escape(tags))
+        lines.append(line)
+    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+
+
+def format_related(notes):
+    """
+    Function to list related notes as markdown links.
+
+    Parameters:
+    notes (list): Tuples of link, title and similarity of the notes.
+
+    Returns:
+    str: One line per note.
+    """
+    lines = []
+    for url, title, score in notes:
+        # Brackets in the title would break the link
+        title = title.translate(str.maketrans("[]()", "    ")).strip() or url
+        title = title if len(title) <= 80 else title[:80] + "..."
+        lines.append("- [{}]({})".format(title, url))
+    return "\n".join(lines)
+
+
+async def related(update: Update, context: CallbackContext):
+    """
+    Function to handle the related command, replying with the notes most similar to a text.
+
+    The text is given after the command or is the message the command replies to.
+
+    Parameters:
+    update (Update): The update object that contains the status update.
+    context (CallbackContext): The context object that contains the current context of the update.
+    """
+    index = await asyncio.to_thread(get_related_index)
+    if index is None:
+        await update.message.reply_text(RELATED_UNAVAILABLE_MESSAGE)
+        return
+
+    text = " ".join(context.args)
+    if not text.strip() and update.message.reply_to_message is not None:
+        text = update.message.reply_to_message.text or update.message.reply_to_message.caption or ""
+    if not text.strip():
+        await update.message.reply_text(RELATED_USAGE_MESSAGE)
+        return
+
+    notes = (await asyncio.to_thread(index.related, [text]))[0]
+    if not notes:
+        await update.message.reply_text(RELATED_EMPTY_MESSAGE)
+        return
+    await update.message.reply_text(format_text_to_html(format_related(notes)), parse_mode=ParseMode.HTML,
+                                    disable_web_page_preview=True)
+
+
+async def edit_reply(bot, chat_id, message_id, text):
+    """
+    Function to replace the text of a reply, formatted as HTML.
+
+    Parameters:
+    bot (Bot): The bot that sent the reply.
+    chat_id (int): The chat of the reply.
+    message_id (int): The ID of the reply.
+    text (str): The new text of the reply.
+    """
+    try:
+        async with trace("telegram_edit", chat_id=chat_id):
+            html_text = format_text_to_html(text)
+            await bot.edit_message_text(html_text, chat_id=chat_id, message_id=message_id,
+                                        parse_mode=ParseMode.HTML)
+    except Exception:
+        # Already logged and counted by the trace
+        pass
+
+
+async def reply_if_duplicate(context: CallbackContext, placeholder_message, keys):
+    """
+    Function to check whether a note was saved before and, if so, reply with the link to its page.
+
+    Parameters:
+    context (CallbackContext): The context object that contains the current context of the update.
+    placeholder_message (Message): The reply to fill in.
+    keys (list): The index keys of the note, see note_keys.
+
+    Returns:
+    bool: Whether the note is a duplicate.
+    """
+    entry = get_dedup_index().find(keys)
+    if entry is None:
+        return False
+    await reply_duplicate(context, placeholder_message, entry)
+    return True
+
+
+async def reserve_note(context: CallbackContext, placeholder_message, keys):
+    """
+    Function to reserve the keys of a new note before any work is done on it, or reply with
+    the link to the copy saved before.
+
+    Parameters:
+    context (CallbackContext): The context object that contains the current context of the update.
+    placeholder_message (Message): The reply to fill in.
+    keys (list): The index keys of the note, see note_keys.
+
+    Returns:
+    list: The keys reserved for the note, to release if it cannot be saved, or None if it is a duplicate.
+    """
+    entry, reserved = get_dedup_index().reserve(keys)
+    if entry is not None:
+        await reply_duplicate(context, placeholder_message, entry)
+        return None
+    return reserved
+
+
+async def reply_duplicate(context: CallbackContext, placeholder_message, entry):
+    """
+    Function to reply with the link to the page of a note saved before.
+    """
+    page_id, page_url = entry
+    text = DUPLICATE_MESSAGE + page_url if page_url else DUPLICATE_PENDING_MESSAGE
+    await edit_reply(context.bot, placeholder_message.chat_id, placeholder_message.message_id, text)
+
+
+async def save_note(context: CallbackContext, placeholder_message, title, keys=(), **kwargs):
+    """
+    Function to summarize a note, show the summary and queue the Notion page.
+
+    The reply is shown before the page is queued, so the writer's update of the
+    reply always comes after it.
+
+    Parameters:
+    context (CallbackContext): The context object that contains the current context of the update.
+    placeholder_message (Message): The reply to fill in.
+    title (str): The title of the note.
+    keys (list, optional): The keys reserved for the note, see reserve_note, filled in or released
+    by the writer's listener. Defaults to ().
+    kwargs: The content, image and link of the note, passed to prepare_notion_page.
+    """
+    data, reply = await prepare_notion_page(title, **kwargs)
+
+    # The note itself is indexed once its page exists, so it is not its own match
+    index = await asyncio.to_thread(get_related_index)
+    if index is not None:
+        notes = (await asyncio.to_thread(index.related, [note_text(data["properties"])]))[0]
+        if notes:
+            reply += "\n\n" + RELATED_MESSAGE + "\n" + format_related(notes)
+
+    await edit_reply(context.bot, placeholder_message.chat_id, placeholder_message.message_id,
+                     reply + "\n\n" + SAVING_MESSAGE)
+    get_notion_writer().enqueue(data, {"chat_id": placeholder_message.chat_id,
+                                       "message_id": placeholder_message.message_id,
+                                       "reply": reply,
+                                       "keys": list(keys)})
+
+
+async def notify_page_created(bot, meta, page, error):
+    """
+    Function to update the reply of a note once its Notion page is created or has failed.
+
+    Parameters:
+    bot (Bot): The bot that sent the reply.
+    meta (dict): The chat and message ID of the reply and its text.
+    page (dict): The created Notion page, or None if the page could not be created.
+    error (str): The error returned by Notion, if any.
+    """
+    if "chat_id" not in meta:
+        return
+    if page is not None:
+        text = meta["reply"] + "\n\n" + SAVED_MESSAGE + page.get("url", "")
+    else:
+        text = "Error: " + error
+    await edit_reply(bot, meta["chat_id"], meta["message_id"], text)
+
+
+async def schedule_note(update: Update, context: CallbackContext, process):
+    """
+    Function to queue the processing of a note behind the earlier notes of its chat.
+
+    The user gets a reply right away: the placeholder, how many notes are ahead,
+    or a request to try again later if too many notes are waiting. If processing
+    fails, the placeholder shows the error.
+
+    Parameters:
+    update (Update): The update object that contains the status update.
+    context (CallbackContext): The context object that contains the current context of the update.
+    process (coroutine function): The function that processes the note, called with the update,
+    the context and the placeholder message.
+    """
+    scheduler = get_scheduler()
+    chat_id = update.message.chat_id
+    if scheduler.is_full(chat_id):
+        await update.message.reply_text(BUSY_MESSAGE)
+        return
+
+    ahead = scheduler.ahead(chat_id)
+    placeholder_message = await update.message.reply_text(QUEUED_MESSAGE.format(ahead) if ahead else "...")
+
+    async def job():
+        try:
+            await process(update, context, placeholder_message)
+        except Exception as err:
+            # The scheduler logs the error, the user should not be left with the placeholder
+            await edit_reply(context.bot, placeholder_message.chat_id, placeholder_message.message_id,
+                             "Error: " + (str(err) or type(err).__name__))
+            raise
+
+    try:
+        scheduler.submit(chat_id, job)
+    except SchedulerFull:
+        await context.bot.edit_message_text(BUSY_MESSAGE, chat_id=placeholder_message.chat_id,
+                                            message_id=placeholder_message.message_id)
 
-    filename = '{}_{}.png'.format(update.message.chat_id, update.message.message_id)
 
-    async with aiofiles.open("files/"+filename, 'wb') as out_file:
-        await out_file.write(image_data)
+async def handle_image(update: Update, context: CallbackContext):
+    """
+    Function to handle the image message.
 
-    img = Image.open("files/"+filename)
-    result = handle_gemini_image(img)
-    reply = add_notion_page(result, image=FILESERVER + filename)
-    await context.bot.edit_message_text(reply, chat_id=placeholder_message.chat_id,
-                                        message_id=placeholder_message.message_id)
+    Parameters:
+    update (Update): The update object that contains the status update.
+    context (CallbackContext): The context object that contains the current context of the update.
+    """
+    await schedule_note(update, context, note_from_image)
 
 
 async def handle_voice(update: Update, context: CallbackContext):
@@ -82,19 +315,8 @@ async def handle_voice(update: Update, context: CallbackContext):
     update (Update): The update object that contains the status update.
     context (CallbackContext): The context object that contains the current context of the update.
     """
-    placeholder_message = await update.message.reply_text("...")
-    await update.message.chat.send_action(action="typing")
-    voice = update.message.voice
-    voice_file = await context.bot.get_file(voice.file_id)
+    await schedule_note(update, context, note_from_voice)
 
-    buf = io.BytesIO()
-    await voice_file.download_to_memory(buf)
-    buf.name = "voice.oga"  # file extension is required
-    buf.seek(0)  # move cursor to the beginning of the buffer
-    result = handle_transcribe_openai(buf)
-    reply = add_notion_page(result)
-    await context.bot.edit_message_text(reply, chat_id=placeholder_message.chat_id,
-                                        message_id=placeholder_message.message_id)
 
 async def echo(update: Update, context: CallbackContext):
     """
@@ -104,53 +326,243 @@ async def echo(update: Update, context: CallbackContext):
     update (Update): The update object that contains the status update.
     context (CallbackContext): The context object that contains the current context of the update.
     """
-    placeholder_message = await update.message.reply_text("...")
+    await schedule_note(update, context, note_from_text)
+
+
+@timed("note_image")
+async def note_from_image(update: Update, context: CallbackContext, placeholder_message):
+    """
+    Function to describe an image and save it as a note.
+
+    Parameters:
+    update (Update): The update object that contains the status update.
+    context (CallbackContext): The context object that contains the current context of the update.
+    placeholder_message (Message): The reply to fill in.
+    """
+    photo = update.message.photo[-1]
+    # A forwarded photo keeps its file ID, it is caught before the download
+    if await reply_if_duplicate(context, placeholder_message, note_keys(file_id=photo.file_unique_id)):
+        return
+
     await update.message.chat.send_action(action="typing")
-    input_text = update.message.text
+    image_file = await context.bot.getFile(photo.file_id)
+
+    # Download into memory and shrink the image off the event loop
+    buf = io.BytesIO()
+    async with trace("telegram_download", kind="photo"):
+        await image_file.download_to_memory(buf)
+    buf.seek(0)
+    keys = await reserve_note(context, placeholder_message,
+                              note_keys(file_id=photo.file_unique_id, image=await asyncio.to_thread(image_hash, buf)))
+    if keys is None:
+        return
+
+    try:
+        name = '{}_{}'.format(update.message.chat_id, update.message.message_id)
+        async with trace("image_process"):
+            data, mime_type, filename = await asyncio.to_thread(process_image, buf, name)
+
+        result = await handle_gemini_image({"mime_type": mime_type, "data": data})
+        await save_note(context, placeholder_message, result, keys=keys, image=FILESERVER + filename)
+    except BaseException:
+        # Without a job nothing would release the reservation
+        get_dedup_index().discard(keys)
+        raise
+
+
+@timed("note_voice")
+async def note_from_voice(update: Update, context: CallbackContext, placeholder_message):
+    """
+    Function to transcribe a voice message and save it as a note.
+
+    Parameters:
+    update (Update): The update object that contains the status update.
+    context (CallbackContext): The context object that contains the current context of the update.
+    placeholder_message (Message): The reply to fill in.
+    """
+    voice = update.message.voice
+    if await reply_if_duplicate(context, placeholder_message, note_keys(file_id=voice.file_unique_id)):
+        return
+
+    await update.message.chat.send_action(action="typing")
+
+    async def download(path):
+        # Only needed if the recording was not transcribed before
+        voice_file = await context.bot.get_file(voice.file_id)
+        await voice_file.download_to_drive(path)
+
+    result = await transcribe_voice(voice.file_unique_id, voice.duration, download)
+    keys = await reserve_note(context, placeholder_message, note_keys(text=result, file_id=voice.file_unique_id))
+    if keys is None:
+        return
+    try:
+        await save_note(context, placeholder_message, result, keys=keys)
+    except BaseException:
+        get_dedup_index().discard(keys)
+        raise
+
+
+@timed("note_text")
+async def note_from_text(update: Update, context: CallbackContext, placeholder_message):
+    """
+    Function to save a text message as a note, with the content of its links.
 
+    Parameters:
+    update (Update): The update object that contains the status update.
+    context (CallbackContext): The context object that contains the current context of the update.
+    placeholder_message (Message): The reply to fill in.
+    """
+    input_text = update.message.text
 
     # Regular expression to match URLs
     urls = find_links_in_text(input_text)
-    urls_string = "\n".join(urls)
-    image = ""
-
-    if urls:
-        content = ""
-        for url in urls:
-            content, image = get_main_text_from_url(url)
-        content = """
-        message: {}
-        {}
-        """.format(input_text, content)
-        bot_reply = add_notion_page(input_text, content=content, link=urls_string, image=image)
-    else:
-        bot_reply = add_notion_page(input_text)
+    # Links saved before stay in the note, but are not reserved for it
+    keys = await reserve_note(context, placeholder_message, note_keys(text=input_text, urls=urls))
+    if keys is None:
+        return
 
     try:
-        html_text = format_text_to_html(bot_reply)
-        await context.bot.edit_message_text(html_text, chat_id=placeholder_message.chat_id,
-                                            message_id=placeholder_message.message_id,
-                                            parse_mode=ParseMode.HTML)
-    except Exception as err:
-        print(err)
+        await update.message.chat.send_action(action="typing")
+        urls_string = "\n".join(urls)
+        image = ""
+
+        if urls:
+            content, image = await fetch_pages(urls)
+            content = """
+            message: {}
+            {}
+            """.format(input_text, content)
+            await save_note(context, placeholder_message, input_text, keys=keys, content=content, link=urls_string,
+                            image=image)
+        else:
+            await save_note(context, placeholder_message, input_text, keys=keys)
+    except BaseException:
+        get_dedup_index().discard(keys)
+        raise
+
+
+async def startup(application):
+    """
+    Function to start the workers before the first update arrives.
 
+    Parameters:
+    application (Application): The running application.
+    """
+    # Load the SDKs, create the shared model objects and open the related index in the background,
+    # updates are received meanwhile
+    application.bot_data["warm_up"] = asyncio.create_task(
+        warm_up(partial(get_gemini_model, TEXT_MODEL), partial(get_gemini_model, VISION_MODEL), get_related_index))
+
+    # Set by the webhook server when several worker processes share the queues
+    worker = application.bot_data.get("worker", 0)
+    workers = application.bot_data.get("workers", 1)
+
+    # Drain the Notion queue, including pages left over from the last run
+    writer = get_notion_writer()
+    # The index learns the page link before the user is told about it
+    writer.add_listener(get_dedup_index().record_page)
+    writer.add_listener(get_search_index().record_page)
+    writer.add_listener(record_related_page)
+    writer.add_listener(partial(notify_page_created, application.bot))
+    await writer.start(share=1 / workers)
+
+    scheduler = get_scheduler()
+    await scheduler.start()
+
+    # Queue depths for capacity planning, read when the metrics are collected
+    metrics = get_metrics()
+    metrics.add_gauge("scheduler_pending", "Notes waiting for a worker.", lambda: scheduler.pending)
+    metrics.add_gauge("scheduler_active", "Notes being processed.", lambda: len(scheduler.active))
+    metrics.add_gauge("notion_pending", "Pages waiting to be written to Notion.", writer.pending)
+    metrics.add_gauge("notion_in_flight", "Pages being written to Notion.", lambda: len(writer.in_flight))
+    # Model calls that went to another provider because the preferred one was slow or failing
+    router = get_model_router()
+    metrics.add_gauge("router_hedges", "Model calls also sent to the next provider.", lambda: router.stats["hedges"])
+    metrics.add_gauge("router_fallbacks", "Model calls sent again to the next provider.",
+                      lambda: router.stats["fallbacks"])
+    metrics.add_gauge("router_open_breakers", "Model providers taken out of rotation.", router.open_breakers)
+    # Pages fetched again within the cache's lifetime are read from disk
+    page_cache = get_page_cache()
+    metrics.add_gauge("page_cache_hits", "Page extractions read from the cache.",
+                      lambda: page_cache.get_stats().get("hits", 0))
+    metrics.add_gauge("page_cache_misses", "Page extractions not in the cache.",
+                      lambda: page_cache.get_stats().get("misses", 0))
+    metrics.add_gauge("page_cache_bytes", "Size of the cached page extractions.",
+                      lambda: page_cache.get_stats()["bytes"])
+    # Prompts seen before are answered from the cache without a model call
+    llm_cache = get_llm_cache()
+    metrics.add_gauge("llm_cache_hit_rate", "Share of model calls answered from the cache.",
+                      lambda: llm_cache.get_stats()["hit_rate"])
+    # Each worker process serves its own metrics, on the ports after METRICS_PORT
+    application.bot_data["metrics_server"] = start_metrics_server(port=METRICS_PORT + worker if METRICS_PORT else 0)
+
+
+async def shutdown(application):
+    """
+    Function to release shared resources when the bot stops.
 
-if __name__ == '__main__':
+    Parameters:
+    application (Application): The running application.
     """
-    Main function to start the bot.
+    if application.bot_data.get("metrics_server") is not None:
+        application.bot_data["metrics_server"].shutdown()
+    if application.bot_data.get("warm_up") is not None:
+        application.bot_data["warm_up"].cancel()
+    await get_scheduler().stop()
+    await get_notion_writer().stop()
+    close_conversation_store()
+    await close_http_client()
+
+
+def build_application(builder=None):
     """
-    application = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+    Function to create the application with the handlers of the bot.
+
+    Parameters:
+    builder (ApplicationBuilder, optional): A builder with the token and any connection settings.
+    Defaults to one with TELEGRAM_TOKEN.
+
+    Returns:
+    Application: The application, not started yet.
+    """
+    if builder is None:
+        builder = ApplicationBuilder().token(TELEGRAM_TOKEN)
+
+    # Process updates concurrently, so one slow note does not hold up the other chats
+    application = builder.concurrent_updates(True).post_init(startup).post_shutdown(shutdown).build()
 
     start_handler = CommandHandler('start', start)
     help_handler = CommandHandler('help', send_help)
+    search_handler = CommandHandler('search', search)
+    related_handler = CommandHandler('related', related)
     message_handler = MessageHandler(filters.TEXT & (~filters.COMMAND), echo)
     photo_handler = MessageHandler(filters.PHOTO, handle_image)
     voice_handler = MessageHandler(filters.VOICE, handle_voice)
 
     application.add_handler(start_handler)
     application.add_handler(help_handler)
+    application.add_handler(search_handler)
+    application.add_handler(related_handler)
     application.add_handler(message_handler)
     application.add_handler(photo_handler)
     application.add_handler(voice_handler)
+    return application
 
-    application.run_polling()
\ No newline at end of file
+
+if __name__ == '__main__':
+    """
+    Main function to start the bot.
+    """
+    parser = argparse.ArgumentParser(description="Run the Telegram bot.")
+    parser.add_argument("--webhook", action="store_true",
+                        help="Receive updates by webhook at WEBHOOK_URL instead of polling for them.")
+    parser.add_argument("--workers", type=int, help="The number of webhook worker processes.")
+    args = parser.parse_args()
+
+    configure_logging()
+    if args.webhook:
+        from utils.webhook import run_webhook, WEBHOOK_WORKERS
+        run_webhook(build_application, args.workers or WEBHOOK_WORKERS)
+    else:
+        # Polling needs no public address, for development
+        build_application().run_polling()
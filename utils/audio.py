@@ -0,0 +1,261 @@
+import os
+import re
+import shutil
+import asyncio
+import tempfile
+
+from dotenv import load_dotenv
+
+from utils.cache import DiskCache
+from utils.metrics import trace
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Recordings longer than this are transcribed in chunks of about AUDIO_CHUNK_SECONDS
+AUDIO_SPLIT_SECONDS = float(os.getenv("AUDIO_SPLIT_SECONDS", 150))
+AUDIO_CHUNK_SECONDS = float(os.getenv("AUDIO_CHUNK_SECONDS", 120))
+# Chunks that cannot be cut on a silence overlap by this much
+AUDIO_OVERLAP_SECONDS = float(os.getenv("AUDIO_OVERLAP_SECONDS", 2))
+AUDIO_MAX_PARALLEL = int(os.getenv("AUDIO_MAX_PARALLEL", 4))
+
+# What counts as silence for trimming and for choosing the cut points
+AUDIO_SILENCE_DB = float(os.getenv("AUDIO_SILENCE_DB", -35))
+AUDIO_SILENCE_SECONDS = float(os.getenv("AUDIO_SILENCE_SECONDS", 0.4))
+
+TRANSCRIPT_CACHE_MAX_BYTES = int(os.getenv("TRANSCRIPT_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+
+# ffmpeg is needed to find silences and cut chunks, without it recordings are sent whole
+FFMPEG = shutil.which("ffmpeg")
+
+SILENCE_START = re.compile(r'silence_start: (-?[\d.]+)')
+SILENCE_END = re.compile(r'silence_end: (-?[\d.]+)')
+WORD = re.compile(r'\w+')
+
+# The function that turns an audio file into text, see set_transcriber
+_transcriber = None
+
+# The transcript cache, opened on first use
+_transcript_cache = None
+
+
+def set_transcriber(transcriber):
+    """
+    Function to replace the transcriber, e.g. with a local stand-in for tests.
+
+    Parameters:
+    transcriber (coroutine function): Called with an open audio file that has a name, returns the text.
+    """
+    global _transcriber
+    _transcriber = transcriber
+
+
+def get_transcriber():
+    """
+    Function to get the transcriber, Whisper unless another one was set.
+
+    Returns:
+    coroutine function: The transcriber.
+    """
+    if _transcriber is None:
+        from utils.openai_api import handle_transcribe_openai
+        return handle_transcribe_openai
+    return _transcriber
+
+
+def get_transcript_cache():
+    """
+    Function to get the cache of transcripts, keyed by Telegram's file_unique_id.
+
+    Returns:
+    DiskCache: The transcript cache.
+    """
+    global _transcript_cache
+    if _transcript_cache is None:
+        _transcript_cache = DiskCache("transcripts", TRANSCRIPT_CACHE_MAX_BYTES)
+    return _transcript_cache
+
+
+async def run_ffmpeg(*args):
+    """
+    Function to run ffmpeg without blocking the event loop.
+
+    Parameters:
+    args (str): The arguments of ffmpeg.
+
+    Returns:
+    str: What ffmpeg wrote to stderr.
+    """
+    process = await asyncio.create_subprocess_exec(FFMPEG, "-hide_banner", "-nostdin", *args,
+                                                   stdout=asyncio.subprocess.DEVNULL,
+                                                   stderr=asyncio.subprocess.PIPE)
+    _, stderr = await process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError("ffmpeg failed: " + stderr.decode(errors="replace")[-500:])
+    return stderr.decode(errors="replace")
+
+
+async def detect_silences(path):
+    """
+    Function to find the silent stretches of a recording.
+
+    Parameters:
+    path (str): The audio file.
+
+    Returns:
+    list: Tuples of start and end of each silence, in seconds.
+    """
+    output = await run_ffmpeg("-i", path, "-af", "silencedetect=noise={}dB:d={}".format(
+        AUDIO_SILENCE_DB, AUDIO_SILENCE_SECONDS), "-f", "null", "-")
+    starts = [float(value) for value in SILENCE_START.findall(output)]
+    ends = [float(value) for value in SILENCE_END.findall(output)]
+    # A silence that lasts until the end has no end mark
+    ends += [float("inf")] * (len(starts) - len(ends))
+    return list(zip(starts, ends))
+
+
+def plan_chunks(duration, silences):
+    """
+    Function to choose the chunks of a recording.
+
+    Leading and trailing silence is cut off. Chunks are about AUDIO_CHUNK_SECONDS
+    long and end in the middle of a silence where there is one near the target
+    length. Otherwise they overlap by AUDIO_OVERLAP_SECONDS, so no word is lost
+    at the cut.
+
+    Parameters:
+    duration (float): The length of the recording in seconds.
+    silences (list): Tuples of start and end of each silence.
+
+    Returns:
+    list: Tuples of start and end of each chunk, in seconds.
+    """
+    start, end = 0.0, duration
+    if silences and silences[0][0] <= 0.05:
+        start = min(silences[0][1], duration)
+    if silences and silences[-1][1] >= duration - 0.05:
+        end = max(silences[-1][0], start)
+    if end - start <= AUDIO_SPLIT_SECONDS:
+        return [(start, end)] if end > start else []
+
+    midpoints = [(s + e) / 2 for s, e in silences if start < s and e < end]
+    chunks = []
+    position = start
+    while end - position > AUDIO_CHUNK_SECONDS:
+        target = position + AUDIO_CHUNK_SECONDS
+        # Prefer the silence closest to the target within the last quarter of the chunk
+        candidates = [m for m in midpoints if target - AUDIO_CHUNK_SECONDS / 4 <= m <= target]
+        if candidates:
+            cut = max(candidates)
+            chunks.append((position, cut))
+            position = cut
+        else:
+            chunks.append((position, target))
+            position = target - AUDIO_OVERLAP_SECONDS
+    chunks.append((position, end))
+    return chunks
+
+
+def normalize_word(word):
+    """
+    Function to compare words regardless of case and punctuation.
+    """
+    return "".join(WORD.findall(word)).lower()
+
+
+def stitch(texts):
+    """
+    Function to join the transcripts of consecutive chunks.
+
+    Words repeated because chunks overlap are dropped: the longest run of words that
+    ends one transcript and starts the next is kept only once.
+
+    Parameters:
+    texts (list): The transcripts, in order.
+
+    Returns:
+    str: The joined transcript.
+    """
+    result = ""
+    for text in texts:
+        text = text.strip()
+        if not result:
+            result = text
+            continue
+        tail = [normalize_word(w) for w in result[-300:].split()]
+        head = text.split()
+        head_words = [normalize_word(w) for w in head[:30]]
+        overlap = 0
+        for size in range(min(len(tail), len(head_words)), 0, -1):
+            if tail[-size:] == head_words[:size]:
+                overlap = size
+                break
+        result += " " + " ".join(head[overlap:])
+    return result.strip()
+
+
+async def transcribe_audio(path, duration):
+    """
+    Function to transcribe a recording, in parallel chunks if it is long.
+
+    Parameters:
+    path (str): The audio file.
+    duration (float): The length of the recording in seconds.
+
+    Returns:
+    str: The transcript.
+    """
+    transcriber = get_transcriber()
+    if FFMPEG is None:
+        with open(path, "rb") as audio_file:
+            return await transcriber(audio_file)
+
+    async with trace("audio_silences", seconds=duration):
+        silences = await detect_silences(path)
+    chunks = plan_chunks(duration, silences)
+    if not chunks:
+        return ""
+
+    semaphore = asyncio.Semaphore(AUDIO_MAX_PARALLEL)
+    directory = os.path.dirname(path)
+
+    async def transcribe_chunk(index, start, end):
+        async with semaphore:
+            chunk_path = os.path.join(directory, "chunk{}.ogg".format(index))
+            async with trace("audio_cut"):
+                await run_ffmpeg("-y", "-ss", str(start), "-t", str(end - start), "-i", path,
+                                 "-ac", "1", "-c:a", "libopus", "-b:a", "24k", chunk_path)
+            with open(chunk_path, "rb") as audio_file:
+                return await transcriber(audio_file)
+
+    texts = await asyncio.gather(*(transcribe_chunk(i, start, end) for i, (start, end) in enumerate(chunks)))
+    return stitch(texts)
+
+
+async def transcribe_voice(file_unique_id, duration, download):
+    """
+    Function to transcribe a Telegram voice message, reusing the transcript if it was seen before.
+
+    Parameters:
+    file_unique_id (str): Telegram's ID of the file, the same for every copy of it.
+    duration (float): The length of the recording in seconds.
+    download (coroutine function): Called with a path to download the recording to.
+
+    Returns:
+    str: The transcript.
+    """
+    cache = get_transcript_cache()
+    cached = cache.get(file_unique_id)
+    if cached is not None:
+        return cached[0]
+
+    with tempfile.TemporaryDirectory() as directory:
+        # The file extension tells Whisper the format
+        path = os.path.join(directory, "voice.oga")
+        async with trace("telegram_download", kind="voice"):
+            await download(path)
+        async with trace("transcribe", seconds=duration):
+            text = await transcribe_audio(path, duration)
+
+    cache.set(file_unique_id, text)
+    return text
@@ -0,0 +1,246 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import Counter, OrderedDict
+
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Directory holding the on-disk caches
+CACHE_DIR = os.getenv("CACHE_DIR", "cache")
+
+
+def cache_key(*parts):
+    """
+    Function to build a fixed-size cache key from any number of strings.
+
+    Parameters:
+    parts (str): The strings identifying the cached value.
+
+    Returns:
+    str: The SHA-256 hex digest of the parts.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class DiskCache:
+    """
+    A persistent key-value cache stored in SQLite.
+
+    Values are JSON-serializable objects. The total size of the stored values is
+    bounded and the least recently used entries are evicted first. The size is
+    read from SQLite before evicting, as worker processes may share the file. Hit
+    and miss counters are kept in `stats`.
+    """
+    def __init__(self, name, max_bytes):
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        self.path = os.path.join(CACHE_DIR, name + ".sqlite")
+        self.max_bytes = max_bytes
+        self.stats = Counter()
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                stored_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed_at)")
+        # Summing the sizes reads this index instead of the values
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_size ON entries (size)")
+        self.total_bytes = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def get(self, key, max_age=None):
+        """
+        Method to look up an entry and mark it as recently used.
+
+        Parameters:
+        key (str): The key of the entry.
+        max_age (float, optional): Seconds after which the entry is stale. A stale entry is
+        still returned, but only counts as a hit once it is revalidated, see touch. Defaults to never.
+
+        Returns:
+        tuple: A tuple containing the value and the time it was stored, or None if the key is missing.
+        """
+        with self.lock:
+            row = self.db.execute("SELECT value, stored_at FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+            if max_age is not None and time.time() - row[1] >= max_age:
+                self.stats["stale"] += 1
+            else:
+                self.stats["hits"] += 1
+            self.db.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0]), row[1]
+
+    def set(self, key, value):
+        """
+        Method to store an entry, evicting the least recently used entries if the cache is full.
+
+        Parameters:
+        key (str): The key of the entry.
+        value (object): The JSON-serializable value to store.
+        """
+        data = json.dumps(value)
+        size = len(data)
+        now = time.time()
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)", (key, data, size, now, now))
+            self.stats["stores"] += 1
+            self._evict()
+
+    def touch(self, key):
+        """
+        Method to mark an entry as freshly stored, e.g. after the origin confirmed it is unchanged.
+
+        Parameters:
+        key (str): The key of the entry.
+        """
+        now = time.time()
+        with self.lock:
+            # The stale entry was of use after all
+            self.stats["revalidated"] += 1
+            self.stats["hits"] += 1
+            self.db.execute("UPDATE entries SET stored_at = ?, accessed_at = ? WHERE key = ?", (now, now, key))
+
+    def _evict(self):
+        """
+        Method to delete the least recently used entries until the cache fits its size limit, with the lock held.
+        """
+        # Other processes sharing the file store and evict entries too
+        self.total_bytes = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        while self.total_bytes > self.max_bytes:
+            rows = self.db.execute("SELECT key, size FROM entries ORDER BY accessed_at LIMIT 64").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self.total_bytes -= size
+                self.stats["evictions"] += 1
+                if self.total_bytes <= self.max_bytes:
+                    break
+
+    def get_stats(self):
+        """
+        Method to get the counters of the cache.
+
+        Returns:
+        dict: The counters, the number of entries and their total size.
+        """
+        with self.lock:
+            entries, self.total_bytes = self.db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) "
+                                                        "FROM entries").fetchone()
+        stats = dict(self.stats)
+        stats.update(entries=entries, bytes=self.total_bytes)
+        return stats
+
+
+class LRUCache:
+    """
+    A bounded in-memory cache that drops the least recently used entry when full.
+    """
+    def __init__(self, max_items):
+        self.max_items = max_items
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        """
+        Method to look up an entry and mark it as recently used.
+
+        Parameters:
+        key (str): The key of the entry.
+
+        Returns:
+        object: The cached value, or None if the key is missing.
+        """
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        """
+        Method to store an entry, dropping the least recently used one if the cache is full.
+
+        Parameters:
+        key (str): The key of the entry.
+        value (object): The value to store.
+        """
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_items:
+            self.entries.popitem(last=False)
+
+
+class TieredCache:
+    """
+    An in-memory LRU cache in front of a persistent DiskCache.
+
+    Disk hits are promoted to memory. Hits of both tiers and misses are counted,
+    so the hit rate can be reported.
+    """
+    def __init__(self, name, max_items, max_bytes):
+        self.memory = LRUCache(max_items)
+        self.disk = DiskCache(name, max_bytes)
+        self.stats = Counter()
+
+    def get(self, key):
+        """
+        Method to look up an entry in memory first, then on disk.
+
+        Parameters:
+        key (str): The key of the entry.
+
+        Returns:
+        object: The cached value, or None if the key is missing.
+        """
+        value = self.memory.get(key)
+        if value is not None:
+            self.stats["memory_hits"] += 1
+            return value
+        entry = self.disk.get(key)
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        self.stats["disk_hits"] += 1
+        self.memory.set(key, entry[0])
+        return entry[0]
+
+    def set(self, key, value):
+        """
+        Method to store an entry in both tiers.
+
+        Parameters:
+        key (str): The key of the entry.
+        value (object): The JSON-serializable value to store.
+        """
+        self.memory.set(key, value)
+        self.disk.set(key, value)
+
+    def get_stats(self):
+        """
+        Method to get the counters and the hit rate of the cache.
+
+        Returns:
+        dict: The counters of both tiers and the overall hit rate.
+        """
+        hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+        lookups = hits + self.stats["misses"]
+        stats = dict(self.stats)
+        stats.update(memory_entries=len(self.memory.entries), disk_entries=self.disk.get_stats()["entries"],
+                     hit_rate=hits / lookups if lookups else 0.0)
+        return stats
@@ -0,0 +1,344 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import logging
+import threading
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+
+from dotenv import load_dotenv
+
+from utils.cache import CACHE_DIR
+from utils.metrics import log_event
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Tokens of recent turns sent with each message, older turns are folded into the summary
+MEMORY_TOKENS = int(os.getenv("MEMORY_TOKENS", 1500))
+# Most tokens of the rolling summary of the older turns
+MEMORY_SUMMARY_TOKENS = int(os.getenv("MEMORY_SUMMARY_TOKENS", 300))
+# Number of chats kept in memory and seconds a chat may stay idle before it is evicted
+MEMORY_CHATS = int(os.getenv("MEMORY_CHATS", 1000))
+MEMORY_IDLE = float(os.getenv("MEMORY_IDLE", 3600))
+# Whether evicted chats are written to disk and picked up again on their next message
+MEMORY_SPILL = os.getenv("MEMORY_SPILL", "1") != "0"
+# Days an evicted chat is kept on disk
+MEMORY_RETENTION_DAYS = float(os.getenv("MEMORY_RETENTION_DAYS", 30))
+
+SENTENCE = re.compile(r'(?<=[.!?])\s')
+
+
+def count_tokens(text):
+    """
+    Function to estimate the number of tokens of a text, about four characters each for English.
+
+    An estimate keeps the memory free of tokenizer downloads, the budgets leave room for its error.
+
+    Parameters:
+    text (str): The text.
+
+    Returns:
+    int: The estimated number of tokens.
+    """
+    return len(text) // 4 + 1
+
+
+def trim_tokens(text, tokens, keep_end=False):
+    """
+    Function to cut a text to about a number of tokens, on a word boundary.
+
+    Parameters:
+    text (str): The text.
+    tokens (int): The most tokens to keep.
+    keep_end (bool, optional): Whether to keep the end of the text rather than its start. Defaults to False.
+
+    Returns:
+    str: The text, cut if it was longer.
+    """
+    limit = tokens * 4
+    if len(text) <= limit:
+        return text
+    if keep_end:
+        cut = text[-limit:]
+        return "..." + cut[cut.find(" ") + 1:] if " " in cut else cut
+    cut = text[:limit]
+    return cut[:cut.rfind(" ")] + "..." if " " in cut else cut
+
+
+def summarize_turns(summary, turns, tokens=MEMORY_SUMMARY_TOKENS):
+    """
+    Function to fold turns into a summary by keeping the first sentence of each side.
+
+    Used when no model is given to summarize with, it makes no requests.
+
+    Parameters:
+    summary (str): The summary of the turns before.
+    turns (list): Pairs of the human input and the answer, oldest first.
+    tokens (int, optional): The most tokens of the new summary. Defaults to MEMORY_SUMMARY_TOKENS.
+
+    Returns:
+    str: The new summary, the most recent part kept if it is too long.
+    """
+    lines = [summary] if summary else []
+    for human, answer in turns:
+        lines.append("Human: {} AI: {}".format(trim_tokens(SENTENCE.split(human.strip(), 1)[0], 40),
+                                               trim_tokens(SENTENCE.split(answer.strip(), 1)[0], 40)))
+    return trim_tokens("\n".join(lines), tokens, keep_end=True)
+
+
+class ChatMemory:
+    """
+    Memory of one chat: the recent turns within a token budget and a rolling summary of the older ones.
+
+    The tokens of the window are counted as turns are added, so adding a turn
+    does not go over the whole history.
+    """
+    def __init__(self, summary="", turns=()):
+        self.summary = summary
+        self.turns = deque()
+        self.tokens = 0
+        self.lock = threading.Lock()
+        self.used_at = time.time()
+        self.users = 0
+        for human, answer in turns:
+            self._append(human, answer)
+
+    def _append(self, human, answer):
+        """
+        Method to add a turn to the window.
+        """
+        tokens = count_tokens(human) + count_tokens(answer)
+        self.turns.append((human, answer, tokens))
+        self.tokens += tokens
+
+    def history(self):
+        """
+        Method to get the history to send with the next message.
+
+        Returns:
+        str: The summary of the older turns, then the recent turns.
+        """
+        lines = ["Summary of the earlier conversation:\n" + self.summary] if self.summary else []
+        for human, answer, _ in self.turns:
+            lines.append("Human: {}\nAI: {}".format(human, answer))
+        return "\n".join(lines)
+
+    def add(self, human, answer, max_tokens, summarize):
+        """
+        Method to add a turn, folding the oldest turns into the summary when the window is over its budget.
+
+        The window is folded down to half its budget, so the summary is updated
+        once every few turns rather than on every turn.
+
+        Parameters:
+        human (str): The human input.
+        answer (str): The answer of the model.
+        max_tokens (int): The most tokens of the window.
+        summarize (function): Called with the summary and the folded turns, returns the new summary.
+        """
+        self._append(human, answer)
+        if self.tokens <= max_tokens:
+            return
+        folded = []
+        # The newest turn always stays, however long it is
+        while len(self.turns) > 1 and self.tokens > max_tokens // 2:
+            human, answer, tokens = self.turns.popleft()
+            self.tokens -= tokens
+            folded.append((human, answer))
+        if folded:
+            self.summary = summarize(self.summary, folded)
+
+    def to_json(self):
+        """
+        Method to get the memory as JSON, to write to disk.
+        """
+        return json.dumps({"summary": self.summary, "turns": [[human, answer] for human, answer, _ in self.turns]})
+
+    @classmethod
+    def from_json(cls, data):
+        """
+        Method to create the memory written by to_json.
+        """
+        data = json.loads(data)
+        return cls(data["summary"], data["turns"])
+
+
+class ConversationStore:
+    """
+    Memory of every chat, shared by the handlers.
+
+    Chats are kept in memory in the order they were last used. When there are
+    more than max_chats, or a chat is idle for longer than idle seconds, the
+    least recently used chats are evicted, and written to SQLite if spill is set
+    so their next message picks up where it left off. A chat in use by a handler
+    is never evicted, and its turns are added under its own lock.
+    """
+    def __init__(self, path=None, max_chats=MEMORY_CHATS, max_tokens=MEMORY_TOKENS, idle=MEMORY_IDLE,
+                 summarize=summarize_turns):
+        self.max_chats = max_chats
+        self.max_tokens = max_tokens
+        self.idle = idle
+        self.summarize = summarize
+        self.chats = OrderedDict()
+        self.lock = threading.Lock()
+        self.spilled = 0
+        self.db = None
+        if path is not None:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS chats (
+                    chat_id INTEGER PRIMARY KEY,
+                    memory TEXT NOT NULL,
+                    used_at REAL NOT NULL
+                )""")
+            self.db.execute("DELETE FROM chats WHERE used_at < ?", (time.time() - MEMORY_RETENTION_DAYS * 86400,))
+
+    @contextmanager
+    def open(self, chat_id):
+        """
+        Method to use the memory of a chat, loading it from disk if it was evicted.
+
+        Parameters:
+        chat_id (int): The chat ID.
+
+        Returns:
+        ChatMemory: The memory of the chat, locked until the block ends.
+        """
+        with self.lock:
+            chat = self.chats.get(chat_id)
+            if chat is None:
+                chat = self._load(chat_id)
+                self.chats[chat_id] = chat
+            self.chats.move_to_end(chat_id)
+            chat.users += 1
+        try:
+            with chat.lock:
+                yield chat
+        finally:
+            with self.lock:
+                chat.users -= 1
+                chat.used_at = time.time()
+                self._evict()
+
+    def history(self, chat_id):
+        """
+        Method to get the history of a chat to send with its next message.
+
+        Parameters:
+        chat_id (int): The chat ID.
+
+        Returns:
+        str: The summary of the older turns, then the recent turns.
+        """
+        with self.open(chat_id) as chat:
+            return chat.history()
+
+    def add_turn(self, chat_id, human, answer, summarize=None):
+        """
+        Method to add a turn to the memory of a chat.
+
+        Parameters:
+        chat_id (int): The chat ID.
+        human (str): The human input.
+        answer (str): The answer of the model.
+        summarize (function, optional): Folds turns into the summary. Defaults to the summarize of the store.
+        """
+        with self.open(chat_id) as chat:
+            chat.add(human, answer, self.max_tokens, summarize or self.summarize)
+
+    def _load(self, chat_id):
+        """
+        Method to read a spilled chat from disk, or start a new one.
+        """
+        if self.db is not None:
+            row = self.db.execute("SELECT memory FROM chats WHERE chat_id = ?", (chat_id,)).fetchone()
+            if row is not None:
+                return ChatMemory.from_json(row[0])
+        return ChatMemory()
+
+    def _evict(self):
+        """
+        Method to take the least recently used chats out of memory, with the store lock held.
+
+        They are written before the lock is released, so a chat is never read back
+        from disk before its latest turns are there.
+        """
+        evicted = []
+        cutoff = time.time() - self.idle
+        for chat_id, chat in list(self.chats.items()):
+            if len(self.chats) <= self.max_chats and chat.used_at >= cutoff:
+                break
+            if chat.users:
+                continue
+            del self.chats[chat_id]
+            evicted.append((chat_id, chat))
+        self._spill(evicted)
+
+    def _spill(self, evicted):
+        """
+        Method to write evicted chats to disk, if the store has a file, with the store lock held.
+
+        Parameters:
+        evicted (list): Pairs of chat ID and memory of the evicted chats.
+        """
+        if not evicted:
+            return
+        if self.db is not None:
+            self.db.executemany("INSERT OR REPLACE INTO chats VALUES (?, ?, ?)",
+                                [(chat_id, chat.to_json(), chat.used_at) for chat_id, chat in evicted])
+            self.spilled += len(evicted)
+        log_event(logging.DEBUG, "memory_evicted", chats=len(evicted), spilled=self.db is not None)
+
+    def close(self):
+        """
+        Method to write every chat in memory to disk, when the bot stops.
+        """
+        with self.lock:
+            self._spill(list(self.chats.items()))
+            self.chats.clear()
+
+    def get_stats(self):
+        """
+        Method to get the size of the store.
+
+        Returns:
+        dict: The number of chats in memory, their tokens and the number of chats written to disk.
+        """
+        with self.lock:
+            return {"chats": len(self.chats), "tokens": sum(chat.tokens for chat in self.chats.values()),
+                    "spilled": self.spilled}
+
+
+# The store shared by every handler, created on first use
+_store = None
+_store_lock = threading.Lock()
+
+def get_conversation_store():
+    """
+    Function to get the memory of the chats.
+
+    Returns:
+    ConversationStore: The shared store, spilling to the cache directory if MEMORY_SPILL is set.
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = ConversationStore(os.path.join(CACHE_DIR, "conversations.sqlite") if MEMORY_SPILL else None)
+    return _store
+
+
+def close_conversation_store():
+    """
+    Function to write the chats of the shared store to disk, if it was created.
+    """
+    global _store
+    with _store_lock:
+        if _store is not None:
+            _store.close()
+            _store = None
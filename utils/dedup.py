@@ -0,0 +1,436 @@
+import io
+import os
+import time
+import sqlite3
+import asyncio
+import argparse
+import threading
+
+from dotenv import load_dotenv
+
+from utils.cache import CACHE_DIR, cache_key
+from utils.helpers import normalize_url
+from utils.http_client import get_http_client
+from utils.images import FILES_DIR, image_hash
+from utils.metrics import log_error
+
+# Load environment variables from .env file
+load_dotenv()
+
+FILESERVER = os.getenv("FILESERVER") or ""
+
+# Images whose hashes differ in at most this many of the 64 bits are the same image
+DEDUP_IMAGE_DISTANCE = int(os.getenv("DEDUP_IMAGE_DISTANCE", 3))
+# Number of images hashed at the same time while rebuilding the index
+DEDUP_REBUILD_PARALLEL = int(os.getenv("DEDUP_REBUILD_PARALLEL", 8))
+
+HASH_BITS = 64
+
+
+def note_keys(text=None, urls=(), file_id=None, image=None):
+    """
+    Function to build the index keys of a note.
+
+    Parameters:
+    text (str, optional): The text of the note, compared regardless of case and spacing.
+    urls (list, optional): The links of the note, compared after normalization.
+    file_id (str, optional): Telegram's file_unique_id of the photo or recording.
+    image (int, optional): The perceptual hash of the image.
+
+    Returns:
+    list: Pairs of kind and key.
+    """
+    keys = []
+    if text and text.strip():
+        keys.append(["text", cache_key(" ".join(text.lower().split()))])
+    for url in urls:
+        keys.append(["url", normalize_url(url)])
+    if file_id:
+        keys.append(["file", file_id])
+    if image is not None:
+        keys.append(["image", "{:016x}".format(image)])
+    return keys
+
+
+def hash_bands(value):
+    """
+    Function to split an image hash into DEDUP_IMAGE_DISTANCE + 1 bands.
+
+    Two hashes within DEDUP_IMAGE_DISTANCE bits of each other have at least one band
+    in common, so near duplicates are found by exact lookups of the bands.
+
+    Parameters:
+    value (int): The image hash.
+
+    Returns:
+    list: Pairs of band number and band value.
+    """
+    count = DEDUP_IMAGE_DISTANCE + 1
+    bands = []
+    for band in range(count):
+        start = band * HASH_BITS // count
+        end = (band + 1) * HASH_BITS // count
+        bands.append((band, (value >> start) & ((1 << (end - start)) - 1)))
+    return bands
+
+
+class DedupIndex:
+    """
+    Index of the notes already saved, to catch duplicates before any work is done on them.
+
+    Entries are kept in SQLite and loaded into dictionaries, so every lookup is a
+    hash table lookup. Notes are reserved as soon as they are found to be new, so
+    a duplicate sent while the first copy is still being saved is caught too.
+    Reserved entries get the page link once the writer has created the page.
+    Entries written by other worker processes are loaded before each lookup.
+    """
+    def __init__(self, path):
+        self.entries = {}
+        self.bands = {}
+        self.last_rowid = 0
+        self.lock = threading.Lock()
+        self.reserve_lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS notes (
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                page_id TEXT,
+                page_url TEXT,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (kind, key)
+            )""")
+        self.refresh()
+
+    def refresh(self):
+        """
+        Method to load the entries written since the last refresh, e.g. by another worker process.
+        """
+        # A replaced row gets a new rowid, so new and updated entries both come after the last one seen
+        with self.lock:
+            rows = self.db.execute("SELECT rowid, kind, key, page_id, page_url FROM notes WHERE rowid > ? "
+                                   "ORDER BY rowid", (self.last_rowid,)).fetchall()
+        for rowid, kind, key, page_id, page_url in rows:
+            self._remember(kind, key, page_id, page_url)
+            self.last_rowid = rowid
+
+    def _remember(self, kind, key, page_id, page_url):
+        """
+        Method to add an entry to the in-memory dictionaries.
+        """
+        self.entries[(kind, key)] = (page_id, page_url)
+        if kind == "image":
+            value = int(key, 16)
+            for band in hash_bands(value):
+                self.bands.setdefault(band, set()).add(value)
+
+    def _forget(self, kind, key):
+        """
+        Method to remove an entry from the in-memory dictionaries.
+        """
+        self.entries.pop((kind, key), None)
+        if kind == "image":
+            value = int(key, 16)
+            for band in hash_bands(value):
+                self.bands.get(band, set()).discard(value)
+
+    def _is_stored(self, kind, key):
+        """
+        Method to check whether an entry is still in SQLite.
+        """
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM notes WHERE kind = ? AND key = ?", (kind, key)).fetchone() is not None
+
+    def _match(self, kind, key):
+        """
+        Method to look up one key, images within DEDUP_IMAGE_DISTANCE bits included.
+
+        Returns:
+        tuple: A tuple containing the page ID and link of the note, or None if the key is new.
+        """
+        entry = self.entries.get((kind, key))
+        if entry == (None, None) and not self._is_stored(kind, key):
+            # Another process dropped the reservation
+            self._forget(kind, key)
+            entry = None
+        if entry is not None:
+            return entry
+        if kind == "image":
+            value = int(key, 16)
+            for band in hash_bands(value):
+                for other in self.bands.get(band, ()):
+                    if bin(value ^ other).count("1") <= DEDUP_IMAGE_DISTANCE:
+                        return self.entries[("image", "{:016x}".format(other))]
+        return None
+
+    def find(self, keys):
+        """
+        Method to look for a saved or reserved copy of a note.
+
+        A note is a copy if its text, file or image matches, or if every one of its
+        links does. A note with only some links saved before is new, see known_links.
+
+        Parameters:
+        keys (list): Pairs of kind and key, see note_keys.
+
+        Returns:
+        tuple: A tuple containing the page ID and link of the note, both None while
+        the page is being created, or None if the note is new.
+        """
+        self.refresh()
+        links = []
+        for kind, key in keys:
+            entry = self._match(kind, key)
+            if kind == "url":
+                links.append(entry)
+            elif entry is not None:
+                return entry
+        if links and all(entry is not None for entry in links):
+            return links[0]
+        return None
+
+    def known_links(self, keys):
+        """
+        Method to find the links of a new note that were saved or reserved before.
+
+        Parameters:
+        keys (list): Pairs of kind and key, see note_keys.
+
+        Returns:
+        list: The pairs of kind and key of the known links.
+        """
+        return [[kind, key] for kind, key in keys if kind == "url" and self._match(kind, key) is not None]
+
+    def reserve(self, keys):
+        """
+        Method to reserve the keys of a new note, unless a copy of it was saved or reserved before.
+
+        The lookup and the reservation are one transaction, so of two copies handled
+        at the same time, by this or another worker process, only one is new.
+
+        Parameters:
+        keys (list): Pairs of kind and key, see note_keys.
+
+        Returns:
+        tuple: A tuple containing the page ID and link of the copy, see find, or None if the
+        note is new, and the keys reserved for it: all but its links saved before.
+        """
+        with self.reserve_lock:
+            with self.lock:
+                # Taking the write lock first keeps other processes from reserving the same keys meanwhile
+                self.db.execute("BEGIN IMMEDIATE")
+            try:
+                entry = self.find(keys)
+                if entry is not None:
+                    return entry, []
+                known = self.known_links(keys)
+                reserved = [[kind, key] for kind, key in keys if [kind, key] not in known]
+                self.add(reserved)
+                return None, reserved
+            finally:
+                with self.lock:
+                    self.db.execute("COMMIT")
+
+    def add(self, keys, page_id=None, page_url=None):
+        """
+        Method to record the keys of a note, with its page or as reserved.
+
+        Parameters:
+        keys (list): Pairs of kind and key, see note_keys.
+        page_id (str, optional): The ID of the Notion page. Defaults to None.
+        page_url (str, optional): The link of the Notion page. Defaults to None.
+        """
+        now = time.time()
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO notes VALUES (?, ?, ?, ?, ?)",
+                                [(kind, key, page_id, page_url, now) for kind, key in keys])
+        for kind, key in keys:
+            self._remember(kind, key, page_id, page_url)
+
+    def discard(self, keys):
+        """
+        Method to drop reserved keys, e.g. when their page could not be created.
+
+        Parameters:
+        keys (list): Pairs of kind and key, see note_keys.
+        """
+        with self.lock:
+            self.db.executemany("DELETE FROM notes WHERE kind = ? AND key = ? AND page_id IS NULL",
+                                [(kind, key) for kind, key in keys])
+        for kind, key in keys:
+            if self.entries.get((kind, key)) == (None, None):
+                self._forget(kind, key)
+
+    async def record_page(self, meta, page, error):
+        """
+        Method to fill in the page of reserved keys, called by the Notion writer when a job finishes.
+
+        Parameters:
+        meta (dict): The meta data of the job, with the keys of the note.
+        page (dict): The created Notion page, or None if the page could not be created.
+        error (str): The error returned by Notion, if any.
+        """
+        keys = meta.get("keys")
+        if not keys:
+            return
+        if page is not None:
+            self.add(keys, page.get("id"), page.get("url"))
+        else:
+            self.discard(keys)
+
+    async def rebuild(self, pages):
+        """
+        Method to index the existing pages of the Notion database.
+
+        Pages are added or updated. Entries of pages that are no longer in the
+        database are dropped, reserved entries are kept.
+
+        Parameters:
+        pages (async iterable): The pages of the Notion database.
+
+        Returns:
+        int: The number of pages indexed.
+        """
+        semaphore = asyncio.Semaphore(DEDUP_REBUILD_PARALLEL)
+
+        async def index_page(page):
+            async with semaphore:
+                keys = await page_keys(page)
+            self.add(keys, page["id"], page.get("url"))
+
+        seen = set()
+        batch = []
+        async for page in pages:
+            if page.get("archived"):
+                continue
+            seen.add(page["id"])
+            batch.append(index_page(page))
+            if len(batch) >= 100:
+                await asyncio.gather(*batch)
+                batch = []
+        await asyncio.gather(*batch)
+
+        stale = [(kind, key) for (kind, key), (page_id, _) in self.entries.items()
+                 if page_id is not None and page_id not in seen]
+        with self.lock:
+            self.db.executemany("DELETE FROM notes WHERE kind = ? AND key = ?", stale)
+        for kind, key in stale:
+            self._forget(kind, key)
+        return len(seen)
+
+    def get_stats(self):
+        """
+        Method to count the entries of the index by kind.
+
+        Returns:
+        dict: The number of entries of each kind.
+        """
+        stats = {}
+        for kind, _ in self.entries:
+            stats[kind] = stats.get(kind, 0) + 1
+        return stats
+
+
+def plain_text(prop):
+    """
+    Function to get the text of a Notion title or rich text property.
+    """
+    items = (prop or {}).get("title") or (prop or {}).get("rich_text") or []
+    return "".join(item.get("plain_text") or item.get("text", {}).get("content", "") for item in items)
+
+
+async def load_image_hash(url):
+    """
+    Function to compute the perceptual hash of an image served by the file server.
+
+    The stored file is read directly if it is on this machine, otherwise it is downloaded.
+
+    Parameters:
+    url (str): The link of the image.
+
+    Returns:
+    int: The hash, or None if the image cannot be read.
+    """
+    path = os.path.join(FILES_DIR, os.path.basename(url))
+    try:
+        if os.path.exists(path):
+            return await asyncio.to_thread(image_hash, path)
+        res = await get_http_client().get(url)
+        res.raise_for_status()
+        return await asyncio.to_thread(image_hash, io.BytesIO(res.content))
+    except Exception as err:
+        log_error("dedup_hash", err, url=url)
+        return None
+
+
+async def page_keys(page):
+    """
+    Function to build the index keys of an existing Notion page.
+
+    Images are hashed only if they were uploaded to the file server, i.e. the note
+    was a photo. Their title is a generated description and is not indexed.
+
+    Parameters:
+    page (dict): The Notion page.
+
+    Returns:
+    list: Pairs of kind and key.
+    """
+    properties = page.get("properties", {})
+    link = (properties.get("link") or {}).get("url") or ""
+    urls = [url for url in link.split() if url]
+
+    image = None
+    for item in (properties.get("image") or {}).get("files", []):
+        url = (item.get("external") or item.get("file") or {}).get("url", "")
+        if FILESERVER and url.startswith(FILESERVER):
+            image = await load_image_hash(url)
+            break
+
+    text = None if image is not None else plain_text(properties.get("mytext"))
+    return note_keys(text=text, urls=urls, image=image)
+
+
+# The index shared by every handler, loaded on first use
+_index = None
+
+def get_dedup_index():
+    """
+    Function to get the index of saved notes.
+
+    Returns:
+    DedupIndex: The shared index.
+    """
+    global _index
+    if _index is None:
+        _index = DedupIndex(os.path.join(CACHE_DIR, "dedup.sqlite"))
+    return _index
+
+
+async def rebuild_index():
+    """
+    Function to rebuild the index from the Notion database.
+    """
+    from utils.http_client import close_http_client
+    from utils.notion_api import iter_database_pages
+
+    index = get_dedup_index()
+    start = time.perf_counter()
+    try:
+        count = await index.rebuild(iter_database_pages())
+    finally:
+        await close_http_client()
+    print("Indexed {} pages in {:.1f}s: {}".format(count, time.perf_counter() - start, index.get_stats()))
+
+
+if __name__ == "__main__":
+    # Stop the bot while rebuilding, it loads the index when it starts
+    parser = argparse.ArgumentParser(description="Index of saved notes used to catch duplicates.")
+    parser.add_argument("--rebuild", action="store_true", help="Rebuild the index from the Notion database.")
+    args = parser.parse_args()
+    if args.rebuild:
+        asyncio.run(rebuild_index())
+    else:
+        print(get_dedup_index().get_stats())
@@ -0,0 +1,460 @@
+import os
+import re
+import codecs
+from html.parser import HTMLParser
+
+from dotenv import load_dotenv
+
+from utils.lazy import lazy_import, is_installed
+
+# The parsers are loaded on first use or by the warm-up, the faster ones only if installed
+bs4 = lazy_import("bs4")
+lexbor = lazy_import("selectolax.lexbor") if is_installed("selectolax") else None
+lxml_html = lazy_import("lxml.html") if is_installed("lxml") else None
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Parser of the page content: selectolax, lxml or soup, auto picks the fastest one installed
+EXTRACT_ENGINE = os.getenv("EXTRACT_ENGINE", "auto")
+# Largest part of a page that is downloaded and parsed, the rest is cut off
+EXTRACT_MAX_BYTES = int(os.getenv("EXTRACT_MAX_BYTES", 2 * 1024 * 1024))
+# Least text the main block must have, otherwise every block of the page is used
+EXTRACT_MIN_CHARS = int(os.getenv("EXTRACT_MIN_CHARS", 250))
+
+# Number of bytes looked at to tell what a download is
+SNIFF_BYTES = 1024
+HTML_MIME_TYPES = ("text/html", "application/xhtml+xml")
+HTML_SIGNATURES = (b"<!doctype html", b"<html", b"<head", b"<body", b"<!--", b"<meta", b"<title", b"<p", b"<div")
+# Size of the pieces the meta tags are read from, reading stops at the end of the head
+META_CHUNK = 8192
+
+# Elements that are never part of the content
+NOISE_TAGS = ('script', 'style', 'noscript', 'template', 'svg', 'iframe', 'nav', 'footer', 'aside')
+# Elements whose text is scored, and elements whose text forms a block of the content
+PARAGRAPH_TAGS = ('p', 'pre', 'td', 'blockquote')
+BLOCK_TAGS = ('p', 'pre', 'blockquote', 'li', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'td', 'th', 'dd', 'dt',
+              'figcaption', 'div', 'section', 'article', 'main')
+# Starting score of a candidate by its tag, as in Readability
+TAG_SCORES = {'div': 5, 'article': 5, 'main': 5, 'pre': 3, 'td': 3, 'blockquote': 3, 'address': -3, 'ol': -3,
+              'ul': -3, 'dl': -3, 'dd': -3, 'dt': -3, 'li': -3, 'form': -3, 'h1': -5, 'h2': -5, 'h3': -5,
+              'h4': -5, 'h5': -5, 'h6': -5, 'th': -5}
+# Class and ID names that make a candidate more or less likely to be the content
+POSITIVE_NAMES = re.compile(r'article|body|content|entry|hentry|main|page|post|text|blog|story', re.I)
+NEGATIVE_NAMES = re.compile(r'comment|contact|footer|footnote|masthead|media|meta|promo|related|share|sidebar|'
+                            r'sponsor|shopping|tags|tool|widget|nav|menu|banner|breadcrumb|cookie|popup', re.I)
+# Class and ID names of comment sections, menus and other parts that are left out, unless they may be content
+UNLIKELY_NAMES = re.compile(r'-ad-|banner|breadcrumbs|combx|comment|community|disqus|extra|footer|gdpr|header|'
+                            r'legends|menu|related|remark|replies|rss|shoutbox|sidebar|skyscraper|social|sponsor|'
+                            r'supplemental|agegate|pagination|pager|popup', re.I)
+MAYBE_NAMES = re.compile(r'and|article|body|column|content|main|shadow', re.I)
+WHITESPACE = re.compile(r'\s+')
+
+
+def sniff_content(content_type, head):
+    """
+    Function to tell from its Content-Type and first bytes whether a download is a web page.
+
+    Parameters:
+    content_type (str): The Content-Type header, empty if there is none.
+    head (bytes): The first bytes of the download.
+
+    Returns:
+    str: "html" for a web page, "text" for plain text, or None for anything else.
+    """
+    mime = content_type.split(";")[0].strip().lower()
+    if mime in HTML_MIME_TYPES:
+        return "html"
+    if mime and mime not in ("text/plain", "application/octet-stream"):
+        return None
+    # Servers often send pages without a type or as plain text
+    start = head[:SNIFF_BYTES].lstrip(b"\xef\xbb\xbf \t\r\n").lower()
+    if start.startswith(HTML_SIGNATURES):
+        return "html"
+    return "text" if mime == "text/plain" else None
+
+
+class MetaReader(HTMLParser):
+    """
+    Parser that reads the description and image meta tags of a page, done at the end of the head.
+    """
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.description = None
+        self.og_description = None
+        self.image = ""
+        self.done = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "meta":
+            attrs = dict(attrs)
+            name = (attrs.get("name") or attrs.get("property") or "").lower()
+            content = attrs.get("content")
+            if name == "description" and content and self.description is None:
+                self.description = content
+            elif name == "og:description" and content and self.og_description is None:
+                self.og_description = content
+            elif name == "og:image" and content and not self.image:
+                self.image = content
+            self.done = self.done or (self.description is not None and bool(self.image))
+        elif tag == "body":
+            self.done = True
+
+    def handle_endtag(self, tag):
+        if tag == "head":
+            self.done = True
+
+
+def read_meta(html):
+    """
+    Function to read the description and the main image of a page from its meta tags.
+
+    Only the head of the page is read, in pieces, so the rest of a large page is never scanned.
+
+    Parameters:
+    html (bytes): The HTML content of the page.
+
+    Returns:
+    tuple: A tuple containing the description, None if there is none, and the image URL, empty if there is none.
+    """
+    reader = MetaReader()
+    decoder = codecs.getincrementaldecoder("utf-8")("replace")
+    for start in range(0, len(html), META_CHUNK):
+        reader.feed(decoder.decode(html[start:start + META_CHUNK]))
+        if reader.done:
+            break
+    return reader.description or reader.og_description, reader.image
+
+
+class SoupEngine:
+    """
+    Pure-Python engine on BeautifulSoup with the html.parser backend, always available.
+    """
+    name = "soup"
+    available = True
+
+    def parse(self, html):
+        soup = bs4.BeautifulSoup(html, "html.parser")
+        for tag in soup.find_all(NOISE_TAGS):
+            tag.decompose()
+        return soup
+
+    def find_all(self, node, tags):
+        return node.find_all(tags)
+
+    def text(self, node):
+        return node.get_text()
+
+    def children(self, node):
+        for child in node.children:
+            # Comments, doctypes and the like are strings too
+            if isinstance(child, bs4.element.Tag):
+                yield child
+            elif not isinstance(child, bs4.element.PreformattedString):
+                yield str(child)
+
+    def parent(self, node):
+        return node.parent
+
+    def tag(self, node):
+        return node.name
+
+    def names(self, node):
+        return " ".join(node.get("class") or ()) + " " + (node.get("id") or "")
+
+    def key(self, node):
+        # Tags compare equal when their markup is, so they are told apart by identity
+        return id(node)
+
+
+class LxmlEngine:
+    """
+    Engine on lxml's C parser.
+    """
+    name = "lxml"
+    available = lxml_html is not None
+
+    def parse(self, html):
+        try:
+            root = lxml_html.document_fromstring(html)
+        except lxml_html.etree.ParserError:
+            # A page without any element
+            return None
+        for element in list(root.iter(*NOISE_TAGS)):
+            element.drop_tree()
+        return root
+
+    def find_all(self, node, tags):
+        return node.iterdescendants(*tags)
+
+    def text(self, node):
+        return node.text_content()
+
+    def children(self, node):
+        if node.text:
+            yield node.text
+        for child in node:
+            # Comments have a function as their tag
+            if isinstance(child.tag, str):
+                yield child
+            if child.tail:
+                yield child.tail
+
+    def parent(self, node):
+        return node.getparent()
+
+    def tag(self, node):
+        return node.tag
+
+    def names(self, node):
+        return (node.get("class") or "") + " " + (node.get("id") or "")
+
+    def key(self, node):
+        # lxml hands out the same proxy for an element while a reference to it is kept
+        return node
+
+
+class SelectolaxEngine:
+    """
+    Engine on selectolax with the lexbor HTML5 parser, the fastest.
+    """
+    name = "selectolax"
+    available = lexbor is not None
+
+    def parse(self, html):
+        # Bytes are read as UTF-8, pages in other encodings are decoded by their declared charset first
+        try:
+            codecs.getincrementaldecoder("utf-8")().decode(html)
+        except UnicodeDecodeError:
+            html = bs4.UnicodeDammit(html, is_html=True).unicode_markup
+        tree = lexbor.LexborHTMLParser(html)
+        tree.strip_tags(list(NOISE_TAGS))
+        return tree.root
+
+    def find_all(self, node, tags):
+        # Selectors match the node itself too
+        return [match for match in node.css(", ".join(tags)) if match.mem_id != node.mem_id]
+
+    def text(self, node):
+        return node.text()
+
+    def children(self, node):
+        for child in node.iter(include_text=True):
+            if child.tag == "-text":
+                yield child.text_content
+            elif not child.tag.startswith("-"):
+                yield child
+
+    def parent(self, node):
+        return node.parent
+
+    def tag(self, node):
+        return node.tag
+
+    def names(self, node):
+        attributes = node.attributes
+        return (attributes.get("class") or "") + " " + (attributes.get("id") or "")
+
+    def key(self, node):
+        return node.mem_id
+
+
+ENGINES = {engine.name: engine for engine in (SelectolaxEngine(), LxmlEngine(), SoupEngine())}
+
+
+def get_engine(name=EXTRACT_ENGINE):
+    """
+    Function to get an extraction engine.
+
+    Parameters:
+    name (str, optional): selectolax, lxml, soup, or auto for the fastest one installed. Defaults to EXTRACT_ENGINE.
+
+    Returns:
+    engine: The engine.
+    """
+    if name == "auto":
+        return next(engine for engine in ENGINES.values() if engine.available)
+    engine = ENGINES.get(name)
+    if engine is None or not engine.available:
+        raise ValueError("Extraction engine {!r} is not available".format(name))
+    return engine
+
+
+def link_density(engine, node, text):
+    """
+    Function to get the share of the text of an element that is in links.
+    """
+    if not text:
+        return 1.0
+    return sum(len(engine.text(link)) for link in engine.find_all(node, ('a',))) / len(text)
+
+
+def is_boilerplate(engine, node, memo):
+    """
+    Function to check whether an element is in a comment section, a menu or another part of the page that is left out.
+
+    Parameters:
+    engine (engine): The engine the page was parsed with.
+    node (element): The element.
+    memo (dict): The answers for elements checked before, shared by the checks of one page.
+
+    Returns:
+    bool: Whether the element or one of its ancestors is named like boilerplate.
+    """
+    chain = []
+    result = False
+    while node is not None:
+        key = engine.key(node)
+        if key in memo:
+            result = memo[key]
+            break
+        chain.append(key)
+        if engine.tag(node) not in ('html', 'body', 'article', 'main'):
+            names = engine.names(node)
+            if UNLIKELY_NAMES.search(names) and not MAYBE_NAMES.search(names):
+                result = True
+                break
+        node = engine.parent(node)
+    for key in chain:
+        memo[key] = result
+    return result
+
+
+def find_main_block(engine, root, memo=None):
+    """
+    Function to pick the element that holds the main content of a page, Readability-style.
+
+    Every paragraph with some text scores for its parent, and half as much for its
+    grandparent: more for long text with many commas. The parents start from a score
+    for their tag and class and ID names, and lose the share of their text in links.
+    Paragraphs in boilerplate, e.g. the many short paragraphs of a comment section,
+    do not score.
+
+    Parameters:
+    engine (engine): The engine the page was parsed with.
+    root (element): The parsed page.
+    memo (dict, optional): The boilerplate checks of the page, see is_boilerplate. Defaults to a new one.
+
+    Returns:
+    element: The best scoring element, or None if no paragraph has enough text.
+    """
+    memo = {} if memo is None else memo
+    candidates = {}
+    for paragraph in engine.find_all(root, PARAGRAPH_TAGS):
+        text = engine.text(paragraph).strip()
+        if len(text) < 25 or is_boilerplate(engine, paragraph, memo):
+            continue
+        score = 1 + text.count(",") + min(len(text) // 100, 3)
+        ancestor = engine.parent(paragraph)
+        for share in (1, 0.5):
+            if ancestor is None:
+                break
+            key = engine.key(ancestor)
+            if key not in candidates:
+                names = engine.names(ancestor)
+                initial = TAG_SCORES.get(engine.tag(ancestor), 0)
+                initial += 25 * bool(POSITIVE_NAMES.search(names)) - 25 * bool(NEGATIVE_NAMES.search(names))
+                candidates[key] = [ancestor, initial]
+            candidates[key][1] += score * share
+            ancestor = engine.parent(ancestor)
+
+    best = None
+    best_score = 0
+    for node, score in candidates.values():
+        score *= 1 - link_density(engine, node, engine.text(node))
+        if score > best_score:
+            best, best_score = node, score
+    return best
+
+
+def iter_blocks(engine, node, memo=None):
+    """
+    Generator to get the text blocks under an element, each piece of text only once.
+
+    Only the innermost block elements are used whole, so nested containers do not
+    repeat the text of their children. The text a container holds besides its
+    blocks forms blocks of its own, split where the blocks are, e.g. "Intro", "x"
+    and "after" for <div>Intro <p>x</p> after</div>. Blocks in boilerplate and
+    exact repeats are dropped.
+
+    Parameters:
+    engine (engine): The engine the page was parsed with.
+    node (element): The element.
+    memo (dict, optional): The boilerplate checks of the page, see is_boilerplate. Defaults to a new one.
+
+    Yields:
+    str: The whitespace-normalized text of each block, in document order.
+    """
+    blocks = list(engine.find_all(node, BLOCK_TAGS))
+    # Mark every element with a block inside it, each ancestor chain is walked once
+    containers = set()
+    stop = engine.key(node)
+    for block in blocks:
+        parent = engine.parent(block)
+        while parent is not None:
+            key = engine.key(parent)
+            if key in containers or key == stop:
+                break
+            containers.add(key)
+            parent = engine.parent(parent)
+
+    memo = {} if memo is None else memo
+    seen = set()
+    run = []
+
+    def flush():
+        text = WHITESPACE.sub(" ", "".join(run)).strip()
+        run.clear()
+        if text and text not in seen:
+            seen.add(text)
+            yield text
+
+    def walk(parent, loose):
+        # Only the children of containers are visited, other elements are taken whole
+        for child in engine.children(parent):
+            if isinstance(child, str):
+                if loose:
+                    run.append(child)
+            elif engine.tag(child) not in BLOCK_TAGS:
+                if engine.key(child) in containers:
+                    yield from walk(child, loose)
+                elif loose:
+                    run.append(engine.text(child))
+            else:
+                yield from flush()
+                if is_boilerplate(engine, child, memo):
+                    continue
+                if engine.key(child) in containers:
+                    yield from walk(child, True)
+                else:
+                    run.append(engine.text(child))
+                yield from flush()
+
+    # Text outside any block, e.g. in the body of the page, is only used within a block
+    yield from walk(node, engine.tag(node) in BLOCK_TAGS)
+    yield from flush()
+
+
+def extract_main_text(html, engine=None):
+    """
+    Function to get the text blocks of the main content of a page.
+
+    Parameters:
+    html (bytes): The HTML content of the page.
+    engine (engine, optional): The engine to parse with. Defaults to the one of get_engine.
+
+    Returns:
+    list: The text blocks of the main block, or of the whole page if the main block has too little text.
+    """
+    if not html.strip():
+        return []
+    engine = engine or get_engine()
+    root = engine.parse(html)
+    if root is None:
+        return []
+    memo = {}
+    main = find_main_block(engine, root, memo)
+    blocks = list(iter_blocks(engine, main, memo)) if main is not None else []
+    if sum(len(block) for block in blocks) < EXTRACT_MIN_CHARS:
+        blocks = list(iter_blocks(engine, root, memo))
+    return blocks
@@ -1,16 +1,34 @@
 import os
-import google.generativeai as genai
+import json
+import asyncio
 
 from dotenv import load_dotenv
 
+from utils.cache import TieredCache, cache_key
+from utils.helpers import chunk_text, estimate_tokens, CHARS_PER_TOKEN
+from utils.lazy import lazy_import
+from utils.messages import CHUNK_SUMMARY, IMAGE_PROMPT
+from utils.metrics import trace
+from utils.openai_api import openai_generate, openai_describe, OPENAI_API_KEY
+from utils.router import Provider, ProviderRouter, ROUTER_PROVIDERS
+
 # Load environment variables from .env file
 load_dotenv()
 
 # Get the Google API key from environment variables
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 
-# Configure the Google Generative AI with the API key
-genai.configure(api_key=GOOGLE_API_KEY)
+# Size of the cache of model responses
+LLM_CACHE_MAX_ITEMS = int(os.getenv("LLM_CACHE_MAX_ITEMS", 1024))
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+
+# Token budget of a prompt, longer texts are summarized in chunks first
+SUMMARY_MAX_INPUT_TOKENS = int(os.getenv("SUMMARY_MAX_INPUT_TOKENS", 8000))
+SUMMARY_CHUNK_TOKENS = int(os.getenv("SUMMARY_CHUNK_TOKENS", 3000))
+SUMMARY_MAX_PARALLEL = int(os.getenv("SUMMARY_MAX_PARALLEL", 4))
+
+# The SDK takes about a second to import, it is loaded on first use or by the warm-up
+genai = lazy_import("google.generativeai")
 
 # Define the configuration for the generative model
 generation_config = {
@@ -20,49 +38,189 @@ generation_config = {
     "max_output_tokens": 8192,
 }
 
-def handle_gemini_model(input_text):
+# Names of the text and vision models
+TEXT_MODEL = os.getenv("GEMINI_TEXT_MODEL", 'gemini-pro')
+VISION_MODEL = os.getenv("GEMINI_VISION_MODEL", 'gemini-pro-vision')
+
+# Whether the text model supports JSON mode (gemini-1.5 and later)
+GEMINI_JSON_MODE = os.getenv("GEMINI_JSON_MODE", "").lower() in ("1", "true", "yes")
+
+# Configuration of requests that must be answered with JSON
+json_generation_config = dict(generation_config, response_mime_type="application/json")
+
+# Long-lived model objects, created once and shared by every handler
+_models = {}
+_configured = False
+
+def get_gemini_model(model_name):
+    """
+    Function to get the shared model object for a model name.
+
+    The SDK reuses one client connection for all models, so after the first call
+    a message pays neither for building the model nor for a new handshake.
+
+    Parameters:
+    model_name (str): The name of the model.
+
+    Returns:
+    GenerativeModel: The shared model object.
+    """
+    global _configured
+    model = _models.get(model_name)
+    if model is None:
+        # Configure the Google Generative AI with the API key, when the SDK is first needed
+        if not _configured:
+            genai.configure(api_key=GOOGLE_API_KEY)
+            _configured = True
+        config = generation_config if model_name == TEXT_MODEL else None
+        model = genai.GenerativeModel(model_name, generation_config=config)
+        _models[model_name] = model
+    return model
+
+# The cache of model responses, opened on first use
+_llm_cache = None
+
+def get_llm_cache():
+    """
+    Function to get the cache of model responses.
+
+    Returns:
+    TieredCache: The response cache.
     """
-    Function to handle the Gemini model.
+    global _llm_cache
+    if _llm_cache is None:
+        _llm_cache = TieredCache("llm", LLM_CACHE_MAX_ITEMS, LLM_CACHE_MAX_BYTES)
+    return _llm_cache
+
+async def gemini_generate(input_text, json_mode=False):
+    """
+    Function to send a single message to the Gemini text model.
 
     Parameters:
     input_text (str): The input text to be processed by the model.
+    json_mode (bool, optional): Whether to ask for a JSON reply, if the model supports it. Defaults to False.
 
     Returns:
     str: The text generated by the model.
     """
-    # Initialize the generative model with the 'gemini-pro' model and the defined configuration
-    model = genai.GenerativeModel('gemini-pro', generation_config=generation_config)
+    config = json_generation_config if json_mode and GEMINI_JSON_MODE else generation_config
 
-    # Start a chat with the model
-    chat = model.start_chat(history=[])
+    # Send the input text to the shared text model and get the response.
+    # A single message without history needs no chat session.
+    async with trace("gemini", model=TEXT_MODEL, prompt_chars=len(input_text)):
+        response = await get_gemini_model(TEXT_MODEL).generate_content_async(input_text, generation_config=config)
+    return response.text
 
-    # Send the input text to the model and get the response
-    response = chat.send_message(input_text)
+async def gemini_describe(image):
+    """
+    Function to transcribe or describe an image with the Gemini vision model.
 
-    # Return the text generated by the model
+    Parameters:
+    image (Image or dict): The image to be processed by the model, or a dict with its MIME type and encoded data.
+
+    Returns:
+    str: The text generated by the model.
+    """
+    # Generate content with the shared vision model using the defined prompt and the image
+    async with trace("gemini_image", model=VISION_MODEL):
+        response = await get_gemini_model(VISION_MODEL).generate_content_async(contents=[IMAGE_PROMPT, image])
+
+        # Resolve the response
+        await response.resolve()
     return response.text
 
-def handle_gemini_image(image):
+# The router shared by every handler, created on first use
+_router = None
+
+def get_model_router():
     """
-    Function to handle the Gemini image model.
+    Function to get the router that sends the model calls to the providers of ROUTER_PROVIDERS.
+
+    A provider is only used if its API key is set.
+
+    Returns:
+    ProviderRouter: The shared router.
+    """
+    global _router
+    if _router is None:
+        providers = []
+        for name in ROUTER_PROVIDERS.split(","):
+            name = name.strip()
+            if name == "gemini" and GOOGLE_API_KEY:
+                providers.append(Provider("gemini", {"text": gemini_generate, "image": gemini_describe}))
+            elif name == "openai" and OPENAI_API_KEY:
+                providers.append(Provider("openai", {"text": openai_generate, "image": openai_describe}))
+        _router = ProviderRouter(providers)
+    return _router
+
+async def handle_gemini_model(input_text, use_cache=True, json_mode=False):
+    """
+    Function to handle the text model, Gemini unless it is failing or slow and another provider is set up.
+
+    Responses of Gemini are cached by model, generation config and prompt, so the
+    same text sent twice only reaches the model once. Answers of another provider
+    are not cached, the key is Gemini's.
 
     Parameters:
-    image (Image): The image to be processed by the model.
+    input_text (str): The input text to be processed by the model.
+    use_cache (bool, optional): Whether to look up and store the response in the cache. Defaults to True.
+    json_mode (bool, optional): Whether to ask for a JSON reply, if the model supports it. Defaults to False.
 
     Returns:
     str: The text generated by the model.
     """
-    # Define the prompt for the model
-    prompt = "If image have text, transcribe it, otherwise describe it."
+    config = json_generation_config if json_mode and GEMINI_JSON_MODE else generation_config
+    key = cache_key(TEXT_MODEL, json.dumps(config, sort_keys=True), input_text)
+    if use_cache:
+        cached = get_llm_cache().get(key)
+        if cached is not None:
+            return cached
 
-    # Initialize the generative model with the 'gemini-pro-vision' model
-    model = genai.GenerativeModel('gemini-pro-vision')
+    provider, text = await get_model_router().call_with_provider("text", input_text, json_mode)
 
-    # Generate content with the model using the defined prompt and the image
-    response = model.generate_content(contents=[prompt, image])
+    # Return the text generated by the model
+    if use_cache and provider == "gemini":
+        get_llm_cache().set(key, text)
+    return text
 
-    # Resolve the response
-    response.resolve()
+async def condense_text(text):
+    """
+    Function to shrink a text to the prompt token budget with map-reduce summarization.
 
-    # Return the text generated by the model
-    return response.text
\ No newline at end of file
+    Texts within the budget are returned unchanged. Longer texts are split into chunks
+    that are summarized in parallel, and the summaries, in order, replace the text.
+    This repeats until the text fits, so the final prompt stays bounded for any length
+    of page or transcript.
+
+    Parameters:
+    text (str): The text to condense.
+
+    Returns:
+    str: The text, or the merged summaries of its chunks.
+    """
+    semaphore = asyncio.Semaphore(SUMMARY_MAX_PARALLEL)
+
+    async def summarize(chunk):
+        async with semaphore:
+            return await handle_gemini_model(CHUNK_SUMMARY + chunk)
+
+    while estimate_tokens(text) > SUMMARY_MAX_INPUT_TOKENS:
+        summaries = await asyncio.gather(*(summarize(chunk) for chunk in chunk_text(text, SUMMARY_CHUNK_TOKENS)))
+        condensed = "\n".join(summaries)
+        # Stop if the model does not make the text any shorter
+        if len(condensed) >= len(text):
+            return condensed[:SUMMARY_MAX_INPUT_TOKENS * CHARS_PER_TOKEN]
+        text = condensed
+    return text
+
+async def handle_gemini_image(image):
+    """
+    Function to handle the image model, Gemini unless it is failing or slow and another provider is set up.
+
+    Parameters:
+    image (Image or dict): The image to be processed by the model, or a dict with its MIME type and encoded data.
+
+    Returns:
+    str: The text generated by the model.
+    """
+    return await get_model_router().call("image", image)
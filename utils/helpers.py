@@ -1,90 +1,215 @@
+import os
 import re
-from html.parser import HTMLParser
-import requests
-from bs4 import BeautifulSoup
-
-class MyHTMLParser(HTMLParser):
+import time
+import asyncio
+from html import escape
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from dotenv import load_dotenv
+
+from utils.cache import DiskCache, cache_key
+from utils.extract import EXTRACT_MAX_BYTES, SNIFF_BYTES, sniff_content, read_meta, extract_main_text
+from utils.http_client import get_http_client
+from utils.metrics import trace, log_error
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Limits for fetching the links of a message
+FETCH_MAX_CONCURRENCY = int(os.getenv("FETCH_MAX_CONCURRENCY", 10))
+FETCH_MAX_PER_HOST = int(os.getenv("FETCH_MAX_PER_HOST", 2))
+FETCH_TIMEOUT = float(os.getenv("FETCH_TIMEOUT", 10))
+
+# Settings of the page extraction cache
+PAGE_CACHE_TTL = int(os.getenv("PAGE_CACHE_TTL", 24 * 3600))
+PAGE_CACHE_MAX_BYTES = int(os.getenv("PAGE_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+
+# Rough number of characters per model token, used to budget prompts
+CHARS_PER_TOKEN = 4
+
+# Patterns of the markdown renderer, compiled once
+INLINE_TOKEN = re.compile(r'\*\*|\*|`[^`\n]+`|\[([^\]\n]*)\]\(([^)\s]+)\)')
+FENCE_LANGUAGE = re.compile(r'\w*')
+HEADING = re.compile(r'(#+)(.*)')
+BULLET = re.compile(r'\*\s+')
+NON_ASCII = re.compile(r'[^\x00-\x7F]+')
+
+# Query parameters that only track where a link was shared
+TRACKING_PARAMS = ("utm_", "fbclid", "gclid", "yclid", "mc_cid", "mc_eid", "igshid", "ref_src")
+
+class FetchLimiter:
     """
-    Custom HTML Parser class that extends the built-in HTMLParser class.
-    This class is used to parse HTML content.
+    Caps the number of page fetches in flight, both overall and per host.
     """
-    def __init__(self):
-        super().__init__()
-        self.stack = []
-
-    def handle_starttag(self, tag, attrs):
+    def __init__(self, max_total, max_per_host):
+        self.total = asyncio.Semaphore(max_total)
+        self.max_per_host = max_per_host
+        self.hosts = {}
+        self.users = {}
+
+    @asynccontextmanager
+    async def limit(self, host):
         """
-        Method to handle start tags. It adds the tag to the stack.
+        Method to hold a fetch slot for a host. Idle hosts are forgotten, so the
+        per-host table only holds hosts that are currently being fetched.
         """
-        self.stack.append(tag)
+        semaphore = self.hosts.setdefault(host, asyncio.Semaphore(self.max_per_host))
+        self.users[host] = self.users.get(host, 0) + 1
+        try:
+            async with semaphore, self.total:
+                yield
+        finally:
+            self.users[host] -= 1
+            if not self.users[host]:
+                del self.users[host]
+                del self.hosts[host]
+
+# The limiter shared by every message, bound to the running event loop
+_limiter = None
+_limiter_loop = None
+
+def get_fetch_limiter():
+    """
+    Function to get the fetch limiter of the running event loop.
 
-    def handle_endtag(self, tag):
-        """
-        Method to handle end tags. It removes the tag from the stack.
-        """
-        if self.stack and self.stack[-1] == tag:
-            self.stack.pop()
+    Returns:
+    FetchLimiter: The shared limiter.
+    """
+    global _limiter, _limiter_loop
+    loop = asyncio.get_running_loop()
+    if _limiter is None or _limiter_loop is not loop:
+        _limiter = FetchLimiter(FETCH_MAX_CONCURRENCY, FETCH_MAX_PER_HOST)
+        _limiter_loop = loop
+    return _limiter
+
+# The page cache, opened on first use
+_page_cache = None
+
+def get_page_cache():
+    """
+    Function to get the cache of page extraction results.
+
+    Returns:
+    DiskCache: The page cache.
+    """
+    global _page_cache
+    if _page_cache is None:
+        _page_cache = DiskCache("pages", PAGE_CACHE_MAX_BYTES)
+    return _page_cache
+
+def render_inline(text):
+    """
+    Function to render the inline markdown of one line as Telegram HTML.
+
+    Handles **bold**, *italic*, `code` and [links](url) in a single scan and escapes
+    everything else. Emphasis markers are paired in order, an unpaired one is kept
+    as text, and overlapping emphasis is closed and reopened so the tags nest.
+
+    Parameters:
+    text (str): The line to render.
+
+    Returns:
+    str: The rendered line.
+    """
+    tokens = list(INLINE_TOKEN.finditer(text))
+
+    # Count the markers that have a partner on this line
+    usable = {"**": 0, "*": 0}
+    for token in tokens:
+        if token.group() in usable:
+            usable[token.group()] += 1
+    usable = {marker: count - count % 2 for marker, count in usable.items()}
+
+    out = []
+    stack = []
+    pos = 0
+    for token in tokens:
+        out.append(escape(text[pos:token.start()], quote=False))
+        pos = token.end()
+        marker = token.group()
+        if marker in usable:
+            if not usable[marker]:
+                out.append(marker)
+                continue
+            usable[marker] -= 1
+            tag = 'b' if marker == "**" else 'i'
+            if tag not in stack:
+                stack.append(tag)
+                out.append('<{}>'.format(tag))
+                continue
+            # Close the tags opened inside this one, then open them again after it
+            reopen = []
+            while stack[-1] != tag:
+                reopen.append(stack.pop())
+                out.append('</{}>'.format(reopen[-1]))
+            stack.pop()
+            out.append('</{}>'.format(tag))
+            for inner in reversed(reopen):
+                stack.append(inner)
+                out.append('<{}>'.format(inner))
+        elif marker.startswith('`'):
+            out.append('<code>{}</code>'.format(escape(marker[1:-1], quote=False)))
+        else:
+            out.append('<a href="{}">{}</a>'.format(escape(token.group(2)), escape(token.group(1), quote=False)))
+    out.append(escape(text[pos:], quote=False))
+    while stack:
+        out.append('</{}>'.format(stack.pop()))
+    return "".join(out)
+
+def render_line(line):
+    """
+    Function to render one line of markdown outside code blocks as Telegram HTML.
+
+    Parameters:
+    line (str): The line to render.
+
+    Returns:
+    str: The rendered line.
+    """
+    heading = HEADING.match(line)
+    if heading:
+        title = render_inline(heading.group(2).strip().upper())
+        # Top-level headings are bold, the others are only uppercased
+        return '<b>{}</b>'.format(title) if len(heading.group(1)) == 1 else title
+    bullet = BULLET.match(line)
+    if bullet:
+        return '- ' + render_inline(line[bullet.end():])
+    return render_inline(line)
 
 def format_text_to_html(text):
     """
     Function to format markdown text to HTML.
 
+    The text is rendered in one pass: it is split on code fences, code blocks are
+    escaped into pre tags, and every other line is rendered on its own, so the
+    output is valid Telegram HTML with properly nested tags.
+
     Parameters:
     text (str): The text to be formatted.
 
     Returns:
     str: The formatted text.
     """
-    # Replace markdown syntax with HTML tags
-    text = re.sub(r'\*\*(.*?)\*\*', r'<b>\1</b>', text)
-    text = re.sub(r'\*(.*?)\*', r'<i>\1</i>', text)
-    text = re.sub(r'^\*(.*)$', r'⚪ \1', text, flags=re.MULTILINE)
-
-    text = re.sub(r'^#{2,}(.*)$', lambda m: '{}'.format(m.group(1).strip().upper()), text, flags=re.MULTILINE)
-    text = re.sub(r'^#(.*)$', lambda m: '<b>{}</b>'.format(m.group(1).strip().upper()), text, flags=re.MULTILINE)
-
-    # Replace markdown code blocks with HTML pre tags
-    # Add more languages as needed
-    language_tags = {
-        'python': '<pre language="python">',
-        'javascript': '<pre language="javascript">',
-        'java': '<pre language="java">',
-    }
-    end_tag = '</pre>'
-
-    # Extract the language from the code block delimiter
-    while '```' in text:
-        # Extract the language from the code block delimiter
-        match = re.search(r'```(\w+)', text)
-        if match:
-            language = match.group(1)
-            if language in language_tags:
-                start_tag = language_tags[language]
-                text = text.replace("```" + language, start_tag, 1)
-                text = text.replace("```", end_tag, 1)
+    out = []
+    # Even segments are regular text, odd segments are code blocks
+    for i, segment in enumerate(text.split('```')):
+        if i % 2:
+            language = FENCE_LANGUAGE.match(segment).group()
+            code = escape(segment[len(language):].strip('\n'), quote=False)
+            if language:
+                out.append('<pre><code class="language-{}">{}</code></pre>'.format(language, code))
             else:
-                text = text.replace("```" + language, '<code>', 1)
-                text = text.replace("```", '</code>', 1)
-        else:
-            text = text.replace("```", '<code>', 1)
-            text = text.replace("```", '</code>', 1)
-
-    # Replace markdown links with HTML a tags
-    text = re.sub(r'\[(.*?)\]\((.*?)\)', r'<a href="\2">\1</a>', text)
-
-    # Parse the text with the custom HTML parser
-    parser = MyHTMLParser()
-    parser.feed(text)
-
-    # Remove unmatched tags
-    if parser.stack:
-        for tag in parser.stack:
-            text = re.sub(r'<{}[^>]*>'.format(tag), '', text)
+                out.append('<pre>{}</pre>'.format(code))
+            continue
+        lines = segment.split('\n')
+        for j, line in enumerate(lines):
+            if j:
+                out.append('\n')
+            # Text right after a closing fence is not at the start of a line
+            out.append(render_inline(line) if i and not j else render_line(line))
 
     # Remove non-ASCII characters
-    text = re.sub(r'[^\x00-\x7F]+', '', text)
-
-    return text
+    return NON_ASCII.sub('', "".join(out))
 
 def find_links_in_text(text):
     """
@@ -104,44 +229,176 @@ def find_links_in_text(text):
 
     return urls
 
-def get_main_text_from_url(url):
+def normalize_url(url):
+    """
+    Function to normalize a URL, so that different spellings of the same link compare equal.
+
+    The scheme and host are lowercased, default ports, fragments, tracking parameters and
+    trailing slashes are dropped and the query parameters are sorted.
+
+    Parameters:
+    url (str): The URL to normalize.
+
+    Returns:
+    str: The normalized URL.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port and (scheme, parts.port) not in (("http", 80), ("https", 443)):
+        host += ":{}".format(parts.port)
+    path = parts.path.rstrip("/") or "/"
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+             if not k.lower().startswith(TRACKING_PARAMS)]
+    return urlunsplit((scheme, host, path, urlencode(sorted(query)), ""))
+
+async def get_main_text_from_url(url):
     """
     Function to get the main text from a URL.
 
+    The page is streamed with the shared async HTTP client, up to EXTRACT_MAX_BYTES and
+    only if it is a web page or text, and parsed in a worker thread, so a slow site or a
+    large page does not block the event loop. Results are cached by normalized URL: fresh
+    entries skip the network, stale entries are revalidated with ETag/Last-Modified and
+    only re-parsed if the page changed.
+
     Parameters:
     url (str): The URL to get the main text from.
 
     Returns:
     tuple: A tuple containing the main text and the main image URL.
     """
+    cache = get_page_cache()
+    key = cache_key(normalize_url(url))
+    entry = cache.get(key, max_age=PAGE_CACHE_TTL)
+
+    # Ask the server whether a stale page changed since it was cached
+    headers = {}
+    if entry is not None:
+        cached, stored_at = entry
+        if time.time() - stored_at < PAGE_CACHE_TTL:
+            return cached["text"], cached["image"]
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+
     # Send a GET request to the URL
-    response = requests.get(url)
+    host = urlsplit(url).netloc.lower()
+    async with trace("fetch", host=host, revalidate=entry is not None) as span:
+        async with get_http_client().stream("GET", url, headers=headers) as response:
+            body, kind = await read_body(response)
+        span.set(status=response.status_code, bytes=len(body), kind=kind)
+    if entry is not None and response.status_code == 304:
+        cache.touch(key)
+        return cached["text"], cached["image"]
+
+    # Parse the page off the event loop
+    async with trace("parse", host=host, bytes=len(body), kind=kind):
+        text, image = await asyncio.to_thread(parse_main_text, body, kind)
+    if response.status_code == 200:
+        cache.set(key, {
+            "text": text,
+            "image": image,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+        })
+    return text, image
+
+async def read_body(response, max_bytes=EXTRACT_MAX_BYTES):
+    """
+    Function to download the body of a response, stopping early if it is not a web page or is too large.
+
+    Parameters:
+    response (Response): The streamed response.
+    max_bytes (int, optional): The most bytes to keep, the rest is not downloaded. Defaults to EXTRACT_MAX_BYTES.
 
-    # Parse the HTML content of the page with BeautifulSoup
-    soup = BeautifulSoup(response.content, 'html.parser')
+    Returns:
+    tuple: A tuple containing the body, cut at max_bytes, and its kind: "html", "text" or None.
+    """
+    content_type = response.headers.get("Content-Type", "")
+    body = bytearray()
+    kind = None
+    async for chunk in response.aiter_bytes():
+        body += chunk
+        if kind is None and len(body) >= SNIFF_BYTES:
+            kind = sniff_content(content_type, bytes(body[:SNIFF_BYTES]))
+            # Images, PDFs and videos are left on the server
+            if kind is None:
+                return b"", None
+        if len(body) >= max_bytes:
+            break
+    if kind is None:
+        kind = sniff_content(content_type, bytes(body))
+    return bytes(body[:max_bytes]), kind
+
+async def fetch_page(url):
+    """
+    Function to fetch a single page within the concurrency limits and the timeout.
 
-    # Find the main text of the page. This will depend on the structure of the webpage.
-    main_text_elements = soup.find_all(['p', 'article', 'section', 'main'])
+    Parameters:
+    url (str): The URL to fetch.
 
-    # Extract the text from the main_text elements
-    main_text = [element.get_text() for element in main_text_elements]
-    main_text = [text for text in main_text if text.strip()]
-    # delete all the empty strings
-    main_text = list(filter(None, main_text))
+    Returns:
+    tuple: A tuple containing the main text and the main image URL, or None if the fetch failed.
+    """
+    async with get_fetch_limiter().limit(urlsplit(url).netloc.lower()):
+        try:
+            return await asyncio.wait_for(get_main_text_from_url(url), FETCH_TIMEOUT)
+        except Exception as err:
+            log_error("fetch_page", err, url=url)
+            return None
+
+async def fetch_pages(urls):
+    """
+    Function to fetch all the links of a message concurrently and merge the results.
 
-    # Find the meta description tag
-    meta_description_tag = soup.find('meta', attrs={'name': 'description'})
-    # Extract the content of the meta description tag
-    meta_description = meta_description_tag['content'] if meta_description_tag else None
+    Parameters:
+    urls (list): The URLs to fetch.
 
-    # Find the main image tag
-    main_image_tag = soup.find('meta', attrs={'property': 'og:image'})
-    # Extract the content of the main image tag
-    main_image_url = main_image_tag['content'] if main_image_tag else ""
+    Returns:
+    tuple: A tuple containing the merged text of all pages and the image of the first page that has one.
+    """
+    # Skip repeated links, keeping the order of the message
+    urls = list(dict.fromkeys(urls))
+    pages = await asyncio.gather(*(fetch_page(url) for url in urls))
+
+    content = []
+    image = ""
+    for url, page in zip(urls, pages):
+        if page is None:
+            continue
+        text, page_image = page
+        content.append("URL: {}{}".format(url, text))
+        # The first link of a message is usually the one the note is about
+        if not image and page_image:
+            image = page_image
+
+    return "\n".join(content), image
+
+def parse_main_text(html, kind="html"):
+    """
+    Function to extract the main text and image from an HTML page.
 
-    main_text = "\n".join(main_text)
-    # Clean up the text
-    main_text = re.sub(r'\s+', ' ', main_text).strip()
+    The description and image are read from the meta tags in the head, the text from
+    the block that holds the main content, see utils.extract.
+
+    Parameters:
+    html (bytes): The HTML content of the page.
+    kind (str, optional): What the content is, "html", "text" or None for neither. Defaults to "html".
+
+    Returns:
+    tuple: A tuple containing the main text and the main image URL.
+    """
+    meta_description = None
+    main_image_url = ""
+    if kind == "html":
+        meta_description, main_image_url = read_meta(html)
+        main_text = "\n".join(extract_main_text(html))
+    elif kind == "text":
+        main_text = html.decode("utf-8", "replace")
+    else:
+        main_text = ""
 
     result = """
     META DESCRIPTION: {}
@@ -150,6 +407,56 @@ def get_main_text_from_url(url):
 
     return result, main_image_url
 
+def estimate_tokens(text):
+    """
+    Function to estimate the number of model tokens in a text.
+
+    Parameters:
+    text (str): The text to measure.
+
+    Returns:
+    int: The estimated number of tokens.
+    """
+    return len(text) // CHARS_PER_TOKEN + 1
+
+def chunk_text(text, max_tokens):
+    """
+    Generator to split a text into chunks that fit a token budget.
+
+    Lines are packed together until the budget is reached, lines that are longer
+    than the budget on their own are cut at word boundaries.
+
+    Parameters:
+    text (str): The text to split.
+    max_tokens (int): The maximum estimated number of tokens per chunk.
+
+    Yields:
+    str: The chunks of the text, in order.
+    """
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    chunk = []
+    size = 0
+    for line in text.splitlines():
+        line = line.strip()
+        while len(line) > max_chars:
+            cut = line.rfind(" ", 0, max_chars)
+            if cut <= 0:
+                cut = max_chars
+            if chunk:
+                yield "\n".join(chunk)
+                chunk, size = [], 0
+            yield line[:cut]
+            line = line[cut:].strip()
+        if not line:
+            continue
+        if size + len(line) > max_chars and chunk:
+            yield "\n".join(chunk)
+            chunk, size = [], 0
+        chunk.append(line)
+        size += len(line) + 1
+    if chunk:
+        yield "\n".join(chunk)
+
 def clean_text(text):
     """
     Function to clean a text.
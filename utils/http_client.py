@@ -0,0 +1,47 @@
+import os
+
+import httpx
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Connection pool settings shared by every outgoing HTTP request
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", 100))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", 20))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", 20))
+
+# Identify the bot to the pages it fetches
+USER_AGENT = "Mozilla/5.0 (compatible; NotesAssistant/1.0)"
+
+# The shared client, created on first use
+_client = None
+
+
+def get_http_client():
+    """
+    Function to get the shared async HTTP client.
+
+    The client keeps a pool of open connections, so repeated requests to the same
+    host (Notion, popular sites) skip the TCP and TLS handshakes.
+
+    Returns:
+    httpx.AsyncClient: The shared client.
+    """
+    global _client
+    if _client is None or _client.is_closed:
+        limits = httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                              max_keepalive_connections=HTTP_MAX_KEEPALIVE)
+        _client = httpx.AsyncClient(limits=limits, timeout=HTTP_TIMEOUT, follow_redirects=True,
+                                    headers={"User-Agent": USER_AGENT})
+    return _client
+
+
+async def close_http_client():
+    """
+    Function to close the shared async HTTP client and its open connections.
+    """
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
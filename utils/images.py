@@ -0,0 +1,117 @@
+import os
+import io
+
+from dotenv import load_dotenv
+
+from utils.lazy import lazy_import
+
+# Pillow is loaded on first use or by the warm-up
+Image = lazy_import("PIL.Image")
+ImageOps = lazy_import("PIL.ImageOps")
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Directory served by the file server
+FILES_DIR = "files"
+
+# Largest side of the stored image and of the image sent to the vision model
+IMAGE_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", 1600))
+IMAGE_THUMBNAIL_DIMENSION = int(os.getenv("IMAGE_THUMBNAIL_DIMENSION", 320))
+
+# Format and quality of the stored images, WEBP or JPEG
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "WEBP").upper()
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", 80))
+
+EXTENSIONS = {"WEBP": "webp", "JPEG": "jpg"}
+
+# Size of the grayscale image the perceptual hash is computed from, one column more than rows
+HASH_SIZE = 8
+
+
+def encode_image(img):
+    """
+    Function to compress an image in the configured format.
+
+    Parameters:
+    img (Image): The image to compress.
+
+    Returns:
+    bytes: The compressed image.
+    """
+    out = io.BytesIO()
+    img.save(out, format=IMAGE_FORMAT, quality=IMAGE_QUALITY)
+    return out.getvalue()
+
+
+def process_image(buf, name):
+    """
+    Function to shrink a downloaded image and store it with a thumbnail for the file server.
+
+    The image is decoded once from the download buffer. JPEG photos are decoded
+    directly at a reduced scale, then downscaled to IMAGE_MAX_DIMENSION and
+    compressed. The compressed bytes are written to disk and also returned, so
+    the vision model gets the same small payload.
+
+    This does blocking work, run it in a worker thread.
+
+    Parameters:
+    buf (BytesIO): The downloaded image.
+    name (str): The file name to store the image under, without extension.
+
+    Returns:
+    tuple: A tuple containing the compressed image, its MIME type and its file name.
+    """
+    img = Image.open(buf)
+    # Let the JPEG decoder skip detail that would be thrown away anyway
+    img.draft("RGB", (IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION))
+    img = ImageOps.exif_transpose(img)
+    if img.mode not in ("RGB", "RGBA") or IMAGE_FORMAT == "JPEG":
+        img = img.convert("RGB")
+    img.thumbnail((IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION), Image.LANCZOS)
+
+    extension = EXTENSIONS.get(IMAGE_FORMAT, IMAGE_FORMAT.lower())
+    filename = "{}.{}".format(name, extension)
+    data = encode_image(img)
+    os.makedirs(FILES_DIR, exist_ok=True)
+    with open(os.path.join(FILES_DIR, filename), "wb") as out_file:
+        out_file.write(data)
+
+    img.thumbnail((IMAGE_THUMBNAIL_DIMENSION, IMAGE_THUMBNAIL_DIMENSION), Image.LANCZOS)
+    with open(os.path.join(FILES_DIR, "{}_thumb.{}".format(name, extension)), "wb") as out_file:
+        out_file.write(encode_image(img))
+
+    return data, Image.MIME[IMAGE_FORMAT], filename
+
+
+def image_hash(buf):
+    """
+    Function to compute the perceptual difference hash (dHash) of an image.
+
+    The image is shrunk to a 9x8 grayscale grid and each bit tells whether a pixel
+    is brighter than its right neighbour. Resized, recompressed or slightly edited
+    copies of an image get hashes that differ in only a few bits.
+
+    This does blocking work, run it in a worker thread.
+
+    Parameters:
+    buf (BytesIO or str): The image or its path. A buffer is rewound afterwards.
+
+    Returns:
+    int: The 64-bit hash.
+    """
+    img = Image.open(buf)
+    # The hash needs only a tiny image, let the JPEG decoder skip nearly everything
+    img.draft("L", (HASH_SIZE * 8, HASH_SIZE * 8))
+    img = ImageOps.exif_transpose(img).convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR)
+    pixels = list(img.getdata())
+    if hasattr(buf, "seek"):
+        buf.seek(0)
+
+    value = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + col]
+            right = pixels[row * (HASH_SIZE + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
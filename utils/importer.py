@@ -0,0 +1,441 @@
+import io
+import os
+import json
+import time
+import shutil
+import sqlite3
+import asyncio
+import logging
+import argparse
+import threading
+from typing import NamedTuple
+from collections import Counter
+
+from dotenv import load_dotenv
+
+from utils.audio import transcribe_voice
+from utils.cache import CACHE_DIR
+from utils.dedup import get_dedup_index, note_keys
+from utils.gemini_api import handle_gemini_image
+from utils.helpers import find_links_in_text, fetch_pages, normalize_url
+from utils.http_client import close_http_client
+from utils.images import process_image, image_hash
+from utils.metrics import trace, log_event, log_error, configure_logging
+from utils.notion_api import prepare_notion_page, get_notion_writer
+from utils.notion_writer import TokenBucket
+from utils.related import record_related_page
+from utils.search import get_search_index
+
+# Load environment variables from .env file
+load_dotenv()
+
+FILESERVER = os.getenv("FILESERVER") or ""
+
+# Number of notes processed at the same time
+IMPORT_WORKERS = int(os.getenv("IMPORT_WORKERS", 4))
+# Notes started per second, keeps the summaries within the rate limit of the model
+IMPORT_RATE = float(os.getenv("IMPORT_RATE", 1))
+# Pages that may wait in the Notion queue before the import pauses, so it runs at the pace of the writer
+IMPORT_MAX_QUEUED = int(os.getenv("IMPORT_MAX_QUEUED", 100))
+# Seconds between progress lines
+IMPORT_PROGRESS_INTERVAL = float(os.getenv("IMPORT_PROGRESS_INTERVAL", 10))
+
+# Statuses of an item that are not processed again when the import is resumed
+FINISHED = ("queued", "done", "duplicate", "skipped")
+
+
+class ImportItem(NamedTuple):
+    """
+    A note to import: a text with its links, a photo or a voice recording.
+    """
+    key: str
+    kind: str
+    text: str = ""
+    links: tuple = ()
+    path: str = ""
+    duration: float = 0.0
+
+
+def message_text(message):
+    """
+    Function to get the text of a message of a Telegram export and the targets of its text links.
+
+    Parameters:
+    message (dict): The message, whose text is a string or a list of strings and entities.
+
+    Returns:
+    tuple: A tuple containing the text and a list of the link targets that are not in the text.
+    """
+    parts = message.get("text", "")
+    if isinstance(parts, str):
+        return parts, []
+    text = []
+    links = []
+    for part in parts:
+        if isinstance(part, str):
+            text.append(part)
+            continue
+        text.append(part.get("text", ""))
+        if part.get("type") == "text_link" and part.get("href"):
+            links.append(part["href"])
+    return "".join(text), links
+
+
+def read_telegram_export(path, chat=None):
+    """
+    Function to read the notes of a chat export of Telegram Desktop (result.json).
+
+    An export of a single chat is read whole. From an export of all chats, the chat
+    named `chat` is read, or Saved Messages if no name is given.
+
+    Parameters:
+    path (str): The result.json file, the photos and recordings are looked up next to it.
+    chat (str, optional): The name of the chat in an export of all chats. Defaults to None.
+
+    Yields:
+    ImportItem: Each text, photo and voice message, oldest first.
+    """
+    with open(path, encoding="utf-8") as export_file:
+        export = json.load(export_file)
+    directory = os.path.dirname(os.path.abspath(path))
+
+    if "messages" in export:
+        chats = [export]
+    else:
+        chats = [entry for entry in export.get("chats", {}).get("list", [])
+                 if (entry.get("name") == chat if chat else entry.get("type") == "saved_messages")]
+
+    for entry in chats:
+        for message in entry.get("messages", []):
+            if message.get("type") != "message":
+                continue
+            key = "tg:{}:{}".format(entry.get("id"), message["id"])
+            if message.get("photo"):
+                yield ImportItem(key, "photo", path=os.path.join(directory, message["photo"]))
+            elif message.get("media_type") == "voice_message" and message.get("file"):
+                yield ImportItem(key, "voice", path=os.path.join(directory, message["file"]),
+                                 duration=float(message.get("duration_seconds") or 0))
+            elif "file" not in message and "media_type" not in message:
+                text, links = message_text(message)
+                if text.strip():
+                    yield ImportItem(key, "text", text=text, links=tuple(links))
+
+
+def read_url_list(path):
+    """
+    Function to read a list of links, one per line, optionally followed by a comment about it.
+
+    Empty lines and lines starting with # are skipped.
+
+    Parameters:
+    path (str): The text file.
+
+    Yields:
+    ImportItem: Each link as a text note, like a message with just the link.
+    """
+    with open(path, encoding="utf-8") as url_file:
+        for line in url_file:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            urls = find_links_in_text(line)
+            if urls:
+                yield ImportItem("url:" + normalize_url(urls[0]), "text", text=line)
+
+
+def read_items(path, chat=None):
+    """
+    Function to read the notes of a Telegram export (.json) or of a list of links (any other file).
+
+    Returns:
+    list: The items, in the order they were saved.
+    """
+    if path.endswith(".json"):
+        return list(read_telegram_export(path, chat))
+    return list(read_url_list(path))
+
+
+class ImportCheckpoint:
+    """
+    Progress of the imports, stored in SQLite so an import can be stopped and resumed.
+
+    Each item is recorded once its page is queued, along with the ID of the job.
+    Items whose page is queued are finished for the import, the Notion queue is
+    durable, and their outcome is filled in from the queue as pages are created.
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS items (
+                key TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                job_id INTEGER,
+                page_id TEXT,
+                error TEXT,
+                updated_at REAL NOT NULL
+            )""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS items_job ON items (status, job_id)")
+
+    def statuses(self, keys):
+        """
+        Method to get the status of items from earlier runs.
+
+        Parameters:
+        keys (list): The keys of the items.
+
+        Returns:
+        dict: The status by key, for the items that were recorded.
+        """
+        keys = list(keys)
+        statuses = {}
+        with self.lock:
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                statuses.update(self.db.execute("SELECT key, status FROM items WHERE key IN ({})".format(
+                    ",".join("?" * len(chunk))), chunk).fetchall())
+        return statuses
+
+    def mark(self, key, status, job_id=None, error=None):
+        """
+        Method to record the status of an item.
+
+        Parameters:
+        key (str): The key of the item.
+        status (str): queued, duplicate, skipped or failed.
+        job_id (int, optional): The job of the Notion queue that creates its page. Defaults to None.
+        error (str, optional): Why it failed or was skipped. Defaults to None.
+        """
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO items (key, status, job_id, error, updated_at) "
+                            "VALUES (?, ?, ?, ?, ?)", (key, status, job_id, error, time.time()))
+
+    def resolve(self, writer):
+        """
+        Method to fill in the outcome of the queued pages that were created or failed since the last call.
+
+        Parameters:
+        writer (NotionWriter): The writer whose queue has the jobs.
+
+        Returns:
+        int: The number of pages still queued.
+        """
+        with self.lock:
+            queued = dict(self.db.execute("SELECT job_id, key FROM items WHERE status = 'queued'").fetchall())
+        finished = writer.job_status(queued)
+        with self.lock:
+            for job_id, (status, page_id, error) in finished.items():
+                self.db.execute("UPDATE items SET status = ?, page_id = ?, error = ?, updated_at = ? WHERE key = ?",
+                                (status, page_id, error, time.time(), queued[job_id]))
+        return len(queued) - len(finished)
+
+    def counts(self, keys):
+        """
+        Method to count the items of an import by status.
+
+        Parameters:
+        keys (list): The keys of the items of the import.
+
+        Returns:
+        Counter: The number of items by status, with the ones not processed yet as pending.
+        """
+        counts = Counter(self.statuses(keys).values())
+        counts["pending"] = len(keys) - sum(counts.values())
+        return counts
+
+
+async def import_item(item):
+    """
+    Function to process one item like the bot processes a message, and queue its page.
+
+    Parameters:
+    item (ImportItem): The item.
+
+    Returns:
+    tuple: A tuple containing the status, the ID of the queued job and why it was skipped.
+    """
+    dedup = get_dedup_index()
+    kwargs = {}
+    if item.kind == "text":
+        title = item.text
+        urls = list(dict.fromkeys(find_links_in_text(item.text) + list(item.links)))
+        keys = note_keys(text=item.text, urls=urls)
+    elif not os.path.exists(item.path):
+        # Media is only in an export if it was enabled in its settings
+        return "skipped", None, "media not exported"
+    elif item.kind == "photo":
+        with open(item.path, "rb") as photo_file:
+            buf = io.BytesIO(photo_file.read())
+        keys = note_keys(image=await asyncio.to_thread(image_hash, buf))
+    else:
+        async def download(path):
+            await asyncio.to_thread(shutil.copyfile, item.path, path)
+
+        # The key stands in for Telegram's file ID in the transcript cache
+        title = await transcribe_voice(item.key, item.duration, download)
+        keys = note_keys(text=title)
+
+    # Reserved right away, so a worker with the same link in another item finds it.
+    # Links saved before stay in the note, but are not reserved for it
+    entry, keys = dedup.reserve(keys)
+    if entry is not None:
+        return "duplicate", None, None
+    try:
+        if item.kind == "text" and urls:
+            content, image = await fetch_pages(urls)
+            kwargs = {"content": """
+            message: {}
+            {}
+            """.format(item.text, content), "link": "\n".join(urls), "image": image}
+        elif item.kind == "photo":
+            async with trace("image_process"):
+                data, mime_type, filename = await asyncio.to_thread(process_image, buf, item.key.replace(":", "_"))
+            title = await handle_gemini_image({"mime_type": mime_type, "data": data})
+            kwargs = {"image": FILESERVER + filename}
+
+        data, reply = await prepare_notion_page(title, **kwargs)
+        job_id = get_notion_writer().enqueue(data, {"reply": reply, "keys": keys, "import": item.key})
+    except BaseException:
+        # Without a job nothing would release the reservation
+        dedup.discard(keys)
+        raise
+    return "queued", job_id, None
+
+
+def format_progress(counts, total, start):
+    """
+    Function to format a progress line of an import.
+
+    Returns:
+    str: The counts by status, the rate and the estimated time left.
+    """
+    processed = total - counts["pending"]
+    elapsed = time.monotonic() - start
+    rate = counts["run"] / elapsed if elapsed > 0 else 0.0
+    eta = "{:.0f}m".format(counts["pending"] / rate / 60) if rate else "-"
+    statuses = ", ".join("{} {}".format(counts[status], status)
+                         for status in ("queued", "done", "duplicate", "skipped", "failed") if counts[status])
+    return "{}/{} processed ({}), {:.2f}/s, {} left".format(processed, total, statuses or "none yet", rate, eta)
+
+
+async def run_import(items, checkpoint, workers=IMPORT_WORKERS, rate=IMPORT_RATE, share=1.0, retry_failed=False,
+                     limit=None):
+    """
+    Function to import items with parallel workers, skipping the ones finished by an earlier run.
+
+    Notes are started at most `rate` per second, and the import pauses while more than
+    IMPORT_MAX_QUEUED pages wait in the Notion queue. When it has gone through the items,
+    it waits until every queued page is created or has failed.
+
+    Parameters:
+    items (list): The items of the import.
+    checkpoint (ImportCheckpoint): The progress of the imports.
+    workers (int, optional): The number of notes processed at the same time. Defaults to IMPORT_WORKERS.
+    rate (float, optional): The most notes started per second. Defaults to IMPORT_RATE.
+    share (float, optional): The share of the Notion rate limit the import may use, 0 to leave writing
+    the pages to the running bot. Defaults to 1.0.
+    retry_failed (bool, optional): Whether items that failed before are processed again. Defaults to False.
+    limit (int, optional): The most items processed in this run. Defaults to all.
+
+    Returns:
+    Counter: The number of items by status.
+    """
+    keys = [item.key for item in items]
+    statuses = checkpoint.statuses(keys)
+    finished = FINISHED if retry_failed else FINISHED + ("failed",)
+    todo = [item for item in items if statuses.get(item.key) not in finished]
+    print("{} items, {} finished before, {} to process".format(len(items), len(items) - len(todo),
+                                                             len(todo) if limit is None else min(limit, len(todo))))
+    todo = todo[:limit]
+
+    writer = get_notion_writer()
+    if share > 0:
+        # The same listeners as the bot, except the replies in Telegram
+        writer.add_listener(get_dedup_index().record_page)
+        writer.add_listener(get_search_index().record_page)
+        writer.add_listener(record_related_page)
+        # Pages of the bot's notes are left to the bot, whose listener updates the replies
+        await writer.start(share=share, only="import")
+
+    bucket = TokenBucket(rate, max(1.0, rate))
+    queue = asyncio.Queue(workers * 2)
+    run_counts = Counter()
+    start = time.monotonic()
+
+    async def work():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            try:
+                status, job_id, error = await import_item(item)
+            except Exception as err:
+                log_error("import_item", err, key=item.key)
+                status, job_id, error = "failed", None, repr(err)
+            checkpoint.mark(item.key, status, job_id, error)
+            run_counts["run"] += 1
+
+    async def report():
+        while True:
+            await asyncio.sleep(IMPORT_PROGRESS_INTERVAL)
+            checkpoint.resolve(writer)
+            counts = checkpoint.counts(keys)
+            counts["run"] = run_counts["run"]
+            print(format_progress(counts, len(items), start), flush=True)
+
+    tasks = [asyncio.create_task(work()) for _ in range(workers)]
+    reporter = asyncio.create_task(report())
+    try:
+        for item in todo:
+            while writer.pending() > IMPORT_MAX_QUEUED:
+                await asyncio.sleep(1)
+            await bucket.acquire()
+            await queue.put(item)
+        for _ in tasks:
+            await queue.put(None)
+        await asyncio.gather(*tasks)
+
+        # The pages are written by this process or by the bot, either way their outcome ends up in the queue
+        while checkpoint.resolve(writer):
+            await asyncio.sleep(1)
+    finally:
+        reporter.cancel()
+        for task in tasks:
+            task.cancel()
+        await writer.stop()
+        await close_http_client()
+
+    counts = checkpoint.counts(keys)
+    counts["run"] = run_counts["run"]
+    print(format_progress(counts, len(items), start))
+    log_event(logging.INFO, "import_finished", items=len(items), processed=run_counts["run"],
+              seconds=round(time.monotonic() - start, 1))
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Import notes from a Telegram chat export or a list of links. Stopped imports resume "
+                    "where they left off when run again with the same file.")
+    parser.add_argument("path", help="result.json of a Telegram Desktop export, or a text file with one link per line.")
+    parser.add_argument("--chat", help="The chat to import from an export of all chats. Defaults to Saved Messages.")
+    parser.add_argument("--workers", type=int, default=IMPORT_WORKERS, help="Notes processed at the same time.")
+    parser.add_argument("--rate", type=float, default=IMPORT_RATE, help="Most notes started per second.")
+    parser.add_argument("--share", type=float, default=1.0,
+                        help="Share of the Notion rate limit to use, 0 if the bot is running and writes the pages.")
+    parser.add_argument("--retry-failed", action="store_true", help="Process the items that failed before again.")
+    parser.add_argument("--limit", type=int, help="Most items to process in this run.")
+    parser.add_argument("--dry-run", action="store_true", help="Only count the items to import.")
+    args = parser.parse_args()
+
+    items = read_items(args.path, args.chat)
+    checkpoint = ImportCheckpoint(os.path.join(CACHE_DIR, "import.sqlite"))
+    if args.dry_run:
+        print("{} items: {}".format(len(items), dict(Counter(item.kind for item in items))))
+        print("by status: {}".format(dict(checkpoint.counts([item.key for item in items]))))
+    else:
+        configure_logging()
+        asyncio.run(run_import(items, checkpoint, args.workers, args.rate, args.share, args.retry_failed,
+                               args.limit))
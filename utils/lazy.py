@@ -0,0 +1,110 @@
+import sys
+import time
+import asyncio
+import logging
+import importlib
+import importlib.util
+
+from utils.metrics import log_event, log_error
+
+# Every module handed out by lazy_import, in the order they were asked for
+_lazy_modules = []
+
+
+class LazyModule:
+    """
+    Stand-in for a module that is only imported when one of its attributes is first used.
+
+    Imports are guarded by the interpreter's import locks, so the first use may
+    come from any thread, including the warm-up thread.
+    """
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def _load(self):
+        """
+        Method to import the module, if it is not imported yet.
+
+        Returns:
+        module: The module.
+        """
+        module = self.__dict__["_module"]
+        if module is None:
+            module = importlib.import_module(self.__dict__["_name"])
+            self.__dict__["_module"] = module
+        return module
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+    def __setattr__(self, attribute, value):
+        setattr(self._load(), attribute, value)
+
+    def __repr__(self):
+        state = "loaded" if self.__dict__["_module"] is not None else "not loaded"
+        return "<lazy module {!r} ({})>".format(self.__dict__["_name"], state)
+
+
+def lazy_import(name):
+    """
+    Function to get a module that is imported on first use.
+
+    Parameters:
+    name (str): The full name of the module, e.g. "google.generativeai".
+
+    Returns:
+    module: The module if it is imported already, otherwise a LazyModule.
+    """
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    module = LazyModule(name)
+    _lazy_modules.append(module)
+    return module
+
+
+def is_installed(name):
+    """
+    Function to check whether a top-level package can be imported, without importing it.
+
+    Parameters:
+    name (str): The name of the package.
+
+    Returns:
+    bool: Whether it is installed.
+    """
+    return importlib.util.find_spec(name) is not None
+
+
+def load_lazy_modules():
+    """
+    Function to import every module handed out by lazy_import so far.
+
+    Returns:
+    float: The number of seconds it took.
+    """
+    start = time.perf_counter()
+    for module in list(_lazy_modules):
+        try:
+            module._load()
+        except ImportError as err:
+            # The module is optional, or its first use will raise the same error
+            log_error("warm_up", err, module=module.__dict__["_name"])
+    return time.perf_counter() - start
+
+
+async def warm_up(*callbacks):
+    """
+    Function to import the lazy modules in a worker thread, then run callbacks that need them.
+
+    Meant to run in the background once the bot is receiving updates, so the first
+    message does not pay for loading the SDKs.
+
+    Parameters:
+    callbacks (function): Run in the worker thread after the imports, e.g. to create model objects.
+    """
+    seconds = await asyncio.to_thread(load_lazy_modules)
+    for callback in callbacks:
+        await asyncio.to_thread(callback)
+    log_event(logging.INFO, "warm_up", ms=round(seconds * 1000, 1), modules=len(_lazy_modules))
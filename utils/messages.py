@@ -4,6 +4,14 @@ HELP_MESSAGE = ""
 
 NEW_CONVERSATION_MESSAGE = "Start new conversation"
 
+SAVING_MESSAGE = "Saving to Notion..."
+
+SAVED_MESSAGE = "Saved to Notion: "
+
+QUEUED_MESSAGE = "Queued ({} ahead)"
+
+BUSY_MESSAGE = "Too many notes in progress, please try again in a minute."
+
 PROCESSED = """
 - Give a short one paragraph summary for the next text and tags. 
 - if there url is provided, the summary will be generated PAGE CONTENT and META DESCRIPTION
@@ -17,4 +25,41 @@ PROCESSED = """
 }
 
 TEXT:
-"""
\ No newline at end of file
+"""
+
+CHUNK_SUMMARY = """
+- This is one part of a longer text, summarize it in a few sentences.
+- Keep names, numbers, and key facts.
+- Reply with the summary only.
+
+TEXT:
+"""
+
+IMAGE_PROMPT = "If image have text, transcribe it, otherwise describe it."
+
+REPAIR_JSON = """
+- The next text was meant to be a json object with a summary and tags, but it is not valid json.
+- Reply with the same content as valid json only, in the format:
+{
+    "summary": "summary",
+    "tags": "tag1, tag2, tag3, ..."
+}
+
+TEXT:
+"""
+
+DUPLICATE_MESSAGE = "Already saved to Notion: "
+
+DUPLICATE_PENDING_MESSAGE = "This note is already being saved to Notion."
+
+SEARCH_USAGE_MESSAGE = "Usage: /search words, prefix*, #tag"
+
+SEARCH_EMPTY_MESSAGE = "No notes found."
+
+RELATED_MESSAGE = "Related notes:"
+
+RELATED_USAGE_MESSAGE = "Usage: /related text, or reply to a message with /related"
+
+RELATED_EMPTY_MESSAGE = "No related notes found."
+
+RELATED_UNAVAILABLE_MESSAGE = "Related notes need NumPy on the server."
@@ -0,0 +1,339 @@
+import os
+import json
+import time
+import inspect
+import logging
+import functools
+import threading
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Address of the Prometheus endpoint, port 0 turns it off
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9108))
+# Number of recent timings per stage the percentiles are computed from
+METRICS_WINDOW = int(os.getenv("METRICS_WINDOW", 1024))
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+QUANTILES = (0.5, 0.95, 0.99)
+
+logger = logging.getLogger("notes")
+
+
+class StageStats:
+    """
+    Timings and errors of one stage: a histogram over the whole run and the most recent timings.
+    """
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.errors = Counter()
+        self.recent = deque(maxlen=METRICS_WINDOW)
+
+    def observe(self, seconds, error=None):
+        """
+        Method to record one run of the stage.
+
+        Parameters:
+        seconds (float): How long it took.
+        error (str, optional): The type of the error it failed with. Defaults to None.
+        """
+        index = 0
+        while index < len(BUCKETS) and seconds > BUCKETS[index]:
+            index += 1
+        self.buckets[index] += 1
+        self.sum += seconds
+        self.count += 1
+        self.recent.append(seconds)
+        if error is not None:
+            self.errors[error] += 1
+
+    def quantiles(self):
+        """
+        Method to get the percentiles of the recent timings.
+
+        Returns:
+        list: The timings at QUANTILES, in seconds, or None if there are none.
+        """
+        if not self.recent:
+            return [None] * len(QUANTILES)
+        timings = sorted(self.recent)
+        return [timings[min(len(timings) - 1, int(len(timings) * q))] for q in QUANTILES]
+
+
+class Metrics:
+    """
+    Registry of stage timings, error counts and gauges, shared by the event loop and worker threads.
+    """
+    def __init__(self):
+        self.stages = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def observe(self, stage, seconds, error=None):
+        """
+        Method to record one run of a stage.
+
+        Parameters:
+        stage (str): The name of the stage.
+        seconds (float): How long it took.
+        error (str, optional): The type of the error it failed with. Defaults to None.
+        """
+        with self.lock:
+            stats = self.stages.get(stage)
+            if stats is None:
+                stats = self.stages[stage] = StageStats()
+            stats.observe(seconds, error)
+
+    def add_gauge(self, name, help, callback):
+        """
+        Method to register a value read when the metrics are collected, e.g. a queue depth.
+
+        Parameters:
+        name (str): The name of the gauge.
+        help (str): What the gauge measures.
+        callback (function): Returns the current value.
+        """
+        self.gauges[name] = (help, callback)
+
+    def read_gauges(self):
+        """
+        Method to read the current value of every gauge.
+
+        Returns:
+        dict: The value of each gauge, None if it could not be read.
+        """
+        values = {}
+        for name, (_, callback) in list(self.gauges.items()):
+            try:
+                values[name] = callback()
+            except Exception:
+                values[name] = None
+        return values
+
+    def snapshot(self):
+        """
+        Method to summarize every stage and gauge.
+
+        Returns:
+        dict: For each stage its count, error rate, mean and percentiles in milliseconds, and the gauges.
+        """
+        stages = {}
+        with self.lock:
+            for stage, stats in self.stages.items():
+                errors = sum(stats.errors.values())
+                summary = {"count": stats.count, "errors": errors,
+                           "error_rate": errors / stats.count if stats.count else 0.0,
+                           "mean_ms": stats.sum / stats.count * 1000 if stats.count else None}
+                for q, value in zip(QUANTILES, stats.quantiles()):
+                    summary["p{}_ms".format(int(q * 100))] = value * 1000 if value is not None else None
+                stages[stage] = summary
+        return {"stages": stages, "gauges": self.read_gauges()}
+
+    def render(self):
+        """
+        Method to write the metrics in the Prometheus text format.
+
+        Returns:
+        str: The metrics.
+        """
+        lines = ["# HELP notes_stage_seconds Time spent in each stage of processing a note.",
+                 "# TYPE notes_stage_seconds histogram"]
+        recent = ["# HELP notes_stage_recent_seconds Percentiles of the recent timings of each stage.",
+                  "# TYPE notes_stage_recent_seconds gauge"]
+        errors = ["# HELP notes_stage_errors_total Failed runs of each stage by error type.",
+                  "# TYPE notes_stage_errors_total counter"]
+        with self.lock:
+            for stage, stats in sorted(self.stages.items()):
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ("+Inf",), stats.buckets):
+                    cumulative += count
+                    lines.append('notes_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(stage, bound,
+                                                                                            cumulative))
+                lines.append('notes_stage_seconds_sum{{stage="{}"}} {}'.format(stage, stats.sum))
+                lines.append('notes_stage_seconds_count{{stage="{}"}} {}'.format(stage, stats.count))
+                for q, value in zip(QUANTILES, stats.quantiles()):
+                    if value is not None:
+                        recent.append('notes_stage_recent_seconds{{stage="{}",quantile="{}"}} {}'.format(
+                            stage, q, value))
+                for error, count in sorted(stats.errors.items()):
+                    errors.append('notes_stage_errors_total{{stage="{}",error="{}"}} {}'.format(stage, error, count))
+        lines += recent + errors
+
+        values = self.read_gauges()
+        for name, (help, _) in sorted(self.gauges.items()):
+            if values[name] is not None:
+                lines += ["# HELP notes_{} {}".format(name, help), "# TYPE notes_{} gauge".format(name),
+                          "notes_{} {}".format(name, values[name])]
+        return "\n".join(lines) + "\n"
+
+
+# The registry shared by every module
+_metrics = Metrics()
+
+def get_metrics():
+    """
+    Function to get the metrics registry.
+
+    Returns:
+    Metrics: The shared registry.
+    """
+    return _metrics
+
+
+def log_event(level, event, **fields):
+    """
+    Function to write a structured log line, a JSON object with the event and its fields.
+
+    Parameters:
+    level (int): The logging level.
+    event (str): What happened.
+    fields: The details of the event.
+    """
+    if logger.isEnabledFor(level):
+        logger.log(level, json.dumps(dict(ts=round(time.time(), 3), event=event, **fields), default=str))
+
+
+def log_error(stage, err, **fields):
+    """
+    Function to log and count an error that is handled without failing the stage.
+
+    Parameters:
+    stage (str): Where the error happened.
+    err (Exception): The error.
+    fields: The details of the error.
+    """
+    with _metrics.lock:
+        stats = _metrics.stages.get(stage)
+        if stats is None:
+            stats = _metrics.stages[stage] = StageStats()
+        stats.errors[type(err).__name__] += 1
+    log_event(logging.ERROR, "error", stage=stage, error=type(err).__name__, message=str(err)[:500], **fields)
+
+
+class trace:
+    """
+    Context manager that times a stage, counts its errors and logs it.
+
+    Works with both `with` and `async with`. Fields passed to the constructor or
+    to `set` are added to the log line. Errors are recorded and passed on.
+    """
+    def __init__(self, stage, **fields):
+        self.stage = stage
+        self.fields = fields
+
+    def set(self, **fields):
+        """
+        Method to add fields to the log line of the stage.
+        """
+        self.fields.update(fields)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        error = exc_type.__name__ if exc_type is not None else None
+        _metrics.observe(self.stage, seconds, error)
+        if error is None:
+            log_event(logging.INFO, "stage", stage=self.stage, ms=round(seconds * 1000, 1), **self.fields)
+        else:
+            log_event(logging.ERROR, "stage", stage=self.stage, ms=round(seconds * 1000, 1), error=error,
+                      message=str(exc)[:500], **self.fields)
+        return False
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return self.__exit__(exc_type, exc, tb)
+
+
+def timed(stage):
+    """
+    Decorator that traces every call of a function as a stage.
+
+    Parameters:
+    stage (str): The name of the stage.
+
+    Returns:
+    function: The decorator, for plain and coroutine functions.
+    """
+    def decorator(function):
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                async with trace(stage):
+                    return await function(*args, **kwargs)
+        else:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with trace(stage):
+                    return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Request handler of the metrics endpoint: /metrics in the Prometheus format, / as JSON.
+    """
+    def do_GET(self):
+        if self.path.split("?")[0] == "/metrics":
+            body = _metrics.render().encode("utf-8")
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        elif self.path.split("?")[0] == "/":
+            body = json.dumps(_metrics.snapshot(), indent=2).encode("utf-8")
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    """
+    Function to serve the metrics from a background thread.
+
+    Parameters:
+    host (str, optional): The address to listen on. Defaults to METRICS_HOST.
+    port (int, optional): The port to listen on, 0 to not serve. Defaults to METRICS_PORT.
+
+    Returns:
+    ThreadingHTTPServer: The running server, or None if it is turned off or the port is taken.
+    """
+    if not port:
+        return None
+    try:
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError as err:
+        log_error("metrics", err, port=port)
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def configure_logging():
+    """
+    Function to send the structured logs to stderr, one JSON object per line.
+    """
+    logging.basicConfig(level=LOG_LEVEL, format="%(message)s")
+    # The HTTP client logs every request, the stages already cover them
+    logging.getLogger("httpx").setLevel(logging.WARNING)
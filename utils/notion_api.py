@@ -1,9 +1,14 @@
 import os
-import requests
+import asyncio
+import logging
 from dotenv import load_dotenv
-from utils.gemini_api import handle_gemini_model
+from utils.gemini_api import handle_gemini_model, condense_text
 from utils.helpers import clean_text
-from utils.messages import PROCESSED
+from utils.http_client import get_http_client
+from utils.metrics import trace, log_event
+from utils.messages import PROCESSED, REPAIR_JSON
+from utils.notion_writer import NotionWriter
+from utils.summary_parser import NoteSummary, parse_summary
 
 # Load environment variables from .env file
 load_dotenv()
@@ -11,6 +16,14 @@ load_dotenv()
 # Get environment variables
 NOTION_API = os.getenv("NOTION_API")
 DATABASE_ID = os.getenv("NOTION_DATABASE_ID")
+NOTION_API_URL = os.getenv("NOTION_API_URL", "https://api.notion.com/v1")
+# Longest title and summary shown in the reply, Telegram messages hold at most 4096 characters
+REPLY_TITLE_CHARS = int(os.getenv("REPLY_TITLE_CHARS", 1000))
+REPLY_SUMMARY_CHARS = int(os.getenv("REPLY_SUMMARY_CHARS", 2000))
+
+# Notion takes at most 2000 characters per text object and 100 text objects per property
+NOTION_TEXT_CHARS = 2000
+NOTION_TEXT_ITEMS = 100
 
 # Set headers for Notion API
 headers = {
@@ -19,42 +32,130 @@ headers = {
     "Notion-Version": "2022-06-28",
 }
 
+# The background writer, created on first use
+_writer = None
 
-def add_notion_page(title, content="", summary="", tags="", image="", link=""):
+def get_notion_writer():
     """
-    Function to add a page to Notion.
+    Function to get the background writer that creates the Notion pages.
+
+    Returns:
+    NotionWriter: The shared writer.
+    """
+    global _writer
+    if _writer is None:
+        _writer = NotionWriter(NOTION_API_URL + "/pages", headers)
+    return _writer
+
+
+def rich_text(text):
+    """
+    Function to split a text into the text objects of a Notion title or rich text property.
+
+    Parameters:
+    text (str): The text, cut off past what a property can hold.
+
+    Returns:
+    list: The text objects.
+    """
+    starts = range(0, min(len(text), NOTION_TEXT_CHARS * NOTION_TEXT_ITEMS), NOTION_TEXT_CHARS)
+    return [{"text": {"content": text[start:start + NOTION_TEXT_CHARS]}} for start in starts] or \
+        [{"text": {"content": ""}}]
+
+
+def shorten(text, limit):
+    """
+    Function to cut off a text for the reply.
+    """
+    return text if len(text) <= limit else text[:limit] + "..."
+
+
+async def iter_database_pages(page_size=100):
+    """
+    Function to go through every page of the Notion database, following the pagination cursor.
+
+    Rate limited requests are retried after the delay Notion asks for.
+
+    Parameters:
+    page_size (int, optional): The number of pages per request, at most 100. Defaults to 100.
+
+    Yields:
+    dict: Each page of the database.
+    """
+    url = "{}/databases/{}/query".format(NOTION_API_URL, DATABASE_ID)
+    body = {"page_size": page_size}
+    while True:
+        async with trace("notion_query", status=None) as span:
+            res = await get_http_client().post(url, headers=headers, json=body)
+            span.set(status=res.status_code)
+        if res.status_code == 429:
+            await asyncio.sleep(float(res.headers.get("Retry-After", 1)))
+            continue
+        res.raise_for_status()
+        result = res.json()
+        for page in result["results"]:
+            yield page
+        if not result.get("has_more"):
+            return
+        body["start_cursor"] = result["next_cursor"]
+
+
+async def summarize_note(prompt, use_cache=True):
+    """
+    Function to get the summary and tags of a note from the Gemini model.
+
+    The reply is parsed as JSON without evaluating it. If it cannot be parsed, the
+    model is asked to fix its own reply, which is much shorter than resending the
+    content. If that fails too, the reply itself becomes the summary.
+
+    Parameters:
+    prompt (str): The summary prompt with the content of the note.
+    use_cache (bool, optional): Whether a cached summary of the same content may be reused. Defaults to True.
+
+    Returns:
+    NoteSummary: The summary and tags of the note.
+    """
+    processed = await handle_gemini_model(prompt, use_cache=use_cache, json_mode=True)
+    summary = parse_summary(processed)
+    if summary is None:
+        log_event(logging.WARNING, "summary_repair", reply_chars=len(processed))
+        summary = parse_summary(await handle_gemini_model(REPAIR_JSON + processed, use_cache=use_cache,
+                                                          json_mode=True))
+    if summary is None:
+        summary = NoteSummary(processed.strip(), "")
+    return summary
+
+
+async def prepare_notion_page(title, content="", image="", link="", use_cache=True):
+    """
+    Function to summarize a note and build the Notion page for it.
 
     Parameters:
     title (str): The title of the page.
-    summary (str, optional): The summary of the page. Defaults to "".
-    tags (str, optional): The tags for the page. Defaults to "".
+    content (str, optional): The content to summarize instead of the title. Defaults to "".
     image (str, optional): The image for the page. Defaults to "".
     link (str, optional): The link for the page. Defaults to "".
+    use_cache (bool, optional): Whether a cached summary of the same content may be reused. Defaults to True.
 
     Returns:
-    str: A message indicating whether the page was added successfully or an error occurred.
+    tuple: A tuple containing the body of the create page request and the reply message.
     """
-    # Notion API endpoint to create a new page
-    create_url = "https://api.notion.com/v1/pages"
+    # Long pages and transcripts are summarized in parts first
     if content != "":
-        prompt = PROCESSED + content
+        prompt = PROCESSED + await condense_text(content)
     else:
-        prompt = PROCESSED + title
+        prompt = PROCESSED + await condense_text(title)
     # Process the title using the Gemini model
-    processed = handle_gemini_model(prompt)
-    try:
-        processed = processed.replace("null", '""')
-        processed = eval(processed)
-    except Exception as e:
-        print(e)
+    processed = await summarize_note(prompt, use_cache=use_cache)
 
     # Prepare the data for the new page
     data = {
         "parent": {"database_id": DATABASE_ID},
         "properties": {
-            "mytext": {"title": [{"text": {"content": title}}]},
-            "summary": {"rich_text": [{"text": {"content": clean_text(processed['summary'])}}]},
-            "tags": {"rich_text": [{"text": {"content": clean_text(processed['tags'])}}]},
+            # Transcripts of long recordings run past the length of one text object
+            "mytext": {"title": rich_text(title)},
+            "summary": {"rich_text": rich_text(clean_text(processed.summary))},
+            "tags": {"rich_text": rich_text(clean_text(processed.tags))},
         }
     }
 
@@ -78,20 +179,39 @@ def add_notion_page(title, content="", summary="", tags="", image="", link=""):
             "url": link
         }
 
-    # Send a POST request to the Notion API to create the new page
-    res = requests.post(create_url, headers=headers, json=data)
-
-    # If the request was successful, return a success message
-    # Otherwise, return an error message
-    if res.status_code == 200:
-        return title + ("{} "
-                        "<br><br>"
-                        "Summary: {} "
-                        "<br><br>"
-                        "Tags: {} "
-                        "<br><br>"
-                        "Image: {} "
-                        "<br><br>"
-                        "Link: {}").format(title, processed['summary'], processed['tags'], image, link)
-    else:
-        return "Error: " + res.text
\ No newline at end of file
+    # The page has the whole title, the reply only its start
+    reply = ("{} "
+             "\n\n"
+             "Summary: {} "
+             "\n\n"
+             "Tags: {} "
+             "\n\n"
+             "Image: {} "
+             "\n\n"
+             "Link: {}").format(shorten(title, REPLY_TITLE_CHARS), shorten(processed.summary, REPLY_SUMMARY_CHARS),
+                                processed.tags, image, link)
+    return data, reply
+
+
+async def add_notion_page(title, content="", summary="", tags="", image="", link="", use_cache=True, meta=None):
+    """
+    Function to add a page to Notion.
+
+    The page is queued for the background writer, so this returns as soon as the
+    summary is ready. The writer's listeners are told when the page is created.
+
+    Parameters:
+    title (str): The title of the page.
+    summary (str, optional): The summary of the page. Defaults to "".
+    tags (str, optional): The tags for the page. Defaults to "".
+    image (str, optional): The image for the page. Defaults to "".
+    link (str, optional): The link for the page. Defaults to "".
+    use_cache (bool, optional): Whether a cached summary of the same content may be reused. Defaults to True.
+    meta (dict, optional): Information handed to the writer's listeners. Defaults to None.
+
+    Returns:
+    str: A message with the summary and tags of the queued page.
+    """
+    data, reply = await prepare_notion_page(title, content=content, image=image, link=link, use_cache=use_cache)
+    get_notion_writer().enqueue(data, dict(meta or {}, reply=reply))
+    return reply
@@ -0,0 +1,325 @@
+import os
+import json
+import time
+import random
+import logging
+import sqlite3
+import asyncio
+import threading
+
+import httpx
+from dotenv import load_dotenv
+
+from utils.cache import CACHE_DIR
+from utils.http_client import get_http_client
+from utils.metrics import trace, log_event, log_error
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Notion allows an average of 3 requests per second per integration
+NOTION_RATE_LIMIT = float(os.getenv("NOTION_RATE_LIMIT", 3))
+NOTION_MAX_IN_FLIGHT = int(os.getenv("NOTION_MAX_IN_FLIGHT", 3))
+NOTION_MAX_ATTEMPTS = int(os.getenv("NOTION_MAX_ATTEMPTS", 8))
+NOTION_BACKOFF_MAX = float(os.getenv("NOTION_BACKOFF_MAX", 300))
+# Seconds a worker process holds a job it has taken before another process may take it over
+NOTION_LEASE = float(os.getenv("NOTION_LEASE", 120))
+
+
+class TokenBucket:
+    """
+    Rate limiter that allows `rate` acquisitions per second with bursts of up to `capacity`.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """
+        Method to hold back all acquisitions, e.g. when the server asks to slow down.
+
+        Parameters:
+        seconds (float): How long to pause.
+        """
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def acquire(self):
+        """
+        Method to wait for a token.
+        """
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class NotionWriter:
+    """
+    Background writer that creates Notion pages from a durable queue.
+
+    Pages are journaled in SQLite before the caller returns, then drained to the
+    Notion API at a limited rate over the shared HTTP client. Rate limiting (429)
+    and server errors are retried with exponential backoff, honoring Retry-After.
+    Listeners are called with the job's meta data once a page is created or has
+    failed for good, so the caller can tell the user. Worker processes that share
+    the queue take jobs with a lease, so each job is sent by one of them, and a
+    job taken by a process that died is sent again once its lease runs out.
+    """
+    def __init__(self, url, headers):
+        self.url = url
+        self.headers = headers
+        self.listeners = []
+        self.in_flight = set()
+        self.task = None
+        self.wakeup = None
+        self.only = None
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(CACHE_DIR, "notion_queue.sqlite"),
+                                  check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                data TEXT NOT NULL,
+                meta TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                created_at REAL NOT NULL,
+                page_id TEXT,
+                error TEXT
+            )""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_due ON jobs (status, next_attempt_at)")
+
+    def add_listener(self, listener):
+        """
+        Method to register a coroutine function called as listener(meta, page, error)
+        when a job finishes. `page` is the created Notion page, or None if the job failed.
+
+        Parameters:
+        listener (coroutine function): The listener.
+        """
+        self.listeners.append(listener)
+
+    def enqueue(self, data, meta=None):
+        """
+        Method to queue a page for creation. The job survives restarts once this returns.
+
+        Parameters:
+        data (dict): The body of the Notion create page request.
+        meta (dict, optional): Information handed to the listeners when the job finishes.
+
+        Returns:
+        int: The ID of the job.
+        """
+        now = time.time()
+        with self.lock:
+            cursor = self.db.execute("INSERT INTO jobs (data, meta, next_attempt_at, created_at) VALUES (?, ?, ?, ?)",
+                                     (json.dumps(data), json.dumps(meta or {}), now, now))
+        if self.wakeup is not None:
+            self.wakeup.set()
+        return cursor.lastrowid
+
+    def pending(self):
+        """
+        Method to count the jobs that are waiting to be written.
+
+        Returns:
+        int: The number of pending jobs.
+        """
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'pending'").fetchone()[0]
+
+    def job_status(self, job_ids):
+        """
+        Method to look up how jobs ended, whichever process sent them.
+
+        Parameters:
+        job_ids (list): The IDs of the jobs.
+
+        Returns:
+        dict: Tuples of status, page ID and error by job ID, for the jobs that are done or failed.
+        """
+        statuses = {}
+        job_ids = list(job_ids)
+        with self.lock:
+            # Within SQLite's limit on the number of parameters
+            for i in range(0, len(job_ids), 500):
+                chunk = job_ids[i:i + 500]
+                rows = self.db.execute("SELECT id, status, page_id, error FROM jobs WHERE status != 'pending' "
+                                       "AND id IN ({})".format(",".join("?" * len(chunk))), chunk).fetchall()
+                statuses.update((row[0], row[1:]) for row in rows)
+        return statuses
+
+    async def start(self, share=1.0, only=None):
+        """
+        Method to start draining the queue in the running event loop, including jobs left from a previous run.
+
+        Parameters:
+        share (float, optional): The share of the Notion rate limit this process may use,
+        when several processes drain the queue. Defaults to 1.0.
+        only (str, optional): Only send the jobs whose meta has this key, leaving the others
+        to the process whose listeners handle them. Defaults to all jobs.
+        """
+        if self.task is None:
+            self.only = only
+            self.wakeup = asyncio.Event()
+            rate = NOTION_RATE_LIMIT * share
+            self.bucket = TokenBucket(rate, max(1.0, rate))
+            self.max_in_flight = max(1, round(NOTION_MAX_IN_FLIGHT * share))
+            self.slots = asyncio.Semaphore(self.max_in_flight)
+            self.sending = set()
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """
+        Method to stop the writer. Unfinished jobs stay queued for the next start.
+        """
+        if self.task is not None:
+            self.task.cancel()
+            for task in list(self.sending):
+                task.cancel()
+            await asyncio.gather(self.task, *self.sending, return_exceptions=True)
+            self.task = None
+            self.in_flight.clear()
+
+    async def run(self):
+        """
+        Method to send due jobs as rate limits allow, and sleep until the next one is due.
+        """
+        while True:
+            self.wakeup.clear()
+            for job in self._due_jobs():
+                await self.slots.acquire()
+                await self.bucket.acquire()
+                self.in_flight.add(job[0])
+                task = asyncio.create_task(self._send(*job))
+                self.sending.add(task)
+                task.add_done_callback(self.sending.discard)
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self._next_delay())
+            except asyncio.TimeoutError:
+                pass
+
+    def _due_jobs(self):
+        """
+        Method to take the jobs that are due and not being sent already.
+
+        Returns:
+        list: Tuples of ID, data, meta and attempts of each job.
+        """
+        now = time.time()
+        with self.lock:
+            # Taking a job moves its next attempt past the lease, so other processes skip it
+            rows = self.db.execute("UPDATE jobs SET next_attempt_at = ? WHERE id IN ("
+                                   "SELECT id FROM jobs WHERE status = 'pending' AND next_attempt_at <= ? "
+                                   "AND (? IS NULL OR json_extract(meta, '$.' || ?) IS NOT NULL) "
+                                   "ORDER BY id LIMIT ?) RETURNING id, data, meta, attempts",
+                                   (now + NOTION_LEASE, now, self.only, self.only,
+                                    self.max_in_flight + len(self.in_flight))).fetchall()
+        return sorted(row for row in rows if row[0] not in self.in_flight)
+
+    def _next_delay(self):
+        """
+        Method to get the time until the next retry is due.
+
+        Returns:
+        float: The number of seconds to wait, or None if no retry is scheduled.
+        """
+        with self.lock:
+            row = self.db.execute("SELECT MIN(next_attempt_at) FROM jobs WHERE status = 'pending' "
+                                  "AND next_attempt_at > ? AND (? IS NULL OR json_extract(meta, '$.' || ?) IS NOT NULL)",
+                                  (time.time(), self.only, self.only)).fetchone()
+        return max(0.0, row[0] - time.time()) if row[0] is not None else None
+
+    async def _send(self, job_id, data, meta, attempts):
+        """
+        Method to send one job to Notion and record the outcome.
+        """
+        try:
+            try:
+                async with trace("notion_post", job=job_id, attempt=attempts + 1) as span:
+                    res = await get_http_client().post(self.url, headers=self.headers, content=data)
+                    span.set(status=res.status_code)
+            except httpx.HTTPError as err:
+                if not self._retry(job_id, attempts, None, repr(err)):
+                    await self._notify(json.loads(meta), None, repr(err))
+                return
+
+            if res.status_code == 200:
+                try:
+                    page = res.json()
+                except ValueError as err:
+                    # A cut off reply is retried like a dropped connection
+                    if not self._retry(job_id, attempts, None, "Invalid response: " + repr(err)):
+                        await self._notify(json.loads(meta), None, "Invalid response from Notion")
+                    return
+                self._finish(job_id, "done", page_id=page.get("id"))
+                await self._notify(json.loads(meta), page, None)
+            elif res.status_code == 429 or res.status_code >= 500:
+                if not self._retry(job_id, attempts, res.headers.get("Retry-After"), res.text):
+                    await self._notify(json.loads(meta), None, res.text)
+            else:
+                self._finish(job_id, "failed", error=res.text)
+                await self._notify(json.loads(meta), None, res.text)
+        finally:
+            self.in_flight.discard(job_id)
+            self.slots.release()
+            self.wakeup.set()
+
+    def _retry(self, job_id, attempts, retry_after, error):
+        """
+        Method to schedule another attempt of a job, or fail it after too many attempts.
+
+        Returns:
+        bool: Whether the job will be retried.
+        """
+        attempts += 1
+        if attempts >= NOTION_MAX_ATTEMPTS:
+            self._finish(job_id, "failed", error=error)
+            return False
+
+        try:
+            delay = float(retry_after)
+            # The whole integration is rate limited, not just this job
+            self.bucket.pause(delay)
+        except (TypeError, ValueError):
+            delay = min(NOTION_BACKOFF_MAX, 2 ** attempts) + random.uniform(0, 1)
+        with self.lock:
+            self.db.execute("UPDATE jobs SET attempts = ?, next_attempt_at = ?, error = ? WHERE id = ?",
+                            (attempts, time.time() + delay, error, job_id))
+        log_event(logging.WARNING, "notion_retry", job=job_id, attempt=attempts, delay=round(delay, 1),
+                  error=error[:500])
+        return True
+
+    def _finish(self, job_id, status, page_id=None, error=None):
+        """
+        Method to mark a job as done or failed.
+        """
+        with self.lock:
+            self.db.execute("UPDATE jobs SET status = ?, page_id = ?, error = ? WHERE id = ?",
+                            (status, page_id, error, job_id))
+
+    async def _notify(self, meta, page, error):
+        """
+        Method to call the listeners of a finished job.
+        """
+        for listener in self.listeners:
+            try:
+                await listener(meta, page, error)
+            except Exception as err:
+                log_error("notion_listener", err, listener=getattr(listener, "__qualname__", repr(listener)))
@@ -1,12 +1,16 @@
+import io
 import os
+import base64
 
 from dotenv import load_dotenv
-from langchain.chains import LLMChain
-from langchain_openai import ChatOpenAI
-from langchain.memory import ConversationBufferMemory
-from langchain_core.prompts import PromptTemplate
 
-from openai import OpenAI
+from utils.conversation import get_conversation_store, summarize_turns, MEMORY_SUMMARY_TOKENS
+from utils.lazy import lazy_import
+from utils.messages import IMAGE_PROMPT
+from utils.metrics import trace, timed, log_error
+
+# Loaded on first use or by the warm-up, LangChain only by the chat model functions
+openai = lazy_import("openai")
 
 # Load environment variables from .env file
 load_dotenv()
@@ -15,10 +19,26 @@ load_dotenv()
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
-# Initialize the OpenAI client
-client = OpenAI()
+# Models used when summaries and image descriptions fall back to OpenAI
+OPENAI_TEXT_MODEL = os.getenv("OPENAI_TEXT_MODEL", "gpt-4o-mini")
+OPENAI_VISION_MODEL = os.getenv("OPENAI_VISION_MODEL", "gpt-4o-mini")
+
+# The OpenAI client, created on first use
+_client = None
+
+def get_openai_client():
+    """
+    Function to get the shared OpenAI client.
 
-def handle_transcribe_openai(audio_file):
+    Returns:
+    AsyncOpenAI: The client.
+    """
+    global _client
+    if _client is None:
+        _client = openai.AsyncOpenAI()
+    return _client
+
+async def handle_transcribe_openai(audio_file):
     """
     Function to transcribe audio using OpenAI.
 
@@ -29,59 +49,170 @@ def handle_transcribe_openai(audio_file):
     str: The transcribed text.
     """
     # Transcribe the audio file using the 'whisper-1' model
-    transcript = client.audio.transcriptions.create(
-        model="whisper-1",
-        file=audio_file
-    )
+    async with trace("whisper"):
+        transcript = await get_openai_client().audio.transcriptions.create(
+            model="whisper-1",
+            file=audio_file
+        )
 
     # Return the transcribed text
     return transcript.text
 
-def handle_openai_model(chat_id, input_text, conversations, model_name):
+async def openai_generate(input_text, json_mode=False):
+    """
+    Function to send a single message to the OpenAI text model, the fallback of the Gemini model.
+
+    Parameters:
+    input_text (str): The input text to be processed by the model.
+    json_mode (bool, optional): Whether to ask for a JSON reply. Defaults to False.
+
+    Returns:
+    str: The text generated by the model.
+    """
+    kwargs = {"response_format": {"type": "json_object"}} if json_mode else {}
+    async with trace("openai_chat", model=OPENAI_TEXT_MODEL, prompt_chars=len(input_text)):
+        response = await get_openai_client().chat.completions.create(
+            model=OPENAI_TEXT_MODEL,
+            messages=[{"role": "user", "content": input_text}],
+            temperature=0.7,
+            **kwargs
+        )
+    return response.choices[0].message.content or ""
+
+async def openai_describe(image):
+    """
+    Function to transcribe or describe an image with the OpenAI vision model, the fallback of the Gemini model.
+
+    Parameters:
+    image (Image or dict): The image, or a dict with its MIME type and encoded data.
+
+    Returns:
+    str: The text generated by the model.
+    """
+    if isinstance(image, dict):
+        mime_type, data = image["mime_type"], image["data"]
+    else:
+        buf = io.BytesIO()
+        image.save(buf, format="PNG")
+        mime_type, data = "image/png", buf.getvalue()
+    url = "data:{};base64,{}".format(mime_type, base64.b64encode(data).decode("ascii"))
+
+    async with trace("openai_image", model=OPENAI_VISION_MODEL):
+        response = await get_openai_client().chat.completions.create(
+            model=OPENAI_VISION_MODEL,
+            messages=[{"role": "user", "content": [
+                {"type": "text", "text": IMAGE_PROMPT},
+                {"type": "image_url", "image_url": {"url": url}},
+            ]}],
+        )
+    return response.choices[0].message.content or ""
+
+# Define the template for the prompt
+template = """
+    {chat_history}
+    Human: {human_input}
+    Chatbot:"""
+
+# Long-lived chains, one per model name, shared by every chat
+_chains = {}
+
+def get_openai_chain(model_name):
+    """
+    Function to get the shared chain for a model name.
+
+    The chain holds no memory of its own, the history of a chat is passed in on each call,
+    so the model client and its open connections are reused across chats.
+
+    Parameters:
+    model_name (str): The name of the model to be used.
+
+    Returns:
+    LLMChain: The shared chain.
+    """
+    from langchain.chains import LLMChain
+    from langchain_openai import ChatOpenAI
+    from langchain_core.prompts import PromptTemplate
+
+    chain = _chains.get(model_name)
+    if chain is None:
+        # Initialize the prompt template with the defined template and input variables
+        prompt_template = PromptTemplate(
+            input_variables=["chat_history", "human_input"], template=template
+        )
+
+        # Initialize the OpenAI model with the specified model name and configuration
+        llm = ChatOpenAI(temperature=.0, model_name=model_name, verbose=False, model_kwargs={"stream": False},
+                         openai_api_key=OPENAI_API_KEY)
+
+        # Initialize the LLMChain with the OpenAI model and prompt template
+        chain = LLMChain(
+            llm=llm,
+            prompt=prompt_template,
+            verbose=True,
+        )
+        _chains[model_name] = chain
+    return chain
+
+# Define the template for folding older turns into the summary
+summary_template = """Progressively summarize the conversation, adding to the previous summary. Keep it under {words} words.
+
+Previous summary:
+{summary}
+
+New lines of conversation:
+{lines}
+
+New summary:"""
+
+def get_openai_summarizer(model_name):
+    """
+    Function to get a summarizer for the conversation memory that asks a model.
+
+    Parameters:
+    model_name (str): The name of the model to be used.
+
+    Returns:
+    function: Called with the summary and the folded turns, returns the new summary.
+    """
+    def summarize(summary, turns):
+        lines = "\n".join("Human: {}\nAI: {}".format(human, answer) for human, answer in turns)
+        prompt = summary_template.format(words=MEMORY_SUMMARY_TOKENS * 3 // 4, summary=summary or "(none)",
+                                         lines=lines)
+        try:
+            with trace("openai_summary"):
+                return get_openai_chain(model_name).llm.invoke(prompt).content.strip()
+        except Exception as err:
+            # The turns are still remembered, only less well
+            log_error("openai_summary", err, model=model_name)
+            return summarize_turns(summary, turns)
+    return summarize
+
+@timed("openai")
+def handle_openai_model(chat_id, input_text, conversations=None, model_name=OPENAI_TEXT_MODEL):
     """
     Function to handle the OpenAI model.
 
+    Only the recent turns of the chat within MEMORY_TOKENS are sent, with a summary of the
+    older ones, so the prompt does not grow with the length of the chat. The chat's memory
+    stays locked from reading the history to adding the answer, so messages of one chat
+    sent at the same time are answered one after the other, each with the turn before it.
+
     Parameters:
     chat_id (int): The chat ID.
     input_text (str): The input text to be processed by the model.
-    conversations (dict): The conversations history.
-    model_name (str): The name of the model to be used.
+    conversations (ConversationStore, optional): The memory of the chats. Defaults to the shared store.
+    model_name (str, optional): The name of the model to be used. Defaults to OPENAI_TEXT_MODEL.
 
     Returns:
     str: The text generated by the model.
     """
-    # Initialize the OpenAI model with the specified model name and configuration
-    llm = ChatOpenAI(temperature=.0, model_name=model_name, verbose=False, model_kwargs={"stream": False},
-                     openai_api_key=OPENAI_API_KEY)
-
-    # Define the template for the prompt
-    template = """
-        {chat_history}
-        Human: {human_input}
-        Chatbot:"""
-
-    # Initialize the prompt template with the defined template and input variables
-    prompt_template = PromptTemplate(
-        input_variables=["chat_history", "human_input"], template=template
-    )
-
-    # Initialize the memory object with the specified memory key and maximum length
-    memory_obj = ConversationBufferMemory(memory_key="chat_history", max_len=2000)
-
-    # If there are existing conversations for the chat ID, save them to the memory object
-    if conversations[chat_id] is not None:
-        for hist in conversations[chat_id]:
-            memory_obj.save_context(
-                {"question": hist["prompt"]},
-                {"output": hist["answer"]})
-
-    # Initialize the LLMChain with the OpenAI model, prompt template, and memory object
-    chain = LLMChain(
-        llm=llm,
-        prompt=prompt_template,
-        verbose=True,
-        memory=memory_obj,
-    )
-
-    # Send the input text to the model and return the generated response
-    return chain.predict(human_input=input_text)
\ No newline at end of file
+    if conversations is None:
+        conversations = get_conversation_store()
+
+    with conversations.open(chat_id) as chat:
+        # Send the input text and the chat history to the model
+        answer = get_openai_chain(model_name).predict(chat_history=chat.history(), human_input=input_text)
+
+        # Remember the turn, older turns are summarized by the same model
+        chat.add(input_text, answer, conversations.max_tokens, get_openai_summarizer(model_name))
+    return answer
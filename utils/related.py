@@ -0,0 +1,485 @@
+import os
+import re
+import zlib
+import time
+import shutil
+import sqlite3
+import asyncio
+import logging
+import argparse
+import threading
+
+from dotenv import load_dotenv
+
+from utils.cache import CACHE_DIR
+from utils.dedup import plain_text
+from utils.lazy import lazy_import, is_installed
+from utils.metrics import log_event, log_error
+from utils.shared_store import file_lock
+
+# The vector index needs NumPy, without it there are no related notes
+np = lazy_import("numpy") if is_installed("numpy") else None
+
+# Load environment variables from .env file
+load_dotenv()
+
+# A sentence-transformers model to embed notes with on the CPU, hashed n-grams if not set
+RELATED_MODEL = os.getenv("RELATED_MODEL", "")
+# Size of the hashed n-gram vectors
+RELATED_DIMENSIONS = int(os.getenv("RELATED_DIMENSIONS", 256))
+# Number of related notes shown and the least similarity that counts as related
+RELATED_RESULTS = int(os.getenv("RELATED_RESULTS", 3))
+RELATED_MIN_SCORE = float(os.getenv("RELATED_MIN_SCORE", 0.25))
+# Number of vectors scored at a time, bounds the memory used by a search
+RELATED_BLOCK_ROWS = int(os.getenv("RELATED_BLOCK_ROWS", 16384))
+
+WORD = re.compile(r'\w+')
+
+
+def note_text(properties):
+    """
+    Function to get the text a note is compared by: its title, summary and tags.
+
+    Parameters:
+    properties (dict): The properties of the Notion page, as created or as returned by Notion.
+
+    Returns:
+    str: The text of the note.
+    """
+    return "\n".join(plain_text(properties.get(name)) for name in ("mytext", "summary", "tags"))
+
+
+class HashedEmbedder:
+    """
+    Embeds text as signed counts of hashed words, word pairs and character trigrams.
+
+    Needs no model and no network. Notes that share words, or words with the
+    same stems, get similar vectors.
+    """
+    def __init__(self, dimensions):
+        self.dimensions = dimensions
+        self.name = "hashed-{}".format(dimensions)
+
+    def features(self, text):
+        """
+        Method to get the n-grams of a text.
+        """
+        words = WORD.findall(text.lower())
+        features = words + [a + " " + b for a, b in zip(words, words[1:])]
+        for word in words:
+            padded = "<" + word + ">"
+            features += [padded[i:i + 3] for i in range(len(padded) - 2)]
+        return features
+
+    def embed(self, texts):
+        """
+        Method to embed texts.
+
+        Parameters:
+        texts (list): The texts.
+
+        Returns:
+        ndarray: One unit-length float32 row per text.
+        """
+        vectors = np.zeros((len(texts), self.dimensions), np.float32)
+        for row, text in enumerate(texts):
+            hashes = np.fromiter((zlib.crc32(feature.encode("utf-8")) for feature in self.features(text)), np.uint32)
+            # The top bit of the hash is the sign, so collisions cancel out on average
+            signs = np.where(hashes & 0x80000000, 1.0, -1.0).astype(np.float32)
+            np.add.at(vectors[row], hashes % self.dimensions, signs)
+            # Long notes should not outweigh short ones on common words
+            vectors[row] = np.sign(vectors[row]) * np.log1p(np.abs(vectors[row]))
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-9)
+
+
+class ModelEmbedder:
+    """
+    Embeds text with a sentence-transformers model on the CPU.
+    """
+    def __init__(self, name):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(name, device="cpu")
+        self.dimensions = self.model.get_sentence_embedding_dimension()
+        self.name = name
+
+    def embed(self, texts):
+        """
+        Method to embed texts.
+
+        Parameters:
+        texts (list): The texts.
+
+        Returns:
+        ndarray: One unit-length float32 row per text.
+        """
+        return self.model.encode(texts, batch_size=64, normalize_embeddings=True).astype(np.float32)
+
+
+class VectorIndex:
+    """
+    Index of note vectors for finding related notes.
+
+    The vectors are quantized to int8 with a scale per row, a quarter of the size
+    of float32, and stored as the rows of a flat file that is memory-mapped, so
+    the operating system keeps only the pages in use in memory. Searches score
+    RELATED_BLOCK_ROWS rows at a time against a batch of queries and keep the top
+    k of each block, so a search needs little memory however large the index
+    grows. The page of each row is kept in SQLite. Writes hold a file lock, so
+    worker processes sharing the index do not hand out the same row twice.
+    Reading past the end of a mapped file kills the process, so the file only
+    grows in place: a new index is written to another file and moved over the
+    old one, and readers map the new file when they see it.
+    """
+    def __init__(self, directory, embedder):
+        os.makedirs(directory, exist_ok=True)
+        self.embedder = embedder
+        self.dimensions = embedder.dimensions
+        self.path = os.path.join(directory, "vectors.i8")
+        self.dtype = np.dtype([("vector", np.int8, (self.dimensions,)), ("scale", np.float32)])
+        self.lock = threading.Lock()
+        self.lock_path = os.path.join(directory, "vectors.lock")
+        self.matrix = None
+        self.inode = None
+        self.db = sqlite3.connect(os.path.join(directory, "vectors.sqlite"), check_same_thread=False,
+                                  isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS rows (
+                row INTEGER PRIMARY KEY,
+                page_id TEXT NOT NULL UNIQUE,
+                url TEXT NOT NULL,
+                title TEXT NOT NULL
+            )""")
+
+        with file_lock(self.lock_path):
+            # Vectors of another embedder cannot be compared, start over until the index is synced again
+            stored = self.db.execute("SELECT value FROM settings WHERE name = 'embedder'").fetchone()
+            if stored is None or stored[0] != embedder.name:
+                if stored is not None:
+                    log_event(logging.WARNING, "related_reset", previous=stored[0], embedder=embedder.name)
+                self.db.execute("DELETE FROM rows")
+                self.db.execute("INSERT OR REPLACE INTO settings VALUES ('embedder', ?)", (embedder.name,))
+                self.empty_file()
+
+            self.count = self.stored_count()
+            # Drop rows written after the last commit, e.g. by a crash, no process maps them
+            with open(self.path, "ab") as vector_file:
+                vector_file.truncate(self.count * self.dtype.itemsize)
+
+    def stored_count(self):
+        """
+        Method to get the number of rows committed, by this or another process.
+
+        Returns:
+        int: The number of rows.
+        """
+        return self.db.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM rows").fetchone()[0]
+
+    def empty_file(self):
+        """
+        Method to replace the vector file with an empty one, leaving the old file to the processes that mapped it.
+        """
+        with open(self.path + ".tmp", "wb"):
+            pass
+        os.replace(self.path + ".tmp", self.path)
+
+    def rows(self):
+        """
+        Method to get the stored vectors, mapping the file again if it has grown or was replaced.
+
+        Returns:
+        memmap: The quantized vectors and their scales, one row per note.
+        """
+        self.count = self.stored_count()
+        if self.matrix is None or len(self.matrix) != self.count or os.stat(self.path).st_ino != self.inode:
+            # The rows and the file are replaced together under the file lock
+            with file_lock(self.lock_path):
+                self.count = self.stored_count()
+                self.inode = os.stat(self.path).st_ino
+                self.matrix = (np.memmap(self.path, self.dtype, "r", shape=(self.count,))
+                               if self.count else np.zeros(0, self.dtype))
+        return self.matrix
+
+    def quantize(self, vectors):
+        """
+        Method to turn float vectors into rows of the vector file.
+
+        Parameters:
+        vectors (ndarray): One vector per row.
+
+        Returns:
+        ndarray: The int8 vectors and the scales that turn them back into floats.
+        """
+        rows = np.zeros(len(vectors), self.dtype)
+        scales = np.maximum(np.abs(vectors).max(axis=1), 1e-9) / 127
+        rows["vector"] = np.round(vectors / scales[:, None])
+        rows["scale"] = scales
+        return rows
+
+    def add(self, notes):
+        """
+        Method to add or update notes.
+
+        Parameters:
+        notes (list): Tuples of page ID, link, title and text of the notes.
+        """
+        if not notes:
+            return
+        vectors = self.quantize(self.embedder.embed([text for _, _, _, text in notes]))
+        with self.lock, file_lock(self.lock_path):
+            self.count = self.stored_count()
+            new = []
+            with open(self.path, "r+b") as vector_file:
+                for (page_id, url, title, _), vector in zip(notes, vectors):
+                    existing = self.db.execute("SELECT row FROM rows WHERE page_id = ?", (page_id,)).fetchone()
+                    if existing is not None:
+                        # A note that is indexed again keeps its row
+                        vector_file.seek(existing[0] * self.dtype.itemsize)
+                        vector_file.write(vector.tobytes())
+                        self.db.execute("UPDATE rows SET url = ?, title = ? WHERE row = ?", (url, title, existing[0]))
+                    else:
+                        vector_file.seek((self.count + len(new)) * self.dtype.itemsize)
+                        vector_file.write(vector.tobytes())
+                        new.append((self.count + len(new), page_id, url, title))
+            self.db.executemany("INSERT INTO rows VALUES (?, ?, ?, ?)", new)
+            self.count += len(new)
+
+    def search(self, queries, k):
+        """
+        Method to find the most similar rows of each query vector.
+
+        Parameters:
+        queries (ndarray): One unit-length query vector per row.
+        k (int): The number of results per query.
+
+        Returns:
+        list: For each query, a list of pairs of similarity and row number, most similar first.
+        """
+        with self.lock:
+            matrix = self.rows()
+        queries = np.asarray(queries, np.float32).T
+        best_scores = []
+        best_rows = []
+        for start in range(0, len(matrix), RELATED_BLOCK_ROWS):
+            block = matrix[start:start + RELATED_BLOCK_ROWS]
+            scores = (block["vector"].astype(np.float32) @ queries) * block["scale"][:, None]
+            if len(scores) > k:
+                top = np.argpartition(-scores, k - 1, axis=0)[:k]
+                scores = np.take_along_axis(scores, top, axis=0)
+            else:
+                top = np.broadcast_to(np.arange(len(scores))[:, None], scores.shape)
+            best_scores.append(scores)
+            best_rows.append(top + start)
+        if not best_scores:
+            return [[] for _ in range(queries.shape[1])]
+
+        scores = np.concatenate(best_scores)
+        rows = np.concatenate(best_rows)
+        results = []
+        for column in range(scores.shape[1]):
+            order = np.argsort(-scores[:, column])[:k]
+            results.append([(float(scores[i, column]), int(rows[i, column])) for i in order])
+        return results
+
+    def related(self, texts, k=RELATED_RESULTS, min_score=RELATED_MIN_SCORE):
+        """
+        Method to find the notes related to some texts.
+
+        Parameters:
+        texts (list): The texts, searched in one batch.
+        k (int, optional): The number of notes per text. Defaults to RELATED_RESULTS.
+        min_score (float, optional): The least cosine similarity of a related note. Defaults to RELATED_MIN_SCORE.
+
+        Returns:
+        list: For each text, a list of tuples of link, title and similarity of the related notes.
+        """
+        results = []
+        for matches in self.search(self.embedder.embed(texts), k):
+            notes = []
+            for score, row in matches:
+                if score < min_score:
+                    break
+                with self.lock:
+                    url, title = self.db.execute("SELECT url, title FROM rows WHERE row = ?", (row,)).fetchone()
+                notes.append((url, title, score))
+            results.append(notes)
+        return results
+
+    async def record_page(self, meta, page, error):
+        """
+        Method to index a page once it is created, called by the Notion writer when a job finishes.
+
+        Parameters:
+        meta (dict): The meta data of the job.
+        page (dict): The created Notion page, or None if the page could not be created.
+        error (str): The error returned by Notion, if any.
+        """
+        if page is not None:
+            properties = page.get("properties", {})
+            note = (page["id"], page.get("url") or "", plain_text(properties.get("mytext")), note_text(properties))
+            await asyncio.to_thread(self.add, [note])
+
+    def clear(self):
+        """
+        Method to remove every note from the index.
+        """
+        with self.lock, file_lock(self.lock_path):
+            self.db.execute("BEGIN")
+            self.db.execute("DELETE FROM rows")
+            self.empty_file()
+            self.db.execute("COMMIT")
+            self.count = 0
+            self.matrix = None
+
+    def take_over(self, other, start):
+        """
+        Method to replace the notes with those of an index built next to this one.
+
+        Notes added to this index while the other was built are kept.
+
+        Parameters:
+        other (VectorIndex): The new index, with the same embedder.
+        start (int): The number of rows of this index when the other was started.
+        """
+        with self.lock, file_lock(self.lock_path):
+            rows = other.db.execute("SELECT row, page_id, url, title FROM rows ORDER BY row").fetchall()
+            pages = {row[1] for row in rows}
+            added = [row for row in self.db.execute("SELECT row, page_id, url, title FROM rows WHERE row >= ? "
+                                                    "ORDER BY row", (start,)).fetchall() if row[1] not in pages]
+            count = len(rows)
+            with open(self.path, "rb") as old_file, open(other.path, "r+b") as new_file:
+                new_file.seek(count * self.dtype.itemsize)
+                for row, page_id, url, title in added:
+                    old_file.seek(row * self.dtype.itemsize)
+                    new_file.write(old_file.read(self.dtype.itemsize))
+                    rows.append((count, page_id, url, title))
+                    count += 1
+
+            self.db.execute("BEGIN")
+            self.db.execute("DELETE FROM rows")
+            self.db.executemany("INSERT INTO rows VALUES (?, ?, ?, ?)", rows)
+            os.replace(other.path, self.path)
+            self.db.execute("COMMIT")
+            self.count = count
+            self.matrix = None
+
+    async def sync(self, pages, batch_size=256):
+        """
+        Method to rebuild the index from every page of the Notion database.
+
+        The new index is built next to this one and takes its place when it is
+        complete, so a running bot keeps finding related notes meanwhile.
+
+        Parameters:
+        pages (async iterable): The pages of the Notion database.
+        batch_size (int, optional): The number of pages embedded at a time. Defaults to 256.
+
+        Returns:
+        int: The number of pages indexed.
+        """
+        with self.lock:
+            start = self.stored_count()
+        directory = os.path.join(os.path.dirname(self.path), "rebuild")
+        shutil.rmtree(directory, ignore_errors=True)
+        rebuilt = VectorIndex(directory, self.embedder)
+        try:
+            count = 0
+            batch = []
+            async for page in pages:
+                if page.get("archived"):
+                    continue
+                properties = page.get("properties", {})
+                batch.append((page["id"], page.get("url") or "", plain_text(properties.get("mytext")),
+                              note_text(properties)))
+                if len(batch) >= batch_size:
+                    await asyncio.to_thread(rebuilt.add, batch)
+                    count += len(batch)
+                    batch = []
+            await asyncio.to_thread(rebuilt.add, batch)
+            await asyncio.to_thread(self.take_over, rebuilt, start)
+        finally:
+            rebuilt.db.close()
+            shutil.rmtree(directory, ignore_errors=True)
+        return count + len(batch)
+
+
+def get_embedder():
+    """
+    Function to create the embedder: the configured model if it can be loaded, hashed n-grams otherwise.
+
+    Returns:
+    HashedEmbedder or ModelEmbedder: The embedder.
+    """
+    if RELATED_MODEL:
+        try:
+            return ModelEmbedder(RELATED_MODEL)
+        except Exception as err:
+            log_error("related_model", err, model=RELATED_MODEL)
+    return HashedEmbedder(RELATED_DIMENSIONS)
+
+
+# The index shared by every handler, opened on first use, from the warm-up thread or a handler
+_index = None
+_index_lock = threading.Lock()
+
+def get_related_index():
+    """
+    Function to get the index of note vectors.
+
+    Opening it imports NumPy and loads the vectors, so handlers call it in a worker thread.
+
+    Returns:
+    VectorIndex: The shared index, or None if NumPy is not installed.
+    """
+    global _index
+    if _index is None and np is not None:
+        with _index_lock:
+            if _index is None:
+                _index = VectorIndex(os.path.join(CACHE_DIR, "related"), get_embedder())
+    return _index
+
+
+async def record_related_page(meta, page, error):
+    """
+    Function to index a page once it is created, opening the shared index if it is not open yet.
+
+    Parameters:
+    meta (dict): The meta data of the job.
+    page (dict): The created Notion page, or None if the page could not be created.
+    error (str): The error returned by Notion, if any.
+    """
+    index = await asyncio.to_thread(get_related_index)
+    if index is not None:
+        await index.record_page(meta, page, error)
+
+
+async def sync_index():
+    """
+    Function to index the Notion database.
+    """
+    from utils.http_client import close_http_client
+    from utils.notion_api import iter_database_pages
+
+    start = time.perf_counter()
+    try:
+        count = await get_related_index().sync(iter_database_pages())
+    finally:
+        await close_http_client()
+    print("Indexed {} pages in {:.1f}s".format(count, time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Vector index of the saved notes for finding related notes.")
+    parser.add_argument("--sync", action="store_true",
+                        help="Index the Notion database again. The bot may keep running meanwhile.")
+    parser.add_argument("text", nargs="*", help="Find the notes related to a text.")
+    args = parser.parse_args()
+    if get_related_index() is None:
+        parser.exit(1, "The related notes index needs NumPy\n")
+    if args.sync:
+        asyncio.run(sync_index())
+    if args.text:
+        for url, title, score in get_related_index().related([" ".join(args.text)])[0]:
+            print("{:.2f}".format(score), url, title, sep="\t")
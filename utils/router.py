@@ -0,0 +1,271 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque, Counter
+
+from dotenv import load_dotenv
+
+from utils.metrics import log_event, log_error
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Providers of the model calls, in order of preference, e.g. "gemini,openai"
+ROUTER_PROVIDERS = os.getenv("ROUTER_PROVIDERS", "gemini,openai")
+# Seconds an attempt may take before it counts as failed
+ROUTER_TIMEOUT = float(os.getenv("ROUTER_TIMEOUT", 60))
+# Whether to ask the next provider too when the first is slower than usual, and take the first answer
+ROUTER_HEDGE = os.getenv("ROUTER_HEDGE", "").lower() in ("1", "true", "yes")
+# A call is slower than usual after this quantile of the provider's recent latencies
+ROUTER_HEDGE_QUANTILE = float(os.getenv("ROUTER_HEDGE_QUANTILE", 0.95))
+# Seconds to wait before hedging while there are too few latencies to tell
+ROUTER_HEDGE_DELAY = float(os.getenv("ROUTER_HEDGE_DELAY", 10))
+# Number of recent latencies kept per provider and call, and the least needed to use them
+ROUTER_WINDOW = int(os.getenv("ROUTER_WINDOW", 200))
+ROUTER_MIN_SAMPLES = int(os.getenv("ROUTER_MIN_SAMPLES", 20))
+# Failures in a row that take a provider out of rotation, and seconds until it is tried again
+ROUTER_BREAKER_FAILURES = int(os.getenv("ROUTER_BREAKER_FAILURES", 5))
+ROUTER_BREAKER_COOLDOWN = float(os.getenv("ROUTER_BREAKER_COOLDOWN", 30))
+
+
+class LatencyTracker:
+    """
+    The recent latencies of the calls of one kind to one provider.
+    """
+    def __init__(self, size=ROUTER_WINDOW):
+        self.samples = deque(maxlen=size)
+
+    def add(self, seconds):
+        """
+        Method to record the latency of a successful call.
+
+        Parameters:
+        seconds (float): How long it took.
+        """
+        self.samples.append(seconds)
+
+    def quantile(self, q):
+        """
+        Method to get a quantile of the recent latencies.
+
+        Parameters:
+        q (float): The quantile, e.g. 0.95.
+
+        Returns:
+        float: The latency in seconds, or None if there are fewer than ROUTER_MIN_SAMPLES.
+        """
+        if len(self.samples) < ROUTER_MIN_SAMPLES:
+            return None
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+class CircuitBreaker:
+    """
+    Takes a provider out of rotation after `failures` failed calls in a row.
+
+    After `cooldown` seconds the breaker is half open: one call is let through,
+    and its outcome closes the breaker or opens it for another cooldown.
+    """
+    def __init__(self, name, failures=ROUTER_BREAKER_FAILURES, cooldown=ROUTER_BREAKER_COOLDOWN):
+        self.name = name
+        self.failures = failures
+        self.cooldown = cooldown
+        self.count = 0
+        self.opened_at = None
+        self.trial = False
+
+    @property
+    def state(self):
+        """
+        The state of the breaker: closed, open or half_open.
+        """
+        if self.opened_at is None:
+            return "closed"
+        return "open" if time.monotonic() - self.opened_at < self.cooldown else "half_open"
+
+    def allow(self):
+        """
+        Method to check whether a call may be sent, taking the trial call if the breaker is half open.
+
+        Returns:
+        bool: Whether the call may be sent.
+        """
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "open" or self.trial:
+            return False
+        self.trial = True
+        return True
+
+    def release(self):
+        """
+        Method to give back the trial call when it was cancelled before it had an outcome.
+        """
+        self.trial = False
+
+    def record_success(self):
+        """
+        Method to record a successful call, closing the breaker.
+        """
+        if self.opened_at is not None:
+            log_event(logging.INFO, "breaker_closed", provider=self.name)
+        self.count = 0
+        self.opened_at = None
+        self.trial = False
+
+    def record_failure(self):
+        """
+        Method to record a failed call, opening the breaker after too many in a row.
+        """
+        self.count += 1
+        self.trial = False
+        if self.opened_at is not None or self.count >= self.failures:
+            self.opened_at = time.monotonic()
+            log_event(logging.WARNING, "breaker_open", provider=self.name, failures=self.count,
+                      cooldown=self.cooldown)
+
+
+class Provider:
+    """
+    A model provider: its calls by kind, e.g. "text" and "image", with a breaker and latencies.
+    """
+    def __init__(self, name, calls, breaker=None):
+        self.name = name
+        self.calls = calls
+        self.breaker = breaker or CircuitBreaker(name)
+        self.latency = {kind: LatencyTracker() for kind in calls}
+
+
+class ProviderRouter:
+    """
+    Sends each model call to the first provider whose breaker is closed, falling back to the next on failure.
+
+    Every attempt has a timeout. With hedging, if the provider has not answered
+    by its usual p95 latency, the next provider is asked as well, the first
+    answer is used and the other attempt is cancelled. Cancelled attempts count
+    neither as failures nor as latencies.
+    """
+    def __init__(self, providers, timeout=ROUTER_TIMEOUT, hedge=ROUTER_HEDGE, hedge_quantile=ROUTER_HEDGE_QUANTILE,
+                 hedge_delay=ROUTER_HEDGE_DELAY):
+        self.providers = providers
+        self.timeout = timeout
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_delay = hedge_delay
+        self.stats = Counter()
+
+    def hedge_after(self, provider, kind):
+        """
+        Method to get how long to wait for a provider before hedging.
+
+        Returns:
+        float: The number of seconds.
+        """
+        latency = provider.latency[kind].quantile(self.hedge_quantile)
+        return latency if latency is not None else self.hedge_delay
+
+    async def attempt(self, provider, kind, args):
+        """
+        Method to make one call to one provider and record its outcome.
+
+        Returns:
+        object: The result of the call.
+        """
+        start = time.monotonic()
+        try:
+            result = await asyncio.wait_for(provider.calls[kind](*args), self.timeout)
+        except asyncio.CancelledError:
+            provider.breaker.release()
+            raise
+        except Exception as err:
+            provider.breaker.record_failure()
+            self.stats[provider.name + "_failures"] += 1
+            log_error("router", err, provider=provider.name, kind=kind)
+            raise
+        provider.breaker.record_success()
+        provider.latency[kind].add(time.monotonic() - start)
+        return result
+
+    async def call(self, kind, *args):
+        """
+        Method to make a model call through the providers.
+
+        Parameters:
+        kind (str): The kind of call, e.g. "text" or "image".
+        args: The arguments of the call.
+
+        Returns:
+        object: The result of the first provider that answered.
+        """
+        return (await self.call_with_provider(kind, *args))[1]
+
+    async def call_with_provider(self, kind, *args):
+        """
+        Method to make a model call through the providers, telling which one answered.
+
+        Parameters:
+        kind (str): The kind of call, e.g. "text" or "image".
+        args: The arguments of the call.
+
+        Returns:
+        tuple: A tuple containing the name of the first provider that answered and its result.
+        """
+        providers = [provider for provider in self.providers if kind in provider.calls]
+        if not providers:
+            raise RuntimeError("No model provider can handle {} calls".format(kind))
+        remaining = list(providers)
+        pending = {}
+
+        def launch():
+            # The next provider whose breaker lets the call through
+            while remaining:
+                provider = remaining.pop(0)
+                if provider.breaker.allow():
+                    pending[asyncio.create_task(self.attempt(provider, kind, args))] = provider
+                    return provider
+            return None
+
+        first = launch()
+        if first is None:
+            # Every breaker is open, trying the preferred provider beats failing the note outright
+            first = providers[0]
+            pending[asyncio.create_task(self.attempt(first, kind, args))] = first
+        hedge_at = time.monotonic() + self.hedge_after(first, kind) if self.hedge else None
+
+        error = None
+        try:
+            while pending:
+                timeout = max(0.0, hedge_at - time.monotonic()) if hedge_at is not None and remaining else None
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedge_at = None
+                    provider = launch()
+                    if provider is not None:
+                        self.stats["hedges"] += 1
+                        log_event(logging.INFO, "router_hedge", kind=kind, slow=first.name, hedge=provider.name)
+                    continue
+                for task in done:
+                    provider = pending.pop(task)
+                    if task.exception() is None:
+                        if provider is not first:
+                            self.stats[provider.name + "_answers"] += 1
+                        return provider.name, task.result()
+                    error = task.exception()
+                if not pending and launch() is not None:
+                    self.stats["fallbacks"] += 1
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def open_breakers(self):
+        """
+        Method to count the providers taken out of rotation.
+
+        Returns:
+        int: The number of breakers that are not closed.
+        """
+        return sum(1 for provider in self.providers if provider.breaker.state != "closed")
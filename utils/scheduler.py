@@ -0,0 +1,149 @@
+import os
+import time
+import asyncio
+from collections import deque
+
+from dotenv import load_dotenv
+
+from utils.metrics import get_metrics, log_error
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Number of notes processed at the same time, sized for the Gemini, Whisper and Notion quotas
+SCHEDULER_WORKERS = int(os.getenv("SCHEDULER_WORKERS", 8))
+# Number of notes waiting overall and per chat before new ones are turned away
+SCHEDULER_MAX_PENDING = int(os.getenv("SCHEDULER_MAX_PENDING", 200))
+SCHEDULER_MAX_PER_CHAT = int(os.getenv("SCHEDULER_MAX_PER_CHAT", 20))
+
+
+class SchedulerFull(Exception):
+    """
+    Raised when a job is submitted while too many jobs are waiting.
+    """
+
+
+class ChatScheduler:
+    """
+    Runs jobs on a bounded pool of workers, one job per chat at a time.
+
+    Each chat has a FIFO queue, so the notes of a chat are processed in the order
+    they were sent. Chats with waiting jobs take turns for the workers, so a chat
+    that sends many notes does not hold up the others.
+    """
+    def __init__(self, workers, max_pending, max_per_chat):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_per_chat = max_per_chat
+        self.queues = {}
+        self.active = set()
+        self.pending = 0
+        self.ready = None
+        self.tasks = []
+
+    def is_full(self, chat_id):
+        """
+        Method to check whether a new job of a chat would be turned away.
+
+        Parameters:
+        chat_id (int): The chat of the job.
+
+        Returns:
+        bool: Whether the scheduler is full.
+        """
+        return (self.pending >= self.max_pending
+                or len(self.queues.get(chat_id, ())) >= self.max_per_chat)
+
+    def ahead(self, chat_id):
+        """
+        Method to estimate how many jobs would run before a new job of a chat.
+
+        Parameters:
+        chat_id (int): The chat of the job.
+
+        Returns:
+        int: The number of jobs ahead of it.
+        """
+        ahead = len(self.queues.get(chat_id, ())) + (chat_id in self.active)
+        # Other chats waiting for a worker get their turn first
+        if len(self.active) >= self.workers:
+            ahead += self.ready.qsize()
+        return ahead
+
+    def submit(self, chat_id, job):
+        """
+        Method to queue a job of a chat.
+
+        Parameters:
+        chat_id (int): The chat of the job.
+        job (coroutine function): The job, called without arguments.
+
+        Raises:
+        SchedulerFull: If too many jobs are waiting.
+        """
+        if self.is_full(chat_id):
+            raise SchedulerFull()
+        queue = self.queues.get(chat_id)
+        if queue is None:
+            queue = self.queues[chat_id] = deque()
+            # The chat has no job running or waiting, give it a turn
+            if chat_id not in self.active:
+                self.ready.put_nowait(chat_id)
+        queue.append((job, time.perf_counter()))
+        self.pending += 1
+
+    async def start(self):
+        """
+        Method to start the workers in the running event loop.
+        """
+        if not self.tasks:
+            self.ready = asyncio.Queue()
+            self.tasks = [asyncio.create_task(self.work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """
+        Method to stop the workers. Jobs that have not started are dropped.
+        """
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def work(self):
+        """
+        Method run by each worker: take the next chat in turn and run its oldest job.
+        """
+        while True:
+            chat_id = await self.ready.get()
+            queue = self.queues[chat_id]
+            job, submitted_at = queue.popleft()
+            get_metrics().observe("queue_wait", time.perf_counter() - submitted_at)
+            if not queue:
+                del self.queues[chat_id]
+            self.pending -= 1
+            self.active.add(chat_id)
+            try:
+                await job()
+            except Exception as err:
+                log_error("job", err, chat_id=chat_id)
+            finally:
+                self.active.discard(chat_id)
+                # Jobs that arrived meanwhile wait for their chat's next turn
+                if chat_id in self.queues:
+                    self.ready.put_nowait(chat_id)
+
+
+# The scheduler shared by every handler
+_scheduler = None
+
+def get_scheduler():
+    """
+    Function to get the scheduler of the note processing jobs.
+
+    Returns:
+    ChatScheduler: The shared scheduler.
+    """
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = ChatScheduler(SCHEDULER_WORKERS, SCHEDULER_MAX_PENDING, SCHEDULER_MAX_PER_CHAT)
+    return _scheduler
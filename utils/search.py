@@ -0,0 +1,254 @@
+import os
+import re
+import time
+import sqlite3
+import asyncio
+import argparse
+import threading
+
+from dotenv import load_dotenv
+
+from utils.cache import CACHE_DIR
+from utils.dedup import plain_text
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Number of results of a search
+SEARCH_RESULTS = int(os.getenv("SEARCH_RESULTS", 10))
+
+# Weights of title, summary, tags and link in the ranking
+SEARCH_WEIGHTS = (10.0, 4.0, 6.0, 1.0)
+
+SEARCH_TERM = re.compile(r'(#?)(\w+)(\*?)')
+
+
+def build_query(text):
+    """
+    Function to turn what the user typed into an FTS5 query.
+
+    Every word must be in the note, a word ending with * matches any word it starts.
+    Words starting with # must match a tag. Quotes and operators are not passed
+    through, so any input is a valid query.
+
+    Parameters:
+    text (str): The search terms.
+
+    Returns:
+    str: The FTS5 query, empty if there are no words.
+    """
+    terms = []
+    for tag, word, prefix in SEARCH_TERM.findall(text):
+        term = '"{}"{}'.format(word, prefix)
+        terms.append("tags : " + term if tag else term)
+    return " ".join(terms)
+
+
+def page_fields(page):
+    """
+    Function to get the indexed fields of a Notion page.
+
+    Parameters:
+    page (dict): The Notion page.
+
+    Returns:
+    tuple: The page ID, link, title, summary, tags, saved link and creation time of the page.
+    """
+    properties = page.get("properties", {})
+    return (page["id"], page.get("url") or "",
+            plain_text(properties.get("mytext")),
+            plain_text(properties.get("summary")),
+            plain_text(properties.get("tags")),
+            (properties.get("link") or {}).get("url") or "",
+            page.get("created_time") or "")
+
+
+class SearchIndex:
+    """
+    Full-text index of the saved notes in SQLite FTS5.
+
+    The notes are stored in a plain table and indexed by an external content FTS5
+    table kept in sync by triggers, so a note is searchable as soon as it is
+    stored. Results are ranked with BM25, matches in the title and tags count most.
+    """
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS notes (
+                id INTEGER PRIMARY KEY,
+                page_id TEXT NOT NULL UNIQUE,
+                url TEXT NOT NULL,
+                title TEXT NOT NULL,
+                summary TEXT NOT NULL,
+                tags TEXT NOT NULL,
+                link TEXT NOT NULL,
+                created_at TEXT NOT NULL
+            );
+            CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(
+                title, summary, tags, link,
+                content='notes', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+            );
+            CREATE TRIGGER IF NOT EXISTS notes_insert AFTER INSERT ON notes BEGIN
+                INSERT INTO notes_fts (rowid, title, summary, tags, link)
+                VALUES (new.id, new.title, new.summary, new.tags, new.link);
+            END;
+            CREATE TRIGGER IF NOT EXISTS notes_delete AFTER DELETE ON notes BEGIN
+                INSERT INTO notes_fts (notes_fts, rowid, title, summary, tags, link)
+                VALUES ('delete', old.id, old.title, old.summary, old.tags, old.link);
+            END;
+            CREATE TRIGGER IF NOT EXISTS notes_update AFTER UPDATE ON notes BEGIN
+                INSERT INTO notes_fts (notes_fts, rowid, title, summary, tags, link)
+                VALUES ('delete', old.id, old.title, old.summary, old.tags, old.link);
+                INSERT INTO notes_fts (rowid, title, summary, tags, link)
+                VALUES (new.id, new.title, new.summary, new.tags, new.link);
+            END;""")
+        # Rank with the weighted BM25 inside FTS5, so only the best rows are read from the notes table
+        self.db.execute("INSERT INTO notes_fts (notes_fts, rank) VALUES ('rank', ?)",
+                        ("bm25({}, {}, {}, {})".format(*SEARCH_WEIGHTS),))
+
+    def add(self, notes):
+        """
+        Method to add or update notes in one transaction.
+
+        Parameters:
+        notes (list): Tuples of page ID, link, title, summary, tags, saved link and creation time, see page_fields.
+        """
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                self.db.executemany("""
+                    INSERT INTO notes (page_id, url, title, summary, tags, link, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (page_id) DO UPDATE SET url = excluded.url, title = excluded.title,
+                        summary = excluded.summary, tags = excluded.tags, link = excluded.link,
+                        created_at = excluded.created_at""", notes)
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def remove(self, page_ids):
+        """
+        Method to remove notes from the index.
+
+        Parameters:
+        page_ids (list): The IDs of the pages.
+        """
+        with self.lock:
+            self.db.executemany("DELETE FROM notes WHERE page_id = ?", [(page_id,) for page_id in page_ids])
+
+    def search(self, text, limit=SEARCH_RESULTS):
+        """
+        Method to find the notes that best match the search terms.
+
+        Parameters:
+        text (str): The search terms.
+        limit (int, optional): The maximum number of results. Defaults to SEARCH_RESULTS.
+
+        Returns:
+        list: Tuples of link, title and tags of the matching notes, best match first.
+        """
+        query = build_query(text)
+        if not query:
+            return []
+        with self.lock:
+            return self.db.execute("""
+                SELECT notes.url, notes.title, notes.tags FROM (
+                    SELECT rowid, rank FROM notes_fts WHERE notes_fts MATCH ? ORDER BY rank LIMIT ?
+                ) AS best JOIN notes ON notes.id = best.rowid ORDER BY best.rank""", (query, limit)).fetchall()
+
+    def count(self):
+        """
+        Method to count the indexed notes.
+
+        Returns:
+        int: The number of notes.
+        """
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM notes").fetchone()[0]
+
+    async def record_page(self, meta, page, error):
+        """
+        Method to index a page as soon as it is created, called by the Notion writer when a job finishes.
+
+        Parameters:
+        meta (dict): The meta data of the job.
+        page (dict): The created Notion page, or None if the page could not be created.
+        error (str): The error returned by Notion, if any.
+        """
+        if page is not None:
+            self.add([page_fields(page)])
+
+    async def sync(self, pages, batch_size=500):
+        """
+        Method to index every page of the Notion database and drop the notes that are gone from it.
+
+        Parameters:
+        pages (async iterable): The pages of the Notion database.
+        batch_size (int, optional): The number of pages written per transaction. Defaults to 500.
+
+        Returns:
+        int: The number of pages indexed.
+        """
+        seen = set()
+        batch = []
+        async for page in pages:
+            if page.get("archived"):
+                continue
+            seen.add(page["id"])
+            batch.append(page_fields(page))
+            if len(batch) >= batch_size:
+                self.add(batch)
+                batch = []
+        self.add(batch)
+
+        with self.lock:
+            stored = [row[0] for row in self.db.execute("SELECT page_id FROM notes")]
+        self.remove([page_id for page_id in stored if page_id not in seen])
+        return len(seen)
+
+
+# The index shared by every handler, opened on first use
+_index = None
+
+def get_search_index():
+    """
+    Function to get the full-text index of the saved notes.
+
+    Returns:
+    SearchIndex: The shared index.
+    """
+    global _index
+    if _index is None:
+        _index = SearchIndex(os.path.join(CACHE_DIR, "search.sqlite"))
+    return _index
+
+
+async def sync_index():
+    """
+    Function to sync the index with the Notion database.
+    """
+    from utils.http_client import close_http_client
+    from utils.notion_api import iter_database_pages
+
+    start = time.perf_counter()
+    try:
+        count = await get_search_index().sync(iter_database_pages())
+    finally:
+        await close_http_client()
+    print("Indexed {} pages in {:.1f}s".format(count, time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Full-text index of the saved notes.")
+    parser.add_argument("--sync", action="store_true", help="Sync the index with the Notion database.")
+    parser.add_argument("query", nargs="*", help="Search the index.")
+    args = parser.parse_args()
+    if args.sync:
+        asyncio.run(sync_index())
+    for url, title, tags in get_search_index().search(" ".join(args.query)):
+        print(url, title, tags, sep="\t")
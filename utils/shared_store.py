@@ -0,0 +1,112 @@
+import os
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from dotenv import load_dotenv
+
+from utils.cache import CACHE_DIR
+
+# File locks are only needed when several processes share the stores
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Telegram keeps undelivered updates for a day, an update ID is not sent again after that
+UPDATE_TTL = float(os.getenv("UPDATE_TTL", 24 * 3600))
+# Seconds between removals of expired update IDs
+PRUNE_INTERVAL = 3600
+
+
+@contextmanager
+def file_lock(path):
+    """
+    Function to hold an exclusive lock on a file, shared by every thread and process that locks the same path.
+
+    The lock is released if the process dies, so a crashed worker cannot leave it held.
+
+    Parameters:
+    path (str): The lock file, created if needed.
+    """
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class SharedStore:
+    """
+    Store shared by the worker processes of the bot.
+
+    Telegram sends an update again when the webhook does not answer in time, and
+    the retry may reach another worker. Each update ID is claimed in SQLite so
+    only one worker handles it.
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.pruned_at = 0.0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS updates (
+                update_id INTEGER PRIMARY KEY,
+                claimed_at REAL NOT NULL,
+                worker INTEGER NOT NULL
+            )""")
+
+    def claim_update(self, update_id, worker=0):
+        """
+        Method to claim an update before handling it.
+
+        Parameters:
+        update_id (int): The ID of the Telegram update.
+        worker (int, optional): The number of the worker process claiming it. Defaults to 0.
+
+        Returns:
+        bool: Whether the update was claimed, False if a worker has claimed it before.
+        """
+        now = time.time()
+        with self.lock:
+            if now - self.pruned_at > PRUNE_INTERVAL:
+                self.db.execute("DELETE FROM updates WHERE claimed_at < ?", (now - UPDATE_TTL,))
+                self.pruned_at = now
+            cursor = self.db.execute("INSERT OR IGNORE INTO updates VALUES (?, ?, ?)", (update_id, now, worker))
+        return cursor.rowcount == 1
+
+    def release_update(self, update_id):
+        """
+        Method to give up the claim on an update that could not be queued, so its retry is handled.
+
+        Parameters:
+        update_id (int): The ID of the Telegram update.
+        """
+        with self.lock:
+            self.db.execute("DELETE FROM updates WHERE update_id = ?", (update_id,))
+
+
+# The store shared by every handler, opened on first use
+_store = None
+
+def get_shared_store():
+    """
+    Function to get the store shared by the worker processes.
+
+    Returns:
+    SharedStore: The shared store.
+    """
+    global _store
+    if _store is None:
+        _store = SharedStore(os.path.join(CACHE_DIR, "shared.sqlite"))
+    return _store
@@ -0,0 +1,105 @@
+import re
+import ast
+import json
+from typing import NamedTuple
+
+# Use the faster JSON parser when it is installed
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+# Patterns of the tolerant extractor, compiled once
+FENCED_BLOCK = re.compile(r'```(?:json)?\s*(.*?)```', re.DOTALL | re.IGNORECASE)
+TRAILING_COMMA = re.compile(r',\s*([}\]])')
+
+
+class NoteSummary(NamedTuple):
+    """
+    The summary and tags generated for a note.
+    """
+    summary: str
+    tags: str
+
+
+def extract_object(text):
+    """
+    Function to find the JSON object in a model reply.
+
+    Parameters:
+    text (str): The model reply.
+
+    Returns:
+    str: The text from the first opening to the last closing brace, or None if there is none.
+    """
+    fenced = FENCED_BLOCK.search(text)
+    if fenced:
+        text = fenced.group(1)
+    start = text.find('{')
+    end = text.rfind('}')
+    if start == -1 or end < start:
+        return None
+    return text[start:end + 1]
+
+
+def load_object(text):
+    """
+    Function to parse a JSON object, tolerating the usual mistakes of model replies.
+
+    Tries strict JSON first, then JSON without trailing commas, then a Python
+    literal (single quotes, None). Nothing is ever evaluated as code.
+
+    Parameters:
+    text (str): The model reply.
+
+    Returns:
+    dict: The parsed object, or None if it cannot be parsed.
+    """
+    try:
+        value = json_loads(text)
+    except ValueError:
+        candidate = extract_object(text)
+        if candidate is None:
+            return None
+        try:
+            value = json_loads(TRAILING_COMMA.sub(r'\1', candidate))
+        except ValueError:
+            try:
+                value = ast.literal_eval(candidate)
+            except (ValueError, SyntaxError, MemoryError, RecursionError):
+                return None
+    return value if isinstance(value, dict) else None
+
+
+def as_text(value):
+    """
+    Function to turn a field of the model reply into a string.
+
+    Parameters:
+    value (object): The field, a string, a list of strings or None.
+
+    Returns:
+    str: The field as a string.
+    """
+    if value is None:
+        return ""
+    if isinstance(value, (list, tuple)):
+        return ", ".join(str(item) for item in value if item is not None)
+    return str(value)
+
+
+def parse_summary(text):
+    """
+    Function to parse and validate the summary reply of the model.
+
+    Parameters:
+    text (str): The model reply.
+
+    Returns:
+    NoteSummary: The summary and tags, or None if the reply has no usable summary object.
+    """
+    value = load_object(text)
+    if value is None or not ("summary" in value or "tags" in value):
+        return None
+    return NoteSummary(as_text(value.get("summary")), as_text(value.get("tags")))
@@ -0,0 +1,271 @@
+import os
+import hmac
+import signal
+import asyncio
+import logging
+import multiprocessing
+from urllib.parse import urlparse
+
+from aiohttp import web
+from dotenv import load_dotenv
+from telegram import Bot, Update
+
+from utils.http_client import get_http_client
+from utils.metrics import log_event, log_error, configure_logging
+from utils.shared_store import get_shared_store
+
+# Load environment variables from .env file
+load_dotenv()
+
+TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
+# Public HTTPS address Telegram sends the updates to, e.g. https://bot.example.com/telegram
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+# Sent back by Telegram with every update, requests without it are rejected
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# Address the workers listen on, usually behind a TLS-terminating proxy
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8080))
+# Number of worker processes sharing the port, one per core by default
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", os.cpu_count() or 1))
+# Worker N also listens on 127.0.0.1 at this port + N for the updates of its chats received by other workers
+WEBHOOK_INTERNAL_PORT = int(os.getenv("WEBHOOK_INTERNAL_PORT", WEBHOOK_PORT + 1))
+# Number of connections Telegram opens to deliver updates in parallel, 1 to 100
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def chat_worker(update, workers):
+    """
+    Function to get the worker process that handles the updates of a chat.
+
+    Every update of a chat goes to the same worker, so its scheduler keeps the
+    notes of the chat in order and counts them against the chat's limit.
+
+    Parameters:
+    update (Update): The update.
+    workers (int): The number of worker processes.
+
+    Returns:
+    int: The number of the worker, or None if the update has no chat.
+    """
+    chat = update.effective_chat
+    return chat.id % workers if chat is not None else None
+
+
+async def forward_update(data, owner):
+    """
+    Function to pass an update to the worker that handles its chat.
+
+    Parameters:
+    data (dict): The update as received from Telegram.
+    owner (int): The number of the worker.
+
+    Returns:
+    bool: Whether the worker queued it.
+    """
+    try:
+        res = await get_http_client().post("http://127.0.0.1:{}/forward".format(WEBHOOK_INTERNAL_PORT + owner),
+                                           json=data, headers={SECRET_HEADER: WEBHOOK_SECRET})
+        return res.status_code == 200
+    except Exception as err:
+        log_error("webhook_forward", err, owner=owner)
+        return False
+
+
+async def read_update(request, bot):
+    """
+    Function to read the update of a webhook request.
+
+    Parameters:
+    request (Request): The request.
+    bot (Bot): The bot the update is for.
+
+    Returns:
+    tuple: A tuple containing the update as received and as an Update, or None if it is not an update.
+    """
+    try:
+        data = await request.json()
+    except ValueError:
+        return None
+    if not isinstance(data, dict) or not isinstance(data.get("update_id"), int):
+        return None
+    try:
+        return data, Update.de_json(data, bot)
+    except Exception as err:
+        log_error("webhook_update", err, update_id=data["update_id"])
+        return None
+
+
+async def handle_update(request):
+    """
+    Function to receive an update from Telegram and queue it for the application.
+
+    The update is answered as soon as it is queued, so Telegram does not send
+    it again while the note is processed. Updates of chats handled by another
+    worker are passed on to it, or queued here if it cannot be reached.
+
+    Parameters:
+    request (Request): The webhook request.
+
+    Returns:
+    Response: 200 if the update was queued or handled before, 403 without the secret, 400 if it is not an update.
+    """
+    if not hmac.compare_digest(request.headers.get(SECRET_HEADER, "").encode(), WEBHOOK_SECRET.encode()):
+        return web.Response(status=403)
+    application = request.app["application"]
+    # Parsed before it is claimed, a claimed update that fails would be dropped when Telegram retries it
+    received = await read_update(request, application.bot)
+    if received is None:
+        return web.Response(status=400)
+    data, update = received
+
+    worker = application.bot_data.get("worker", 0)
+    workers = application.bot_data.get("workers", 1)
+    # A retried update may have reached another worker first
+    if not get_shared_store().claim_update(data["update_id"], worker):
+        log_event(logging.INFO, "webhook_duplicate", update_id=data["update_id"], worker=worker)
+        return web.Response()
+    try:
+        owner = chat_worker(update, workers)
+        if owner is not None and owner != worker and await forward_update(data, owner):
+            return web.Response()
+        await application.update_queue.put(update)
+    except BaseException:
+        get_shared_store().release_update(data["update_id"])
+        raise
+    return web.Response()
+
+
+async def handle_forwarded(request):
+    """
+    Function to receive an update passed on by another worker, already claimed by it.
+
+    Parameters:
+    request (Request): The request of the other worker.
+
+    Returns:
+    Response: 200 if the update was queued, 403 without the secret, 400 if it is not an update.
+    """
+    if not hmac.compare_digest(request.headers.get(SECRET_HEADER, "").encode(), WEBHOOK_SECRET.encode()):
+        return web.Response(status=403)
+    application = request.app["application"]
+    received = await read_update(request, application.bot)
+    if received is None:
+        return web.Response(status=400)
+    await application.update_queue.put(received[1])
+    return web.Response()
+
+
+async def serve(application, worker=0, workers=1):
+    """
+    Function to run the application on updates received by the webhook until the process is stopped.
+
+    Parameters:
+    application (Application): The application, not initialized yet.
+    worker (int, optional): The number of this worker process. Defaults to 0.
+    workers (int, optional): The number of worker processes sharing the port. Defaults to 1.
+    """
+    application.bot_data["worker"] = worker
+    application.bot_data["workers"] = workers
+    await application.initialize()
+    if application.post_init is not None:
+        await application.post_init(application)
+    await application.start()
+
+    server = web.Application(client_max_size=1024 * 1024)
+    server["application"] = application
+    server.router.add_post(urlparse(WEBHOOK_URL).path or "/", handle_update)
+    runner = web.AppRunner(server, access_log=None)
+    await runner.setup()
+    # Every worker listens on the same port, the kernel spreads the connections across them
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT, reuse_port=workers > 1).start()
+    if workers > 1:
+        internal = web.Application(client_max_size=1024 * 1024)
+        internal["application"] = application
+        internal.router.add_post("/forward", handle_forwarded)
+        internal_runner = web.AppRunner(internal, access_log=None)
+        await internal_runner.setup()
+        # Only other workers on this machine send updates here
+        await web.TCPSite(internal_runner, "127.0.0.1", WEBHOOK_INTERNAL_PORT + worker).start()
+        runners = [runner, internal_runner]
+    else:
+        runners = [runner]
+    log_event(logging.INFO, "webhook_started", worker=worker, host=WEBHOOK_HOST, port=WEBHOOK_PORT)
+
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopped.set)
+    try:
+        await stopped.wait()
+    finally:
+        for runner in runners:
+            await runner.cleanup()
+        await application.stop()
+        await application.shutdown()
+        if application.post_shutdown is not None:
+            await application.post_shutdown(application)
+
+
+def run_worker(build_application, worker, workers):
+    """
+    Function to run one worker process.
+
+    Parameters:
+    build_application (function): Creates the application with its handlers.
+    worker (int): The number of this worker process.
+    workers (int): The number of worker processes.
+    """
+    configure_logging()
+    asyncio.run(serve(build_application(), worker, workers))
+
+
+async def set_webhook():
+    """
+    Function to tell Telegram where to send the updates, with the secret it must send back.
+    """
+    async with Bot(TELEGRAM_TOKEN) as bot:
+        await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET, max_connections=WEBHOOK_MAX_CONNECTIONS,
+                              allowed_updates=Update.ALL_TYPES)
+
+
+def run_webhook(build_application, workers=WEBHOOK_WORKERS):
+    """
+    Function to register the webhook and serve it from one or more worker processes.
+
+    The workers only share state through the files in the cache directory, so
+    they are started fresh rather than forked from a process with open clients.
+    Every update of a chat is handled by the same worker, passed on over
+    127.0.0.1 if another worker received it, so the notes of a chat keep their
+    order and count against one per-chat limit.
+
+    Parameters:
+    build_application (function): Creates the application with its handlers, a module-level function.
+    workers (int, optional): The number of worker processes. Defaults to WEBHOOK_WORKERS.
+    """
+    if not WEBHOOK_URL or not WEBHOOK_SECRET:
+        raise SystemExit("Set WEBHOOK_URL and WEBHOOK_SECRET to receive updates by webhook")
+    asyncio.run(set_webhook())
+    if workers <= 1:
+        asyncio.run(serve(build_application()))
+        return
+
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=run_worker, args=(build_application, worker, workers))
+                 for worker in range(workers)]
+    for process in processes:
+        process.start()
+
+    def stop(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+    # Workers stop on their own on Ctrl-C, the parent forwards SIGTERM
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for process in processes:
+        process.join()
+        if process.exitcode:
+            log_error("webhook_worker", RuntimeError("exit code {}".format(process.exitcode)), pid=process.pid)